@@ -0,0 +1,244 @@
+"""
+Product catalog with indexed lookups and hot reload.
+
+Products are loaded from a JSON file into an immutable snapshot indexed by
+product id. The file is polled for changes, and a new
+snapshot replaces the current one with a single reference assignment, so a
+request that grabbed a product keeps a consistent view of it while later
+requests see the new catalog. A file that fails to load or validate is
+logged and the current snapshot stays in place.
+
+The file looks like:
+    {
+        "products": [
+            {
+                "id": "fundamentals",
+                "type": "guide",
+                "title": "Fundamentals of Mushroom Cultivation",
+                "description": "...",
+                "price": 20.0,
+                "image": "/mush1.webp",
+                "file_list": ["guides/fundamentals.pdf"],
+                "delivery_mode": "direct",
+                "stripe_price_id_prod": "price_...",
+                "stripe_price_id_dev": "price_..."
+            }
+        ]
+    }
+
+delivery_mode picks how a product's files reach the customer. 'copy' (the
+default) copies every file to a per-order key and presigns the copy,
+'direct' presigns the canonical file with a per-order download filename.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from types import MappingProxyType
+
+log = logging.getLogger("mycomize-backend")
+
+REQUIRED_FIELDS = ("id", "type", "title", "description", "price", "image", "file_list")
+BUILT_IN_SOURCE = "built-in product list"
+DELIVERY_MODES = ("copy", "direct")
+DEFAULT_DELIVERY_MODE = "copy"
+
+class CatalogError(Exception):
+    """Raised when a product catalog fails validation."""
+
+class CatalogSnapshot:
+    """
+    An immutable, indexed view of the product catalog.
+
+    Args:
+        products (list): Product dicts, each with a 'stripe_price_id' for the
+            current deployment
+        source (str): Where the products came from, for logging
+    """
+
+    def __init__(self, products, source):
+        self.source = source
+        self.products = tuple(MappingProxyType(dict(product)) for product in products)
+        self.by_id = {}
+
+        for product in self.products:
+            missing = [field for field in REQUIRED_FIELDS if field not in product]
+            if missing:
+                raise CatalogError(f"product {product.get('id')} is missing {', '.join(missing)}")
+            if not isinstance(product['price'], (int, float)) or product['price'] < 0:
+                raise CatalogError(f"product {product['id']} has an invalid price {product['price']!r}")
+            if product.get('delivery_mode', DEFAULT_DELIVERY_MODE) not in DELIVERY_MODES:
+                raise CatalogError(f"product {product['id']} has an invalid delivery mode {product['delivery_mode']!r}")
+            if product['id'] in self.by_id:
+                raise CatalogError(f"duplicate product id {product['id']}")
+
+            self.by_id[product['id']] = product
+
+        guide_list = [{
+            "id": product['id'],
+            "title": product['title'],
+            "description": product['description'],
+            "price": product['price'],
+            "image": product['image']
+        } for product in self.products if product['type'] == 'guide']
+
+        # The /guides response, serialized once per catalog
+        self.guides_body = json.dumps({"guides": guide_list}, separators=(",", ":")).encode("utf-8")
+        self.guides_etag = '"' + hashlib.sha256(self.guides_body).hexdigest()[:32] + '"'
+
+# Catalog state, set by configure_catalog()
+catalog_file = None
+catalog_deployment_type = None
+catalog_file_signature = None
+snapshot = None
+
+def file_signature(path):
+    """
+    Get a cheap change signature of a file, also used for the config file.
+
+    Returns:
+        tuple: (mtime in ns, size), or None if the file doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def load_catalog_file(path, deployment_type):
+    """
+    Load and validate a catalog file.
+
+    Args:
+        path (str): Path of the catalog JSON file
+        deployment_type (str): 'prod' or 'dev', selects the Stripe price ids
+
+    Returns:
+        CatalogSnapshot: The loaded catalog
+
+    Raises:
+        CatalogError: If the file can't be parsed or fails validation
+    """
+    try:
+        with open(path, 'r') as f:
+            products = json.load(f)['products']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise CatalogError(f"failed to read {path}: {e}")
+
+    if not isinstance(products, list):
+        raise CatalogError(f"'products' in {path} is not a list")
+
+    for product in products:
+        if not isinstance(product, dict):
+            raise CatalogError(f"product {product!r} in {path} is not an object")
+        product['stripe_price_id'] = product.get(f'stripe_price_id_{deployment_type}', product.get('stripe_price_id', ''))
+
+    return CatalogSnapshot(products, path)
+
+def configure_catalog(path, deployment_type, default_products):
+    """
+    Load the catalog at startup.
+
+    Args:
+        path (str): Path of the catalog JSON file, which may not exist yet
+        deployment_type (str): 'prod' or 'dev', selects the Stripe price ids
+        default_products (list): Products to serve while the file doesn't exist
+
+    Raises:
+        CatalogError: If the catalog file exists but is invalid
+    """
+    global catalog_file, catalog_deployment_type, catalog_file_signature, snapshot
+
+    catalog_file = path
+    catalog_deployment_type = deployment_type
+    catalog_file_signature = file_signature(path)
+
+    if catalog_file_signature is None:
+        snapshot = CatalogSnapshot(default_products, BUILT_IN_SOURCE)
+    else:
+        snapshot = load_catalog_file(path, deployment_type)
+
+    log.info(f"catalog: loaded {len(snapshot.products)} products from {snapshot.source}")
+
+def current_catalog():
+    """
+    Get the current catalog snapshot. Hold on to the returned snapshot for
+    the duration of a request to see a consistent catalog.
+
+    Returns:
+        CatalogSnapshot: The current catalog
+    """
+    return snapshot
+
+def build_default_catalog(default_products):
+    """
+    Build the catalog of the built-in product list.
+
+    Args:
+        default_products (list): Products to serve while the file doesn't exist
+
+    Returns:
+        CatalogSnapshot: The built-in catalog
+
+    Raises:
+        CatalogError: If the products fail validation
+    """
+    return CatalogSnapshot(default_products, BUILT_IN_SOURCE)
+
+def set_default_catalog(default_catalog):
+    """
+    Replace the built-in catalog. Takes effect only while the built-in
+    list is being served, a loaded catalog file always wins over it.
+
+    Args:
+        default_catalog (CatalogSnapshot): Catalog built by build_default_catalog()
+    """
+    global snapshot
+
+    if snapshot.source != BUILT_IN_SOURCE:
+        return
+
+    snapshot = default_catalog
+    log.info(f"catalog: reloaded {len(snapshot.products)} products from {snapshot.source}")
+
+def reload_catalog():
+    """
+    Reload the catalog file if it changed since it was last loaded.
+
+    Returns:
+        bool: True if a new snapshot was swapped in
+    """
+    global catalog_file_signature, snapshot
+
+    signature = file_signature(catalog_file)
+    if signature == catalog_file_signature:
+        return False
+
+    catalog_file_signature = signature
+
+    if signature is None:
+        log.warning(f"catalog: {catalog_file} was removed, keeping the current catalog")
+        return False
+
+    try:
+        new_snapshot = load_catalog_file(catalog_file, catalog_deployment_type)
+    except CatalogError as e:
+        log.error(f"catalog: not reloading, keeping the current catalog: {e}")
+        return False
+
+    snapshot = new_snapshot
+    log.info(f"catalog: reloaded {len(snapshot.products)} products from {snapshot.source}")
+    return True
+
+async def watch_catalog(interval):
+    """
+    Poll the catalog file and reload it when it changes, for as long as the app runs.
+
+    Args:
+        interval (float): Seconds between checks
+    """
+    while True:
+        await asyncio.sleep(interval)
+        reload_catalog()
@@ -0,0 +1,80 @@
+"""
+Validation of /checkout request bodies.
+
+The body is parsed and validated in one pass by a Pydantic model, before
+any DNS lookup, database query or upstream call. Everything that can be
+checked from the request alone is checked here: the payment type, field
+lengths and shapes, and the location fields a Bitcoin checkout needs. A
+malformed request is turned into the same error codes the checkout always
+returned, without any I/O.
+"""
+from typing import Literal
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
+from pydantic_core import PydanticCustomError
+
+# Bodies larger than this are rejected without parsing them
+MAX_BODY_BYTES = 4096
+
+ERROR_INVALID_REQUEST = "error_invalid_request"
+ERROR_INVALID_LOCATION = "error_invalid_location"
+
+# Error code of each field of the request
+FIELD_ERRORS = {
+    "type": "error_invalid_payment_type",
+    "id": "error_invalid_product_id",
+    "email": "error_invalid_email",
+    "city": ERROR_INVALID_LOCATION,
+    "state": ERROR_INVALID_LOCATION,
+    "zipcode": ERROR_INVALID_LOCATION,
+    "country": ERROR_INVALID_LOCATION,
+}
+
+class CheckoutRequest(BaseModel):
+    """
+    A /checkout request. The location fields are only sent, and required,
+    for Bitcoin payments, Stripe collects the address itself.
+    """
+    model_config = ConfigDict(str_strip_whitespace=True, frozen=True)
+
+    type: Literal["btc", "stripe"]
+    id: str = Field(min_length=1, max_length=64)
+    # Only the shape is checked here, deliverability is checked by EmailDeliverabilityChecker
+    email: str = Field(min_length=3, max_length=254, pattern=r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+    city: str = Field("", max_length=100)
+    state: str = Field("", max_length=100)
+    zipcode: str = Field("", max_length=16, pattern=r"^[A-Za-z0-9 -]*$")
+    country: str = Field("", max_length=64)
+
+    @model_validator(mode="after")
+    def require_location(self):
+        if self.type == "btc":
+            missing = [field for field in ("city", "state", "zipcode", "country") if not getattr(self, field)]
+            if missing:
+                raise PydanticCustomError("location_missing", "missing {fields}", {"fields": ", ".join(missing)})
+        return self
+
+def parse_checkout_request(body):
+    """
+    Parse and validate a /checkout request body.
+
+    Args:
+        body (bytes): The raw request body
+
+    Returns:
+        tuple: (CheckoutRequest, None, None) for a valid request, or
+            (None, error code, reason) for an invalid one
+    """
+    if len(body) > MAX_BODY_BYTES:
+        return None, ERROR_INVALID_REQUEST, f"body of {len(body)} bytes"
+
+    try:
+        return CheckoutRequest.model_validate_json(body), None, None
+    except ValidationError as e:
+        error = e.errors(include_url=False, include_input=False)[0]
+
+    field = error["loc"][0] if error["loc"] else None
+    reason = f"{field}: {error['msg']}" if field else error["msg"]
+
+    if error["type"] == "location_missing":
+        return None, ERROR_INVALID_LOCATION, reason
+    return None, FIELD_ERRORS.get(field, ERROR_INVALID_REQUEST), reason
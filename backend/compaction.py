@@ -0,0 +1,170 @@
+"""
+Garbage collection and compaction of the SQLite databases.
+
+Expired, Failed and Canceled orders are kept for a retention window, then
+archived as JSON lines under data/<deployment>/archive/ and deleted in small
+batches, so the invoice scans (stats, reconciliation) only see live orders.
+Each archived order gets an order_archived event, and order events older
+than the retention window are pruned. The databases run in incremental
+auto_vacuum mode, freed pages are returned to the filesystem after every
+pass, and a full VACUUM and ANALYZE runs on a slower schedule.
+"""
+import json
+import os
+
+from database import Invoice, OrderEvent, RateLimit
+from datetime import date, datetime
+from order_events import ORDER_ARCHIVED, append_order_event
+from sqlalchemy import text
+
+# Order states that end an order without a sale
+TERMINAL_ORDER_STATES = ("Expired", "Failed", "Canceled")
+
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+
+def invoice_to_json(invoice):
+    row = {}
+    for column in Invoice.__table__.columns:
+        value = getattr(invoice, column.name)
+        row[column.name] = value.isoformat() if isinstance(value, (date, datetime)) else value
+    return json.dumps(row, separators=(",", ":"))
+
+def archive_terminal_invoices(invoice_db, archive_dir, cutoff, batch_size=500):
+    """
+    Archive and delete terminal orders created before a cutoff.
+
+    Each batch is appended to the month's archive file and synced to disk
+    before it is deleted, so an interrupted run archives a batch twice at
+    worst and never loses one.
+
+    Args:
+        invoice_db (Session): Invoice database session
+        archive_dir (str): Directory of the invoices-YYYY-MM.jsonl archive files
+        cutoff (datetime): Orders created before it are archived
+        batch_size (int): Orders archived and deleted per transaction
+
+    Returns:
+        int: Number of orders archived
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_file = os.path.join(archive_dir, f"invoices-{datetime.now():%Y-%m}.jsonl")
+    archived = 0
+
+    while True:
+        invoices = invoice_db.query(Invoice) \
+            .filter(Invoice.order_state.in_(TERMINAL_ORDER_STATES), Invoice.created_at < cutoff) \
+            .limit(batch_size) \
+            .all()
+        if not invoices:
+            break
+
+        with open(archive_file, "a") as f:
+            f.write("".join(invoice_to_json(invoice) + "\n" for invoice in invoices))
+            f.flush()
+            os.fsync(f.fileno())
+
+        order_ids = [invoice.order_id for invoice in invoices]
+        for invoice in invoices:
+            append_order_event(invoice_db, ORDER_ARCHIVED, invoice)
+        invoice_db.query(Invoice).filter(Invoice.order_id.in_(order_ids)).delete(synchronize_session=False)
+        invoice_db.commit()
+        invoice_db.expunge_all()
+
+        archived += len(order_ids)
+        if len(order_ids) < batch_size:
+            break
+
+    return archived
+
+def prune_order_events(invoice_db, cutoff, batch_size=500):
+    """
+    Delete order events recorded before a cutoff.
+
+    Args:
+        invoice_db (Session): Invoice database session
+        cutoff (datetime): Events recorded before it are deleted
+        batch_size (int): Events deleted per transaction
+
+    Returns:
+        int: Number of events deleted
+    """
+    cutoff_time = cutoff.timestamp()
+    deleted = 0
+
+    while True:
+        ids = [row[0] for row in invoice_db.query(OrderEvent.id)
+               .filter(OrderEvent.recorded_at < cutoff_time)
+               .order_by(OrderEvent.id)
+               .limit(batch_size)
+               .all()]
+        if not ids:
+            break
+
+        deleted += invoice_db.query(OrderEvent).filter(OrderEvent.id.in_(ids)).delete(synchronize_session=False)
+        invoice_db.commit()
+
+    return deleted
+
+def reset_rate_limits(rate_limit_db, batch_size=500):
+    """
+    Delete every checkout rate limit counter, which starts a new rate limit window.
+
+    Args:
+        rate_limit_db (Session): Rate limit database session
+        batch_size (int): Rows deleted per transaction
+
+    Returns:
+        int: Number of counters deleted
+    """
+    deleted = 0
+
+    while True:
+        emails = [row[0] for row in rate_limit_db.query(RateLimit.email).limit(batch_size).all()]
+        if not emails:
+            break
+
+        deleted += rate_limit_db.query(RateLimit).filter(RateLimit.email.in_(emails)).delete(synchronize_session=False)
+        rate_limit_db.commit()
+
+    return deleted
+
+def database_bytes(conn):
+    page_count = conn.execute(text("PRAGMA page_count")).scalar()
+    page_size = conn.execute(text("PRAGMA page_size")).scalar()
+    return page_count * page_size
+
+def compact_database(engine, full=False):
+    """
+    Return a database's free pages to the filesystem and refresh its planner statistics.
+
+    A database that isn't in incremental auto_vacuum mode yet is switched
+    to it, which takes a full VACUUM.
+
+    Args:
+        engine (Engine): The database's engine
+        full (bool): Rebuild the database with VACUUM and run a full ANALYZE,
+            instead of an incremental vacuum and PRAGMA optimize
+
+    Returns:
+        tuple: (size in bytes after compaction, bytes reclaimed)
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        before = database_bytes(conn)
+
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != SQLITE_AUTO_VACUUM_INCREMENTAL:
+            conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+            full = True
+
+        if full:
+            conn.execute(text("VACUUM"))
+            conn.execute(text("ANALYZE"))
+        else:
+            # Each step of the statement frees one page and the sqlite3 module
+            # steps a statement without result columns only once, executescript
+            # runs it to completion
+            conn.connection.driver_connection.executescript("PRAGMA incremental_vacuum")
+            conn.execute(text("PRAGMA optimize"))
+
+        after = database_bytes(conn)
+
+    return after, before - after
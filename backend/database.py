@@ -1,16 +1,19 @@
-from sqlalchemy import create_engine, Column, String, Integer, Date, Float
+from sqlalchemy import create_engine, Column, String, Integer, Date, DateTime, Float, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from datetime import date
+from metrics import instrument_engine, instrument_sessionmaker
 
 # Database URLs
 DEV_INVOICE_DATABASE_URL = "sqlite:///./data/dev/invoices.db"
 DEV_RATE_LIMIT_DATABASE_URL = "sqlite:///./data/dev/rate_limits.db"
 DEV_API_USAGE_DATABASE_URL = "sqlite:///./data/dev/api_usage.db"
+DEV_WEBHOOK_INBOX_DATABASE_URL = "sqlite:///./data/dev/webhook_inbox.db"
 
 PROD_INVOICE_DATABASE_URL = "sqlite:///./data/prod/invoices.db"
 PROD_RATE_LIMIT_DATABASE_URL = "sqlite:///./data/prod/rate_limits.db"
 PROD_API_USAGE_DATABASE_URL = "sqlite:///./data/prod/api_usage.db"
+PROD_WEBHOOK_INBOX_DATABASE_URL = "sqlite:///./data/prod/webhook_inbox.db"
 
 # Invoice database setup
 prod_invoice_engine = create_engine(PROD_INVOICE_DATABASE_URL, connect_args={"check_same_thread": False})
@@ -36,22 +39,47 @@ ProdApiUsageSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=
 dev_api_usage_engine = create_engine(DEV_API_USAGE_DATABASE_URL, connect_args={"check_same_thread": False})
 DevApiUsageSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=dev_api_usage_engine)
 
+# Webhook inbox database setup
+prod_webhook_inbox_engine = create_engine(PROD_WEBHOOK_INBOX_DATABASE_URL, connect_args={"check_same_thread": False})
+ProdWebhookInboxSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=prod_webhook_inbox_engine)
+
+# Webhook inbox database setup
+dev_webhook_inbox_engine = create_engine(DEV_WEBHOOK_INBOX_DATABASE_URL, connect_args={"check_same_thread": False})
+DevWebhookInboxSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=dev_webhook_inbox_engine)
+
+# Query and commit timing for the /metrics endpoint
+for engine, session_factory, database in [
+    (prod_invoice_engine, ProdInvoiceSessionLocal, "invoices"),
+    (prod_rate_limit_engine, ProdRateLimitSessionLocal, "rate_limits"),
+    (prod_api_usage_engine, ProdApiUsageSessionLocal, "api_usage"),
+    (dev_invoice_engine, DevInvoiceSessionLocal, "invoices"),
+    (dev_rate_limit_engine, DevRateLimitSessionLocal, "rate_limits"),
+    (dev_api_usage_engine, DevApiUsageSessionLocal, "api_usage"),
+    (prod_webhook_inbox_engine, ProdWebhookInboxSessionLocal, "webhook_inbox"),
+    (dev_webhook_inbox_engine, DevWebhookInboxSessionLocal, "webhook_inbox"),
+]:
+    instrument_engine(engine, database)
+    instrument_sessionmaker(session_factory, database)
+
 Base = declarative_base()
 
 class Invoice(Base):
     __tablename__ = "invoices"
 
-    email = Column(String, primary_key=True)
+    # A customer (email) can hold any number of orders
+    order_id = Column(String, primary_key=True)
+    email = Column(String, nullable=False)
     payment_type = Column(String, nullable=False)
-    order_id = Column(String, nullable=False, index=True)
     order_state = Column(String, nullable=False)
     checkout_link= Column(String, nullable=False)
     product_id = Column(String, nullable=False)
     created_at_time = Column(String, nullable=False)
     fulfillment_time = Column(String, nullable=True)
-    stripe_session_id = Column(String, nullable=True, index=True)
+    created_at = Column(DateTime, nullable=True)  # NULL only until backfilled by tool/mycomize-migrate.py
+    fulfilled_at = Column(DateTime, nullable=True)
+    stripe_session_id = Column(String, nullable=True)
     stripe_invoice_state = Column(String, nullable=True)
-    btcpay_invoice_id = Column(String, nullable=True, index=True)
+    btcpay_invoice_id = Column(String, nullable=True)
     btcpay_invoice_state = Column(String, nullable=True)
     btcpay_city = Column(String, nullable=True)
     btcpay_state = Column(String, nullable=True)
@@ -59,6 +87,22 @@ class Invoice(Base):
     btcpay_country = Column(String, nullable=True)
     btcpay_sales_tax = Column(Float, nullable=True)
 
+    # Schema changes to this table need a matching step in tool/mycomize-migrate.py
+    __table_args__ = (
+        # Checkout looks up a customer's latest order of a product
+        Index("ix_invoices_customer_orders", "email", "product_id", "created_at"),
+        # The SSE streams poll the order state by payment reference, these
+        # indexes answer those polls without reading the table. They only
+        # hold the orders paid that way, so ANALYZE never sees a column
+        # that is all NULL and decides a scan is cheaper.
+        Index("ix_invoices_stripe_sessions", "stripe_session_id", "order_state",
+              sqlite_where=text("stripe_session_id IS NOT NULL")),
+        Index("ix_invoices_btcpay_invoices", "btcpay_invoice_id", "order_state",
+              sqlite_where=text("btcpay_invoice_id IS NOT NULL")),
+        # Garbage collection and reconciliation scan orders by state and age
+        Index("ix_invoices_state_created", "order_state", "created_at"),
+    )
+
 class RateLimit(Base):
     __tablename__ = "rate_limits"
 
@@ -74,6 +118,48 @@ class ApiUsage(Base):
     api_type = Column(String, primary_key=True)  # 'address_validation' or 'email_sending'
     count = Column(Integer, nullable=False, default=0)
 
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+
+    # Append-only inbox of verified webhook deliveries, applied in id order
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dedupe_key = Column(String, nullable=False, unique=True)  # e.g. 'stripe:{event_id}' or 'btcpay:{invoice_id}:{type}:{delivery_id}'
+    source = Column(String, nullable=False)  # 'stripe' or 'btcpay'
+    event_type = Column(String, nullable=False)
+    invoice_key = Column(String, nullable=False)  # Stripe session id or BTCPay invoice id
+    payload = Column(String, nullable=False)
+    received_at = Column(Float, nullable=False)  # Unix time
+    processed_at = Column(Float, nullable=True)  # Unix time, None while pending
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(Float, nullable=False, default=0.0)  # Unix time, pushed back after each failed attempt
+    error = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_webhook_events_pending", "processed_at", "id"),
+    )
+
+class OrderEvent(Base):
+    __tablename__ = "order_events"
+
+    # Append-only, AUTOINCREMENT never reuses an id, so ids are the offsets
+    # consumers resume from even after old events are pruned
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_type = Column(String, nullable=False)  # see order_events.py
+    order_id = Column(String, nullable=False)
+    recorded_at = Column(Float, nullable=False, index=True)  # Unix time
+    payload = Column(String, nullable=False)  # JSON snapshot of the order
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class ProcessedWebhookEvent(Base):
+    __tablename__ = "processed_webhook_events"
+
+    # Dedupe keys of applied webhook events, kept for a retention window
+    dedupe_key = Column(String, primary_key=True)
+    processed_at = Column(Float, nullable=False, index=True)  # Unix time
+
+    __table_args__ = {"sqlite_with_rowid": False}
+
 # Create tables in all databases
 Base.metadata.create_all(bind=prod_invoice_engine)
 Base.metadata.create_all(bind=prod_rate_limit_engine)
@@ -81,6 +167,8 @@ Base.metadata.create_all(bind=prod_api_usage_engine)
 Base.metadata.create_all(bind=dev_invoice_engine)
 Base.metadata.create_all(bind=dev_rate_limit_engine)
 Base.metadata.create_all(bind=dev_api_usage_engine)
+Base.metadata.create_all(bind=prod_webhook_inbox_engine)
+Base.metadata.create_all(bind=dev_webhook_inbox_engine)
 
 # Database session management
 def get_prod_invoice_db():
@@ -126,6 +214,45 @@ def get_dev_api_usage_db():
     finally:
         db.close()
 
+def get_prod_webhook_inbox_db():
+    db = ProdWebhookInboxSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_dev_webhook_inbox_db():
+    db = DevWebhookInboxSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def latest_customer_invoice(db: Session, email: str, product_id: str):
+    """
+    Get a customer's most recent order of a product.
+
+    Args:
+        db (Session): Invoice database session
+        email (str): Customer's email address
+        product_id (str): Product ID
+
+    Returns:
+        Invoice: The most recent invoice, or None if the customer has no order of the product
+    """
+    return db.query(Invoice) \
+        .filter(Invoice.email == email, Invoice.product_id == product_id) \
+        .order_by(Invoice.created_at.desc()) \
+        .first()
+
+def invoice_by_stripe_session(db: Session, session_id: str):
+    """Get the invoice of a Stripe checkout session, or None."""
+    return db.query(Invoice).filter(Invoice.stripe_session_id == session_id).first()
+
+def invoice_by_btcpay_invoice(db: Session, invoice_id: str):
+    """Get the invoice of a BTCPay invoice, or None."""
+    return db.query(Invoice).filter(Invoice.btcpay_invoice_id == invoice_id).first()
+
 def dump_invoice_db(db: Session):
     invoices = db.query(Invoice).all()
     print([invoice.__dict__ for invoice in invoices])
@@ -0,0 +1,134 @@
+"""
+Email validation with cached, non-blocking deliverability checks.
+
+Syntax is checked inline, which needs no I/O. The DNS deliverability check
+runs in a worker thread so it never blocks the event loop, and its result
+is cached per domain. Concurrent checks of the same domain share a single
+lookup and the number of lookups in flight is bounded.
+"""
+import asyncio
+import time
+
+from collections import OrderedDict
+from email_validator import validate_email, EmailUndeliverableError
+from email_validator.deliverability import validate_email_deliverability
+
+import dns.resolver
+
+class EmailDeliverabilityChecker:
+    """
+    Validates email addresses, caching per-domain deliverability results.
+
+    Args:
+        positive_ttl (float): Seconds to cache a deliverable domain
+        negative_ttl (float): Seconds to cache an undeliverable domain
+        max_concurrency (int): Maximum DNS lookups in flight at once
+        max_entries (int): Maximum number of cached domains
+        allowlist (iterable): Domains treated as deliverable without a lookup
+        timeout (float): DNS lookup timeout in seconds
+        dns_resolver (object, optional): Resolver with a dnspython-compatible
+            resolve(domain, rdtype) method. Defaults to a dnspython Resolver.
+    """
+
+    def __init__(self, positive_ttl=86400, negative_ttl=900, max_concurrency=8,
+                 max_entries=10000, allowlist=(), timeout=5, dns_resolver=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.allowlist = frozenset(domain.lower() for domain in allowlist)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        if dns_resolver is None:
+            dns_resolver = dns.resolver.Resolver()
+            dns_resolver.lifetime = timeout
+        self.dns_resolver = dns_resolver
+
+        # domain -> (expires_at, error message or None if deliverable)
+        self.cache = OrderedDict()
+        # domain -> Future shared by concurrent lookups of the same domain
+        self.in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def validate(self, email):
+        """
+        Validate an email address and check that its domain accepts email.
+
+        Args:
+            email (str): The email address to validate
+
+        Returns:
+            str: The normalized email address
+
+        Raises:
+            EmailNotValidError: If the address is malformed or undeliverable
+        """
+        email_info = validate_email(email, check_deliverability=False)
+        domain = email_info.ascii_domain
+
+        if domain not in self.allowlist:
+            error = await self.domain_error(domain, email_info.domain)
+            if error is not None:
+                raise EmailUndeliverableError(error)
+
+        return email_info.normalized
+
+    async def domain_error(self, domain, domain_i18n):
+        """
+        Get the cached or freshly looked up deliverability of a domain.
+
+        Returns:
+            str: Reason the domain is undeliverable, or None if deliverable
+        """
+        entry = self.cache.get(domain)
+        if entry is not None:
+            expires_at, error = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                return error
+            del self.cache[domain]
+
+        self.misses += 1
+
+        future = self.in_flight.get(domain)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[domain] = future
+
+        try:
+            error = await self.lookup(domain, domain_i18n)
+            future.set_result(error)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[domain]
+
+        return error
+
+    async def lookup(self, domain, domain_i18n):
+        async with self.semaphore:
+            try:
+                info = await asyncio.to_thread(validate_email_deliverability, domain, domain_i18n, None, self.dns_resolver)
+            except EmailUndeliverableError as e:
+                self.store(domain, str(e), self.negative_ttl)
+                return str(e)
+
+        # Timeouts and nameserver failures let the address through but
+        # are not cached, so the next checkout retries the lookup
+        if "unknown-deliverability" not in info:
+            self.store(domain, None, self.positive_ttl)
+
+        return None
+
+    def store(self, domain, error, ttl):
+        self.cache[domain] = (time.monotonic() + ttl, error)
+        self.cache.move_to_end(domain)
+
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
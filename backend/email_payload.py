@@ -0,0 +1,72 @@
+"""
+Precompiled MailerSend payloads for fulfillment emails.
+
+Everything in a fulfillment email except the recipient, the order id and
+the download links is the same for every order of a product. It is built
+once per product, with each of the product's files mapped to its template
+variable by extension, so rendering an email only fills in the per-order
+fields. A rendered payload is a complete MailerSend message, ready for the
+single email endpoint or as one entry of a bulk request.
+"""
+import os
+
+# Template variable of each supported file type
+FILE_LINK_VARIABLES = {".pdf": "pdf_link", ".epub": "epub_link"}
+
+class FulfillmentEmailTemplate:
+    """
+    The fixed part of a product's fulfillment email.
+
+    Args:
+        product (dict): The product, its file_list is in the order of the
+            URLs passed to render()
+        template_id (str): MailerSend template ID
+        mail_from (dict): Sender with 'name' and 'email'
+        support_email (str): Support address shown in the email
+    """
+
+    def __init__(self, product, template_id, mail_from, support_email):
+        self.product = product
+        self.template_id = template_id
+
+        # Template variable of each file, None for unsupported file types
+        self.link_variables = tuple(
+            FILE_LINK_VARIABLES.get(os.path.splitext(product_file)[1].lower())
+            for product_file in product['file_list']
+        )
+        self.unsupported_files = [
+            product_file for product_file, variable in zip(product['file_list'], self.link_variables) if variable is None
+        ]
+
+        self.data = {
+            "product_name": product['title'],
+            "support_email": support_email,
+            **{variable: "" for variable in FILE_LINK_VARIABLES.values()},
+        }
+        self.payload = {
+            "from": mail_from,
+            "template_id": template_id,
+        }
+
+    def render(self, email, order_id, url_list):
+        """
+        Build the MailerSend message of an order.
+
+        Args:
+            email (str): Customer's email address
+            order_id (str): Unique order identifier
+            url_list (list): Download URLs, one per file of the product
+
+        Returns:
+            dict: The message
+        """
+        data = dict(self.data, order_id=order_id)
+        for variable, url in zip(self.link_variables, url_list):
+            if variable is not None:
+                data[variable] = url
+
+        return dict(
+            self.payload,
+            to=[{"email": email}],
+            personalization=[{"email": email, "data": data}],
+        )
@@ -0,0 +1,161 @@
+"""
+In-memory per-IP and per-subnet throttling for /checkout.
+
+Each client gets a token bucket that refills at a steady rate up to a burst
+size, and so does the subnet it is in, since rotating through the addresses
+of one network is cheap. A request that finds either bucket empty is
+rejected before the request body is even read. A client is an IPv4 address
+or an IPv6 /64, a subnet is an IPv4 /24 or an IPv6 /48. The buckets are
+kept in their GCRA form: a single float per bucket, the time at which it
+would be full again, instead of a token count and the time of the last
+update.
+
+Buckets are kept in a fixed number of LRU slots per level, so memory stays
+flat no matter how many distinct addresses show up. An evicted bucket is
+one that hasn't been used for a while, and a client that keeps sending
+requests keeps its bucket.
+
+Throttling tightens when upstream API spend hits a milestone: every step
+divides the rate and burst of every bucket, and a step is undone after a
+quiet period without new milestones.
+"""
+import ipaddress
+import time
+
+from collections import OrderedDict
+
+# Keys of IPv6 clients and subnets are offset past every IPv4 key
+IPV6_KEY_OFFSET = 1 << 128
+
+def throttle_keys(host):
+    """
+    Get the client and subnet keys of a host.
+
+    Args:
+        host (str): The client's address, as reported by the server
+
+    Returns:
+        tuple: (client key, subnet key)
+    """
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host, host
+
+    value = int(address)
+    if address.version == 4:
+        return value, value >> 8
+    return IPV6_KEY_OFFSET | (value >> 64), IPV6_KEY_OFFSET | (value >> 80)
+
+class _Buckets:
+    __slots__ = ("max_entries", "entries", "evictions")
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+
+        # key -> time the bucket is full again, least recently used first
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def take(self, key, rate, burst, now):
+        interval = 1 / rate
+        full_at = self.entries.get(key)
+
+        if full_at is None:
+            if len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            full_at = now
+        else:
+            self.entries.move_to_end(key)
+            full_at = max(full_at, now)
+
+        # Taking a token pushes the time the bucket is full again back by one interval
+        if full_at + interval - now > burst * interval:
+            self.entries[key] = full_at
+            return False
+
+        self.entries[key] = full_at + interval
+        return True
+
+class IpThrottle:
+    """
+    Token buckets by client and subnet, in bounded LRU tables.
+
+    Args:
+        rate (float): Tokens added to a client's bucket per second
+        burst (int): Size of a client's bucket
+        subnet_factor (float): A subnet's bucket has this many times the
+            rate and burst of a client's
+        max_entries (int): Number of buckets kept per level
+        tighten_factor (float): Each tightening step divides the rates and
+            bursts by this
+        max_tightening (int): Maximum number of tightening steps
+        relax_seconds (float): Seconds without tightening after which a
+            step is undone
+    """
+
+    def __init__(self, rate, burst, subnet_factor=8, max_entries=50000,
+                 tighten_factor=2, max_tightening=3, relax_seconds=3600):
+        self.rate = rate
+        self.burst = burst
+        self.subnet_factor = subnet_factor
+        self.tighten_factor = tighten_factor
+        self.max_tightening = max_tightening
+        self.relax_seconds = relax_seconds
+
+        self.clients = _Buckets(max_entries)
+        self.subnets = _Buckets(max_entries)
+
+        self.tightening = 0
+        self.tightened_at = 0.0
+
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, host, now=None):
+        """
+        Take a token from the buckets of a client and its subnet.
+
+        Args:
+            host (str): The client's address
+            now (float): Monotonic time, defaults to the current time
+
+        Returns:
+            bool: True if the request may go ahead
+        """
+        now = time.monotonic() if now is None else now
+
+        if self.tightening and now - self.tightened_at >= self.relax_seconds:
+            self.tightening -= 1
+            self.tightened_at = now
+
+        divisor = self.tighten_factor ** self.tightening
+        rate = self.rate / divisor
+        burst = max(1, self.burst / divisor)
+        client_key, subnet_key = throttle_keys(host)
+
+        # The subnet is only charged for requests its client's bucket let
+        # through, so one hot address can't drain the budget of its neighbours
+        allowed = self.clients.take(client_key, rate, burst, now) \
+            and self.subnets.take(subnet_key, rate * self.subnet_factor, burst * self.subnet_factor, now)
+
+        if allowed:
+            self.allowed += 1
+        else:
+            self.rejected += 1
+        return allowed
+
+    def tighten(self, now=None):
+        """
+        Tighten throttling by one step, up to max_tightening steps.
+
+        Args:
+            now (float): Monotonic time, defaults to the current time
+
+        Returns:
+            int: The number of tightening steps now in effect
+        """
+        self.tightening = min(self.max_tightening, self.tightening + 1)
+        self.tightened_at = time.monotonic() if now is None else now
+        return self.tightening
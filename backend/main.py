@@ -6,27 +6,60 @@ import httpx
 import json
 import logging
 import os
+import random
+import signal
 import string
 import stripe
 import secrets
 import subprocess
 import tempfile
+import threading
+import time
 
 from botocore.exceptions import ClientError
+from catalog import DEFAULT_DELIVERY_MODE, build_default_catalog, configure_catalog, current_catalog, set_default_catalog, watch_catalog
+from checkout_request import parse_checkout_request
+from compaction import archive_terminal_invoices, compact_database, prune_order_events, reset_rate_limits
+from contextlib import asynccontextmanager
 from database import (
     Invoice, get_prod_invoice_db, get_dev_invoice_db,
+    latest_customer_invoice, invoice_by_stripe_session, invoice_by_btcpay_invoice,
     RateLimit, get_prod_rate_limit_db, get_dev_rate_limit_db,
     ApiUsage, get_prod_api_usage_db, get_dev_api_usage_db,
+    WebhookEvent, get_prod_webhook_inbox_db, get_dev_webhook_inbox_db,
+    ProdInvoiceSessionLocal, DevInvoiceSessionLocal, ProdApiUsageSessionLocal,
+    ProdWebhookInboxSessionLocal, DevWebhookInboxSessionLocal,
+    ProdRateLimitSessionLocal, DevRateLimitSessionLocal,
+    prod_invoice_engine, dev_invoice_engine, prod_rate_limit_engine, dev_rate_limit_engine,
+    prod_api_usage_engine, prod_webhook_inbox_engine, dev_webhook_inbox_engine,
     increment_api_usage
 )
 from datetime import datetime
-from email_validator import validate_email, EmailNotValidError
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from downloads import MODES_BY_CODE, PresignedUrlCache, download_link, verify_download
+from email_check import EmailDeliverabilityChecker
+from email_payload import FulfillmentEmailTemplate
+from ip_throttle import IpThrottle
+from email_validator import EmailNotValidError
+from fastapi import FastAPI, Depends, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from mailersend import emails
+from order_events import (
+    ORDER_CREATED, OrderStats, append_order_event, order_event_offsets, read_order_events, record_order_change
+)
+from metrics import (
+    RequestMetricsMiddleware, CHECKOUT_REJECTIONS, DATABASE_SIZE, DELIVERY_URL_LATENCY, GC_ARCHIVED_INVOICES, GC_RECLAIMED_BYTES,
+    RECONCILE_TRANSITIONS, SSE_OPEN_STREAMS, WEBHOOK_INBOX_LAG,
+    render_metrics, time_upstream, timed_lock
+)
+from reconcile import list_btcpay_changes, list_stripe_changes
+from s3_lifecycle import expiration_rules, reconcile_lifecycle
 from sqlalchemy import and_
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from settings import load_settings, watch_settings
+from structured_log import configure_logging
+from tracing import configure_tracing, finish_trace, flush_traces, set_trace_attribute, span, start_trace
+from webhook_dedupe import WebhookDedupeStore
 
 class Location:
     def __init__(self, valid, city, state, postal_code, country):
@@ -46,8 +79,63 @@ stripe_webhook_lock = asyncio.Lock()
 invoice_lock = asyncio.Lock()
 rate_limit_lock = asyncio.Lock()
 
-s3_lifecycle_configured = False
-FRONTEND_DEV_HTTP_URL = "http://localhost:5173"
+webhook_inbox_wakeup = asyncio.Event()
+WEBHOOK_INBOX_BATCH_SIZE = 100
+WEBHOOK_INBOX_POLL_SECONDS = 5.0
+
+# The provider got a 200 for an event in the inbox and won't deliver it
+# again, so a failed event is retried with exponential backoff, from a
+# minute up to every 6 hours, for over two days (about as long as the
+# providers' own retry schedules) before it is given up on
+WEBHOOK_INBOX_MAX_ATTEMPTS = 18
+WEBHOOK_INBOX_RETRY_BASE_SECONDS = 60
+WEBHOOK_INBOX_RETRY_MAX_SECONDS = 6 * 3600
+WEBHOOK_DEDUPE_PRUNE_SECONDS = 3600
+
+# Set on SIGTERM/SIGINT, the SSE streams hand off to the client and close
+sse_draining = asyncio.Event()
+SSE_POLL_SECONDS = 2.0
+SSE_RETRY_MS = 3000
+SSE_RETRY_JITTER_MS = 2000
+# Reconnect delay sent by a draining stream, long enough to outlast a restart
+# and jittered so the clients don't all come back in the same second
+SSE_DRAIN_RETRY_MS = 5000
+SSE_DRAIN_RETRY_JITTER_MS = 10000
+SHUTDOWN_FLUSH_SECONDS = 10.0
+
+# Listing starts this long before the oldest pending order, the provider's
+# invoice or session is created a moment before the local row
+RECONCILE_CLOCK_SLACK_SECONDS = 300
+
+GC_BATCH_SIZE = 500
+
+MAIL_FROM = {
+    "name": "Connor",
+    "email": "connor@mycomize.com",
+}
+SUPPORT_EMAIL = "connor@mycomize.com"
+
+# Precompiled fulfillment emails by product id
+fulfillment_email_templates = {}
+
+# Buckets kept per level of the /checkout throttle, about 25MB in all
+CHECKOUT_THROTTLE_MAX_ENTRIES = 50000
+
+# Seconds a presigned URL behind a download link is valid for
+DOWNLOAD_PRESIGN_SECONDS = 3600
+
+# Seconds before a failed lifecycle reconcile is retried
+S3_LIFECYCLE_RETRY_SECONDS = 300
+
+# Largest page of /order-events, and how often a caught up stream checks for new events
+ORDER_EVENTS_PAGE_SIZE = 500
+ORDER_EVENTS_POLL_SECONDS = 1.0
+
+# /invoice-stats figures, seeded from the invoices on first use and then
+# advanced through the order event log
+order_stats = None
+
+CONFIG_FILE = "config/config.json"
 
 product_list = [
     {
@@ -58,24 +146,44 @@ product_list = [
         "price": 0.00,
         "stripe_price_id": "",
         "file_list": [],
+        "delivery_mode": "copy",
         "image": "/mush1.webp"
     }
 ]
 
-def init_product_list(config):
+def build_product_list(settings):
     """
-    Initialize the product list with configuration values.
+    Build the built-in product list with configuration values. The
+    built-in list is only served while there is no catalog file.
 
     Args:
-        config (dict): Configuration dictionary containing product pricing and IDs
-    """
-    deployment_type = config['deployment_type']
+        settings (Settings): Settings containing product pricing and IDs
 
+    Returns:
+        list: New product dicts, the current ones are left untouched
+    """
+    products = []
     for p in product_list:
+        p = dict(p)
         if p['id'] == 'fundamentals':
-            p['price'] = config['fundamentals_price']
-            p['stripe_price_id'] = config['fundamentals_stripe_price_id_prod'] if deployment_type == 'prod' else config['fundamentals_stripe_price_id_dev']
-            p['file_list'] = config['fundamentals_s3_files']
+            p['price'] = settings.fundamentals_price
+            p['stripe_price_id'] = settings.fundamentals_stripe_price_id
+            p['file_list'] = settings.fundamentals_s3_files
+            p['delivery_mode'] = settings.fundamentals_delivery_mode
+        products.append(p)
+    return products
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header against an ETag, using weak comparison as
+    RFC 9110 requires for If-None-Match.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 def find_product(product_id):
     """
@@ -87,71 +195,315 @@ def find_product(product_id):
     Returns:
         dict: The product dictionary if found, None otherwise
     """
-    for product in product_list:
-        if product['id'] == product_id:
-            return product
-    return None
+    return current_catalog().by_id.get(product_id)
 
-with open("config/config.json", 'r') as f:
-    config = json.load(f)
+def build_s3_client(settings):
+    """
+    Build the S3 client shared by all requests. boto3 clients are thread
+    safe and keep a connection pool, so one is built per set of credentials.
 
-    deployment_type = config['deployment_type']
+    Args:
+        settings (Settings): Settings with the AWS credentials
 
-    # BTCPay configs
-    btcpay_url = config['btcpay_url']
-    btcpay_store_id = config['btcpay_store_id']
-    btcpay_api_key = config['btcpay_api_key']
-    btcpay_webhook_secret = config['btcpay_webhook_secret']
-    btcpay_invoice_expiration_minutes = config['btcpay_invoice_expiration_minutes']
+    Returns:
+        S3.Client: The S3 client
+    """
+    return boto3.client(
+        's3',
+        region_name=settings.aws_region,
+        endpoint_url=settings.s3_endpoint_url,
+        aws_access_key_id=settings.aws_access_key_id,
+        aws_secret_access_key=settings.aws_secret_access_key
+    )
+
+def tighten_checkout_throttle(api_type, count):
+    """
+    Tighten the /checkout throttle when an API that checkouts pay for
+    reaches a usage milestone, a sign that checkouts may be being abused.
 
-    # Rate limit configs
-    checkout_rate_limit = config['checkout_rate_limit']
+    Args:
+        api_type (str): The API that reached the milestone
+        count (int): Its call count today
+    """
+    step = checkout_throttle.tighten()
+    log.warning(f"checkout: {api_type} reached {count} calls today, tightened the per-IP throttle to step {step}")
+
+def build_mailer(settings):
+    """
+    Build the MailerSend client shared by all fulfillment emails.
+
+    Args:
+        settings (Settings): Settings with the MailerSend API key and base
+
+    Returns:
+        emails.NewEmail: The MailerSend client
+    """
+    client = emails.NewEmail(settings.mailersend_api_key)
+    if settings.mailersend_api_base:
+        client.api_base = settings.mailersend_api_base
+    return client
+
+def fulfillment_email_template(product):
+    """
+    Get the precompiled fulfillment email of a product, building it the
+    first time the product (or the MailerSend template) is seen.
+
+    Args:
+        product (dict): The product
 
-    # Colorado GIS configs
-    colorado_gis_url = config['colorado_gis_url']
-    colorado_gis_key = config['colorado_gis_key']
+    Returns:
+        FulfillmentEmailTemplate: The product's email
+    """
+    template = fulfillment_email_templates.get(product['id'])
 
-    # Google maps configs
-    google_maps_api_key = config['google_maps_api_key']
-    google_maps_addr_validation_url = config['google_maps_addr_validation_url']
+    # A reloaded catalog hands out new product objects
+    if template is None or template.product is not product or template.template_id != settings.mailersend_template_id:
+        template = FulfillmentEmailTemplate(product, settings.mailersend_template_id, MAIL_FROM, SUPPORT_EMAIL)
+        fulfillment_email_templates[product['id']] = template
 
-    # Stripe configs
-    stripe.api_key = config['stripe_secret_key_prod'] if deployment_type == 'prod' else config['stripe_secret_key_dev']
-    stripe_webhook_secret = config['stripe_webhook_secret_prod'] if deployment_type == 'prod' else config['stripe_webhook_secret_dev']
+        for product_file in template.unsupported_files:
+            log.warning(f"unsupported file type: {product_file} of product_id={product['id']} is left out of fulfillment emails")
 
-    # MailerSend configs
-    mailersend_template_id = config['mailersend_template_id']
-    mailersend_api_key = config['mailersend_api_key']
+    return template
 
-    # AWS configs
-    aws_access_key_id = config['aws_access_key_id']
-    aws_secret_access_key = config['aws_secret_access_key']
-    aws_region = config['aws_region']
-    s3_bucket_name = config['s3_bucket_name']
-    s3_url_expiration_seconds = config.get('s3_url_expiration_seconds', 172800)  # Default: 2 days in seconds
-    s3_url_expiration_days = s3_url_expiration_seconds // 86400
+def build_email_checker(settings):
+    return EmailDeliverabilityChecker(
+        positive_ttl=settings.email_deliverability_positive_ttl_seconds,
+        negative_ttl=settings.email_deliverability_negative_ttl_seconds,
+        max_concurrency=settings.email_deliverability_max_concurrency,
+        allowlist=settings.email_domain_allowlist
+    )
 
-    init_product_list(config)
+def apply_settings(old, new):
+    """
+    Swap in new settings and rebuild whatever was built from the old ones.
 
-    frontend_url = config['frontend_url'] if deployment_type == "prod" else FRONTEND_DEV_HTTP_URL
-    get_invoice_db = get_prod_invoice_db if deployment_type == "prod" else get_dev_invoice_db
-    get_rate_limit_db = get_prod_rate_limit_db if deployment_type == "prod" else get_dev_rate_limit_db
-    get_api_usage_db = get_prod_api_usage_db if deployment_type == "prod" else get_dev_api_usage_db
+    Requests already running keep the clients they picked up, and every
+    request that starts after the swap sees only the new settings. Every
+    object built from the settings is built before anything is swapped
+    in, so settings that fail to apply leave the current ones untouched.
 
+    Args:
+        old (Settings): The settings currently in use, or None at startup
+        new (Settings): The settings to apply
+    """
+    global settings, s3_client, mailer, email_checker, guides_cache_control, product_list
+
+    changed = old.changed(new) if old is not None else None
+
+    def any_changed(*names):
+        return changed is None or not changed.isdisjoint(names)
+
+    new_s3_client = s3_client
+    if any_changed('aws_region', 's3_endpoint_url', 'aws_access_key_id', 'aws_secret_access_key'):
+        new_s3_client = build_s3_client(new)
+
+    new_mailer = mailer
+    if any_changed('mailersend_api_key', 'mailersend_api_base'):
+        new_mailer = build_mailer(new)
+
+    new_email_checker = email_checker
+    if any_changed('email_deliverability_positive_ttl_seconds', 'email_deliverability_negative_ttl_seconds',
+                   'email_deliverability_max_concurrency', 'email_domain_allowlist'):
+        new_email_checker = build_email_checker(new)
+
+    new_product_list = product_list
+    default_catalog = None
+    if any_changed('fundamentals_price', 'fundamentals_stripe_price_id', 'fundamentals_s3_files', 'fundamentals_delivery_mode'):
+        new_product_list = build_product_list(new)
+        if old is not None:
+            default_catalog = build_default_catalog(new_product_list)
+
+    # Nothing below raises, the new settings are swapped in as a whole
+    stripe.api_key = new.stripe_secret_key
+    stripe.api_base = new.stripe_api_base or stripe.DEFAULT_API_BASE
+
+    s3_client = new_s3_client
+    mailer = new_mailer
+    email_checker = new_email_checker
+    product_list = new_product_list
+    if default_catalog is not None:
+        set_default_catalog(default_catalog)
+
+    if old is not None:
+        webhook_dedupe.retention = new.webhook_dedupe_retention_days * 86400
+        webhook_dedupe.max_entries = new.webhook_dedupe_cache_size
+        checkout_throttle.rate = new.checkout_ip_rate_per_minute / 60
+        checkout_throttle.burst = new.checkout_ip_burst
+
+    configure_logging(sample_rates=new.log_sample_rates)
+
+    configure_tracing(export_file=new.trace_export_file,
+                      collector_url=new.trace_collector_url,
+                      slow_request_ms=new.trace_slow_request_ms)
+
+    guides_cache_control = f"public, max-age={new.guides_cache_max_age_seconds}"
+
+    settings = new
+
+settings = None
+s3_client = None
+mailer = None
+email_checker = None
+guides_cache_control = None
+apply_settings(None, load_settings(CONFIG_FILE))
+deployment_type = settings.deployment_type
+
+# Processed webhook events are remembered long enough to outlast the
+# Stripe and BTCPay retry schedules (a few days at most)
+webhook_dedupe = WebhookDedupeStore(
+    retention=settings.webhook_dedupe_retention_days * 86400,
+    max_entries=settings.webhook_dedupe_cache_size
+)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s:%(funcName)s %(levelname)s: %(message)s',
-    datefmt='%Y-%m-%dT%H:%M:%S'
+# Per-IP and per-subnet token buckets in front of /checkout
+checkout_throttle = IpThrottle(
+    rate=settings.checkout_ip_rate_per_minute / 60,
+    burst=settings.checkout_ip_burst,
+    max_entries=CHECKOUT_THROTTLE_MAX_ENTRIES
 )
 
+# Presigned URLs behind the download links
+presigned_urls = PresignedUrlCache(lifetime=DOWNLOAD_PRESIGN_SECONDS)
+
+configure_catalog(settings.products_file, deployment_type, product_list)
+
+get_invoice_db = get_prod_invoice_db if deployment_type == "prod" else get_dev_invoice_db
+get_rate_limit_db = get_prod_rate_limit_db if deployment_type == "prod" else get_dev_rate_limit_db
+get_api_usage_db = get_prod_api_usage_db if deployment_type == "prod" else get_dev_api_usage_db
+get_webhook_inbox_db = get_prod_webhook_inbox_db if deployment_type == "prod" else get_dev_webhook_inbox_db
+
+# Session factories for background tasks (API usage is shared, see get_dev_api_usage_db)
+invoice_session_local = ProdInvoiceSessionLocal if deployment_type == "prod" else DevInvoiceSessionLocal
+api_usage_session_local = ProdApiUsageSessionLocal
+webhook_inbox_session_local = ProdWebhookInboxSessionLocal if deployment_type == "prod" else DevWebhookInboxSessionLocal
+rate_limit_session_local = ProdRateLimitSessionLocal if deployment_type == "prod" else DevRateLimitSessionLocal
+
+# Databases compacted by the garbage collector, and where it keeps its archive and schedule
+database_engines = {
+    "invoices": prod_invoice_engine if deployment_type == "prod" else dev_invoice_engine,
+    "rate_limits": prod_rate_limit_engine if deployment_type == "prod" else dev_rate_limit_engine,
+    "api_usage": prod_api_usage_engine,
+    "webhook_inbox": prod_webhook_inbox_engine if deployment_type == "prod" else dev_webhook_inbox_engine,
+}
+archive_dir = f"data/{deployment_type}/archive"
+gc_state_file = f"data/{deployment_type}/gc-state.json"
+
 log = logging.getLogger("mycomize-backend")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Run background tasks for the lifetime of the app.
+    """
+    install_drain_handlers()
+
+    tasks = [
+        asyncio.create_task(consume_webhook_inbox()),
+        asyncio.create_task(prune_webhook_dedupe()),
+        asyncio.create_task(run_reconciler()),
+        asyncio.create_task(run_garbage_collector()),
+        asyncio.create_task(maintain_s3_lifecycle()),
+        asyncio.create_task(watch_catalog(settings.catalog_reload_interval_seconds)),
+        asyncio.create_task(watch_settings(CONFIG_FILE, settings, apply_settings)),
+    ]
+
+    yield
+
+    # The SSE streams are closed by now (see install_drain_handlers), stop
+    # the background tasks and flush what they would have handled later
+    sse_draining.set()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    await flush_webhook_inbox(SHUTDOWN_FLUSH_SECONDS)
+    await flush_traces(SHUTDOWN_FLUSH_SECONDS)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware, routes=[
+    "/checkout",
+    "/stripe-webhook",
+    "/btcpay-webhook",
+    "/stripe-webhook-events",
+    "/btcpay-webhook-events",
+    "/invoice-stats",
+    "/order-events",
+    "/order-events/stream",
+])
 
 #
 # Helpers
 #
+def install_drain_handlers():
+    """
+    Start draining the SSE streams as soon as a shutdown signal arrives.
+
+    The server waits for open responses to finish before it runs the
+    lifespan shutdown, and the SSE streams never finish on their own, so
+    they are told to wind down from the signal handler. The server's own
+    handler is still called to carry on with its shutdown.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    loop = asyncio.get_running_loop()
+
+    def start_draining():
+        if not sse_draining.is_set():
+            log.info("shutdown: draining SSE streams")
+            sse_draining.set()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(start_draining)
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+async def wait_for_drain(timeout):
+    """Sleep for timeout seconds, or until the SSE streams start draining."""
+    try:
+        await asyncio.wait_for(sse_draining.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+
+def sse_retry(base_ms, jitter_ms):
+    """SSE field that sets the client's reconnect delay, with random jitter."""
+    return f"retry: {base_ms + random.randint(0, jitter_ms)}\n\n"
+
+def order_state_message(order_state, last_state):
+    """
+    Format an order state as a server-sent event. The state is also the
+    event id, so a reconnecting client tells us through Last-Event-ID which
+    state it already has.
+
+    Args:
+        order_state (str): The order state to send
+        last_state (str): The order state the client last received
+
+    Returns:
+        str: The event, or a keepalive comment if the client has the state
+    """
+    if order_state == last_state:
+        return ": keepalive\n\n"
+
+    return f"id: {order_state}\ndata: {json.dumps({'order_state': order_state})}\n\n"
+
+def latest_queued_state(queue):
+    """Empty a webhook notification queue and return the last order state in it, or None."""
+    order_state = None
+
+    while queue is not None and not queue.empty():
+        order_state = queue.get_nowait()["order_state"]
+
+    return order_state
+
 def invoice_settled(invoice):
     """
     Check if an invoice is in the 'Settled' state.
@@ -264,7 +616,11 @@ async def fulfill_order(email, order_id, product_id, type, api_usage_db):
 
 def create_presigned_url_list(email, order_id, product):
     """
-    Generate a presigned URL for a customer to access their purchased guide.
+    Generate the URLs a customer downloads their purchased guide from.
+
+    Products in 'copy' delivery mode get a copy of every file under a
+    per-order key first. When download links are configured the URLs are
+    signed links to /download, otherwise they are presigned S3 URLs.
 
     Args:
         email (str): Customer's email address
@@ -272,66 +628,47 @@ def create_presigned_url_list(email, order_id, product):
         product (obj): Guide being purchased
 
     Returns:
-        str: Presigned URL or None if there was an error
+        list: URLs or None if there was an error
     """
-    global s3_lifecycle_configured
+    delivery_mode = product.get('delivery_mode', DEFAULT_DELIVERY_MODE)
 
     try:
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            region_name=aws_region,
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key
-        )
+        with DELIVERY_URL_LATENCY.time(delivery_mode):
+            # Hold on to the current client and settings in case they are reloaded meanwhile
+            client = s3_client
+            current = settings
+            url_list = []
 
-        # Create a unique object key for this customer
-        email_hash = hashlib.md5(email.encode()).hexdigest()
-        url_list = []
+            if delivery_mode == 'copy':
+                copy_customer_files(client, current.s3_bucket_name, email, order_id, product)
 
-        for product_file in product['file_list']:
-            customer_file = f"{deployment_type}/{product['id']}/customers/{email_hash}/{order_id}/{product_file}"
+            if current.download_links_enabled:
+                # Copies are expired by the bucket lifecycle, links to them can't outlive them
+                lifetime = current.download_link_expiration_days * 86400 if delivery_mode == 'direct' else current.s3_url_expiration_seconds
+                expires = int(time.time() + lifetime)
 
-            # Copy the guide to the customer-specific location
-            s3_client.copy_object(
-                Bucket=s3_bucket_name,
-                CopySource={'Bucket': s3_bucket_name, 'Key': product_file},
-                Key=customer_file
-            )
+                for product_file in product['file_list']:
+                    url_list.append(download_link(current.backend_url, current.download_link_secret, order_id,
+                                                  os.path.basename(product_file), delivery_mode, expires))
 
-            # Generate a presigned URL for the customer-specific object
-            presigned_url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': s3_bucket_name,
-                    'Key': customer_file
-                },
-                ExpiresIn=s3_url_expiration_seconds
-            )
+                log.info("created download links", extra={"event": "download_links_created", "order_id": order_id,
+                                                           "email": email, "links": len(url_list), "expires_in": int(lifetime)})
+                return url_list
 
-            log.info(f"created presigned URL that expires in {s3_url_expiration_seconds} seconds for email={email}, order_id={order_id} (customer_file={customer_file})")
-            url_list.append(presigned_url)
+            for product_file in product['file_list']:
+                key, content_disposition = order_file_object(email, order_id, product['id'], product_file, delivery_mode)
 
-        if not s3_lifecycle_configured:
-            prefix=f"{deployment_type}/{product['id']}/customers/"
+                params = {'Bucket': current.s3_bucket_name, 'Key': key}
+                if content_disposition is not None:
+                    params['ResponseContentDisposition'] = content_disposition
 
-            s3_client.put_bucket_lifecycle_configuration(
-                Bucket=s3_bucket_name,
-                LifecycleConfiguration={
-                    'Rules': [
-                        {
-                            'Expiration': {'Days': s3_url_expiration_days + 1},
-                            'ID': 'expire-3-days',
-                            'Filter': {'Prefix': prefix},
-                            'Status': 'Enabled',
-                        },
-                    ],
-                },
-            )
+                presigned_url = client.generate_presigned_url('get_object', Params=params, ExpiresIn=current.s3_url_expiration_seconds)
 
-            s3_lifecycle_configured = True
+                log.info("created presigned URL", extra={"event": "presigned_url_created", "order_id": order_id, "email": email,
+                                                          "key": key, "expires_in": current.s3_url_expiration_seconds})
+                url_list.append(presigned_url)
 
-        return url_list
+            return url_list
 
     except ClientError as e:
         log.error(f"error creating presigned URL: {e}")
@@ -340,6 +677,45 @@ def create_presigned_url_list(email, order_id, product):
         log.error(f"unexpected error creating presigned URL: {e}")
         return None
 
+def order_file_object(email, order_id, product_id, product_file, delivery_mode):
+    """
+    Get the S3 object a customer downloads a file of their order from.
+
+    Args:
+        email (str): Customer's email address
+        order_id (str): Unique order identifier
+        product_id (str): ID of the product
+        product_file (str): Key of the product's canonical file
+        delivery_mode (str): 'copy' or 'direct'
+
+    Returns:
+        tuple: (key, Content-Disposition to respond with or None)
+    """
+    if delivery_mode == 'copy':
+        email_hash = hashlib.md5(email.encode()).hexdigest()
+        return f"{deployment_type}/{product_id}/customers/{email_hash}/{order_id}/{product_file}", None
+
+    # The order id in the filename ties a downloaded file to its order
+    name, extension = os.path.splitext(os.path.basename(product_file))
+    return product_file, f'attachment; filename="{name}-{order_id}{extension}"'
+
+def copy_customer_files(client, s3_bucket_name, email, order_id, product):
+    """
+    Copy a product's files to the customer-specific location of an order.
+
+    Raises:
+        ClientError: If a copy fails
+    """
+    for product_file in product['file_list']:
+        customer_file, _ = order_file_object(email, order_id, product['id'], product_file, 'copy')
+
+        with time_upstream('s3'):
+            client.copy_object(
+                Bucket=s3_bucket_name,
+                CopySource={'Bucket': s3_bucket_name, 'Key': product_file},
+                Key=customer_file
+            )
+
 async def send_email(email, order_id, presigned_url_list, product, type, api_usage_db):
     """
     Send an email to the customer with their presigned URLs.
@@ -357,50 +733,15 @@ async def send_email(email, order_id, presigned_url_list, product, type, api_usa
     """
     # send email containing link to access the guide
     # return success/fail
-    log.info(f"fulfilling order for email={email}, order_id={order_id}, product_id={product['id']}, type={type}")
-
-    pdf_link = ""
-    epub_link = ""
+    log.info("fulfilling order", extra={"event": "order_fulfilling", "order_id": order_id, "payment_type": type,
+                                        "product_id": product['id'], "email": email})
 
-    for url in presigned_url_list:
-        if ".pdf?" in url:
-            pdf_link = url
-        elif ".epub?" in url:
-            epub_link = url
-        else:
-            log.warning(f"unsupported file type: {url}")
-
-    mailer = emails.NewEmail(mailersend_api_key)
-    mail_body = {}
-
-    mail_from = {
-        "name": "Connor",
-        "email": "connor@mycomize.com",
-    }
+    # Hold on to the current mailer in case it is rebuilt meanwhile
+    current_mailer = mailer
+    mail_body = fulfillment_email_template(product).render(email, order_id, presigned_url_list)
 
-    recipients  = [{
-        "email": email
-    }]
-
-    personalization = [
-        {
-            "email": email,
-            "data": {
-                "product_name": product['title'],
-                "order_id": order_id,
-                "pdf_link": pdf_link,
-                "epub_link": epub_link,
-                "support_email": "connor@mycomize.com"
-            }
-        }
-    ]
-
-    mailer.set_mail_from(mail_from, mail_body)
-    mailer.set_mail_to(recipients, mail_body)
-    mailer.set_template(mailersend_template_id, mail_body)
-    mailer.set_personalization(personalization, mail_body)
-
-    response = mailer.send(mail_body).replace('\n', ' ')
+    with time_upstream('mailersend'):
+        response = current_mailer.send(mail_body).replace('\n', ' ')
 
     # Track email API call
     count, is_milestone = await increment_api_usage(api_usage_db, 'mailersend_api')
@@ -408,14 +749,15 @@ async def send_email(email, order_id, presigned_url_list, product, type, api_usa
         log.warning(f"Mailersend API call count reached {count} count milestone")
 
     if "200" in response or "202" in response:
-        log.info(f"sent fulfillment email to {email}, type={type}")
+        log.info("sent fulfillment email", extra={"event": "fulfillment_email_sent", "order_id": order_id, "payment_type": type, "email": email})
         return True
     else:
-        log.error(f"failed to send fulfillment email to {email}, pdf_link={pdf_link}, epub_link={epub_link}, type={type}, (response={response})")
+        log.error("failed to send fulfillment email", extra={"event": "fulfillment_email_failed", "order_id": order_id,
+                                                             "payment_type": type, "email": email, "response": response})
         return False
 
 async def validate_location(city, state, postal_code, country, api_usage_db):
-    url = google_maps_addr_validation_url + f"?key={google_maps_api_key}"
+    url = settings.google_maps_addr_validation_url + f"?key={settings.google_maps_api_key}"
 
     headers = {
         "Content-Type": "application/json",
@@ -428,13 +770,15 @@ async def validate_location(city, state, postal_code, country, api_usage_db):
         }
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=data)
+    with time_upstream('google_maps'):
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, headers=headers, json=data)
 
     # Track API call to address validation service
     count, is_milestone = await increment_api_usage(api_usage_db, 'google_maps_addr_validation_api')
     if is_milestone:
         log.warning(f"Address validation API call count reached {count} count milestone")
+        tighten_checkout_throttle('google_maps_addr_validation_api', count)
 
     if response.status_code == 200:
         data = response.json()
@@ -456,7 +800,8 @@ async def validate_location(city, state, postal_code, country, api_usage_db):
             postal_code = data['result']['address']['postalAddress']['postalCode']
             country = data['result']['address']['postalAddress']['regionCode']
 
-            log.info(f"validated address: city={city}, state={state}, postal_code={postal_code}, country={country}")
+            log.info("validated address", extra={"event": "address_validated", "city": city, "state": state,
+                                                 "postal_code": postal_code, "country": country})
         else:
             log.warning(f"failed to validateAddress: city={city}, state={state}, postal_code={postal_code}, country={country} (status_code={response.status_code})")
 
@@ -484,25 +829,27 @@ async def compute_sales_tax(location):
     state = location.state
     zipcode = location.postal_code
 
-    url = colorado_gis_url
+    url = settings.colorado_gis_url
 
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
-        "Authorization": f"Bearer {colorado_gis_key}"
+        "Authorization": f"Bearer {settings.colorado_gis_key}"
     }
 
     data = {
         "address": f"{city}, {state} {zipcode}"
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=data)
+    with time_upstream('colorado_gis'):
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, headers=headers, json=data)
 
     if response.status_code == 200:
         data = response.json()
         sales_tax = data['totalSalesTax']
-        log.info(f"computed colorado sales tax: city={city}, state={state}, zipcode={zipcode}, sales_tax={sales_tax}")
+        log.info("computed colorado sales tax", extra={"event": "sales_tax_computed", "city": city, "state": state,
+                                                       "zipcode": zipcode, "sales_tax": sales_tax})
         return sales_tax
     else:
         log.error(f"failed to compute colorado sales tax: city={city}, state={state}, zipcode={zipcode}, (status_code={response.status_code})")
@@ -511,7 +858,7 @@ async def compute_sales_tax(location):
 async def rate_limit_exceeded(email, product_id, limit, rate_limit_db):
     count = 0
 
-    async with rate_limit_lock:
+    async with timed_lock(rate_limit_lock, "rate_limit_lock"):
         rate_limit = rate_limit_db.query(RateLimit).filter(and_(RateLimit.email == email, RateLimit.product_id == product_id)).first()
 
         if rate_limit is None:
@@ -526,7 +873,7 @@ async def rate_limit_exceeded(email, product_id, limit, rate_limit_db):
 
             count = rate_limit.request_count
 
-    log.info(f"checkout rate limit: email={email}, product_id={product_id}, count={count}")
+    log.info("checkout rate limit", extra={"event": "checkout_rate_limit", "email": email, "product_id": product_id, "count": count})
 
     return count >= limit
 
@@ -544,10 +891,10 @@ async def create_btcpay_invoice(customer_email, order_id, product, sales_tax, lo
     Returns:
         dict: The created invoice data if successful, or an error dictionary
     """
-    url = f"{btcpay_url}/api/v1/stores/{btcpay_store_id}/invoices"
+    url = f"{settings.btcpay_url}/api/v1/stores/{settings.btcpay_store_id}/invoices"
 
     headers = {
-        "Authorization": f"token {btcpay_api_key}",
+        "Authorization": f"token {settings.btcpay_api_key}",
         "Content-Type": "application/json"
     }
 
@@ -571,16 +918,17 @@ async def create_btcpay_invoice(customer_email, order_id, product, sales_tax, lo
         "checkout": {
             "speedPolicy": "MediumSpeed", # 1 confirmation
             "paymentMethods": ["BTC", "BTC-LightningNetwork"],
-            "expirationMinutes": btcpay_invoice_expiration_minutes,
-            "redirectURL": frontend_url + "/order-status?type=btc&order_id=" + order_id + "&invoice_id={InvoiceId}",
+            "expirationMinutes": settings.btcpay_invoice_expiration_minutes,
+            "redirectURL": settings.frontend_url + "/order-status?type=btc&order_id=" + order_id + "&invoice_id={InvoiceId}",
             "redirectAutomatically": True,
         },
         "amount": str(round(product['price'] + total_tax, 2)),
         "currency": "USD"
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=data)
+    with time_upstream('btcpay'):
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, headers=headers, json=data)
 
     if response.status_code == 200:
         return response.json()
@@ -627,47 +975,49 @@ async def checkout_btc(email, order_id, invoice_db, product, city, state, zipcod
         dict: Response containing checkout link or error information
     """
     try:
-        invoice = invoice_db.query(Invoice).filter(Invoice.email == email).first()
+        invoice = latest_customer_invoice(invoice_db, email, product['id'])
 
         if invoice:
-            async with invoice_lock:
-                if invoice.payment_type == 'btc':
-                    if invoice_settled(invoice) or invoice_fulfilled(invoice):
-                        return {"order_state": invoice.order_state}
-                    elif invoice_processing(invoice):
-                        return {"checkout_link": invoice.checkout_link}
-                    else: # Failed or Expired or Canceled
-                        log.warning(f"invoice (btcpay): invoice_id={invoice.btcpay_invoice_id} state={invoice.btcpay_invoice_state} email={email} (failed/expired) deleting from DB")
-                        invoice_db.delete(invoice)
-                        invoice_db.commit()
-                else:
-                    log.error(f"invoice (btcpay): email={email} already has a stripe invoice. Only one payment type supported")
-                    return {"error": "error_only_one_payment_type_supported"}
-
-        location = await validate_location(city, state, zipcode, country, api_usage_db)
+            async with timed_lock(invoice_lock, "invoice_lock"):
+                if invoice_settled(invoice) or invoice_fulfilled(invoice):
+                    return {"order_state": invoice.order_state}
+                elif invoice_processing(invoice) and invoice.payment_type == 'btc':
+                    return {"checkout_link": invoice.checkout_link}
+                else: # Failed, Expired, Canceled or switching from stripe
+                    log.info("replacing previous order", extra={"event": "invoice_superseded", "order_id": invoice.order_id,
+                                                                "payment_type": "btc", "previous_payment_type": invoice.payment_type,
+                                                                "state": invoice.order_state, "email": email})
+
+        with span("validate_location"):
+            location = await validate_location(city, state, zipcode, country, api_usage_db)
         if not location.valid:
             return {"error": "error_invalid_location"}
 
-        sales_tax = await compute_sales_tax(location)
+        with span("compute_sales_tax"):
+            sales_tax = await compute_sales_tax(location)
         if sales_tax < 0.00:
             return {"error": "error_compute_sales_tax_failed"}
 
-        invoice = await create_btcpay_invoice(email, order_id, product, sales_tax, location)
+        with span("create_btcpay_invoice"):
+            invoice = await create_btcpay_invoice(email, order_id, product, sales_tax, location)
         if "error" in invoice:
             return invoice
 
         invoice_id = invoice["id"]
         invoice_state = invoice["status"]
 
-        log.info(f"invoice (btcpay): order_id={order_id} invoice_id={invoice_id} state={invoice_state} email={email} (new)")
+        log.info("created invoice", extra={"event": "invoice_state_change", "order_id": order_id, "payment_type": "btc",
+                                           "invoice_id": invoice_id, "state": invoice_state, "previous_state": None, "email": email})
 
+        created_at = datetime.now()
         invoice_db_entry = Invoice(email=email,
                                    payment_type='btc',
                                    order_id=order_id,
                                    order_state="Processing Payment",
                                    checkout_link=invoice["checkoutLink"],
                                    product_id=product['id'],
-                                   created_at_time=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                                   created_at_time=created_at.strftime("%Y-%m-%dT%H:%M:%S"),
+                                   created_at=created_at,
                                    btcpay_invoice_id=invoice_id,
                                    btcpay_invoice_state=invoice_state,
                                    btcpay_city=location.city,
@@ -676,10 +1026,12 @@ async def checkout_btc(email, order_id, invoice_db, product, city, state, zipcod
                                    btcpay_country=location.country,
                                    btcpay_sales_tax=sales_tax)
 
-        invoice_db.add(invoice_db_entry)
-        invoice_db.commit()
+        with span("db_commit"):
+            invoice_db.add(invoice_db_entry)
+            append_order_event(invoice_db, ORDER_CREATED, invoice_db_entry)
+            invoice_db.commit()
 
-        async with btcpay_webhook_lock:
+        async with timed_lock(btcpay_webhook_lock, "btcpay_webhook_lock"):
             if invoice_id not in btcpay_webhook_queue_map:
                 btcpay_webhook_queue_map[invoice_id] = asyncio.Queue()
 
@@ -691,7 +1043,7 @@ async def checkout_btc(email, order_id, invoice_db, product, city, state, zipcod
         log.error(f"error_checkout_btc: {e}, email={email}")
         return {"error": f"error_checkout_btc"}
 
-async def checkout_stripe(email, order_id, invoice_db, product):
+async def checkout_stripe(email, order_id, invoice_db, product, api_usage_db):
     """
     Process a Stripe checkout request.
 
@@ -700,68 +1052,72 @@ async def checkout_stripe(email, order_id, invoice_db, product):
         order_id (str): Unique order identifier
         invoice_db (Session): Database session
         product (dict): Product information
+        api_usage_db (Session): API usage database session
 
     Returns:
         dict: Response containing checkout link or error information
     """
     try:
-        invoice = invoice_db.query(Invoice).filter(Invoice.email == email).first()
-        log.info(f"checkout_stripe: got invoice")
+        invoice = latest_customer_invoice(invoice_db, email, product['id'])
+        log.info("got latest invoice", extra={"event": "stripe_checkout", "step": "latest_invoice", "order_id": order_id})
 
         if invoice:
-            async with invoice_lock:
-                if invoice.payment_type == 'stripe':
-                    if invoice_fulfilled(invoice) or invoice_settled(invoice):
-                        return { "order_state": invoice.order_state }
-                    elif invoice_processing(invoice):
-                        return { "checkout_link": invoice.checkout_link }
-                    else: # Failed or Expired or Canceled
-                        log.warning(f"invoice (stripe): session_id={invoice.stripe_session_id} state={invoice.stripe_invoice_state} email={email} (failed/expired) deleting from DB")
-                        invoice_db.delete(invoice)
-                        invoice_db.commit()
-                else:
-                    # User is switching payment types
-                    if invoice_fulfilled(invoice) or invoice_settled(invoice):
-                        log.error(f"invoice (stripe): email={email} already has a btc invoice. Only one payment type supported")
-                        return {"error": "error_only_one_payment_type_supported"}
-                    else:
-                        log.warning(f"invoice (btcpay -> stripe): btcpay_invoice_id={invoice.btcpay_invoice_id} btcpay_state={invoice.btcpay_invoice_state} email={email} deleting from DB")
-                        invoice_db.delete(invoice)
-                        invoice_db.commit()
-
-        success_url = frontend_url + "/order-status?type=stripe&order_id=" + order_id + "&session_id={CHECKOUT_SESSION_ID}"
-        cancel_url = frontend_url + "/guides"
-
-        log.info(f"checkout_stripe: Creating session")
-
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[{"price": product['stripe_price_id'], "quantity": 1}], # assumes one product
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            customer_email=email,
-            metadata={"order_id": order_id},
-            automatic_tax={"enabled": True}
-        )
+            async with timed_lock(invoice_lock, "invoice_lock"):
+                if invoice_fulfilled(invoice) or invoice_settled(invoice):
+                    return { "order_state": invoice.order_state }
+                elif invoice_processing(invoice) and invoice.payment_type == 'stripe':
+                    return { "checkout_link": invoice.checkout_link }
+                else: # Failed, Expired, Canceled or switching from btc
+                    log.info("replacing previous order", extra={"event": "invoice_superseded", "order_id": invoice.order_id,
+                                                                "payment_type": "stripe", "previous_payment_type": invoice.payment_type,
+                                                                "state": invoice.order_state, "email": email})
+
+        success_url = settings.frontend_url + "/order-status?type=stripe&order_id=" + order_id + "&session_id={CHECKOUT_SESSION_ID}"
+        cancel_url = settings.frontend_url + "/guides"
+
+        log.info("creating session", extra={"event": "stripe_checkout", "step": "create_session", "order_id": order_id})
+
+        with span("create_stripe_session"), time_upstream('stripe'):
+            checkout_session = stripe.checkout.Session.create(
+                line_items=[{"price": product['stripe_price_id'], "quantity": 1}], # assumes one product
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                customer_email=email,
+                metadata={"order_id": order_id},
+                automatic_tax={"enabled": True}
+            )
+
+        # Track Stripe checkout session creation
+        count, is_milestone = await increment_api_usage(api_usage_db, 'stripe_checkout_session_api')
+        if is_milestone:
+            log.warning(f"Stripe checkout session count reached {count} count milestone")
+            tighten_checkout_throttle('stripe_checkout_session_api', count)
 
         session_id = checkout_session.id
         invoice_state = checkout_session.payment_status
 
-        log.info(f"invoice (stripe): order_id={order_id} session_id={session_id} state={invoice_state} email={email} (new)")
+        log.info("created invoice", extra={"event": "invoice_state_change", "order_id": order_id, "payment_type": "stripe",
+                                           "session_id": session_id, "state": invoice_state, "previous_state": None, "email": email})
 
+        created_at = datetime.now()
         invoice_db_entry = Invoice(email=email,
                            payment_type='stripe',
                            order_id=order_id,
                            order_state="Processing Payment",
                            checkout_link=checkout_session.url,
                            product_id=product['id'],
-                           created_at_time=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                           created_at_time=created_at.strftime("%Y-%m-%dT%H:%M:%S"),
+                           created_at=created_at,
                            stripe_session_id=session_id,
                            stripe_invoice_state=invoice_state)
-        invoice_db.add(invoice_db_entry)
-        invoice_db.commit()
 
-        async with stripe_webhook_lock:
+        with span("db_commit"):
+            invoice_db.add(invoice_db_entry)
+            append_order_event(invoice_db, ORDER_CREATED, invoice_db_entry)
+            invoice_db.commit()
+
+        async with timed_lock(stripe_webhook_lock, "stripe_webhook_lock"):
             if session_id not in stripe_webhook_queue_map:
                 stripe_webhook_queue_map[session_id] = asyncio.Queue()
 
@@ -773,6 +1129,424 @@ async def checkout_stripe(email, order_id, invoice_db, product):
         log.error(f"error_checkout_stripe: {e}, email={email}")
         return {"error": f"error_checkout_stripe"}
 
+#
+# Webhook inbox
+#
+def store_webhook_event(webhook_inbox_db, source, dedupe_key, event_type, invoice_key, payload):
+    """
+    Append a verified webhook delivery to the inbox and wake the consumer.
+
+    Retries of an already applied event are rejected by the dedupe store,
+    retries of a still pending one by the inbox's unique dedupe_key. A
+    retry of an event that was given up on makes it pending again, so an
+    outage longer than the inbox's retries doesn't lose the update.
+
+    Args:
+        webhook_inbox_db (Session): Webhook inbox database session
+        source (str): 'stripe' or 'btcpay'
+        dedupe_key (str): Key identifying retries of the same delivery
+        event_type (str): The webhook event type
+        invoice_key (str): Stripe session id or BTCPay invoice id, events
+            with the same key are applied in the order they were received
+        payload (bytes): The raw, verified request body
+
+    Returns:
+        bool: True if the event was stored, False if it is a duplicate
+    """
+    if webhook_dedupe.seen(webhook_inbox_db, dedupe_key):
+        return False
+
+    received_at = time.time()
+
+    try:
+        webhook_inbox_db.add(WebhookEvent(dedupe_key=dedupe_key,
+                                          source=source,
+                                          event_type=event_type,
+                                          invoice_key=invoice_key,
+                                          payload=payload.decode('utf-8'),
+                                          received_at=received_at,
+                                          next_attempt_at=received_at))
+        webhook_inbox_db.commit()
+    except IntegrityError:
+        webhook_inbox_db.rollback()
+
+        # Given up events are processed with their last error kept, applied ones have no error
+        given_up = webhook_inbox_db.query(WebhookEvent) \
+            .filter(WebhookEvent.dedupe_key == dedupe_key,
+                    WebhookEvent.processed_at.isnot(None),
+                    WebhookEvent.error.isnot(None)) \
+            .first()
+        if given_up is None:
+            return False
+
+        given_up.payload = payload.decode('utf-8')
+        given_up.received_at = received_at
+        given_up.processed_at = None
+        given_up.attempts = 0
+        given_up.next_attempt_at = received_at
+        webhook_inbox_db.commit()
+        log.warning(f"webhook inbox: {source} event {dedupe_key} was given up on and delivered again, retrying it")
+
+    webhook_inbox_wakeup.set()
+    return True
+
+def webhook_retry_delay(attempts):
+    """
+    Get how long to wait before retrying a failed inbox event.
+
+    Args:
+        attempts (int): Attempts made so far
+
+    Returns:
+        float: Seconds until the next attempt
+    """
+    return min(WEBHOOK_INBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), WEBHOOK_INBOX_RETRY_MAX_SECONDS)
+
+async def apply_webhook_events(events, webhook_inbox_db):
+    """
+    Apply the pending inbox events of one invoice in the order received.
+
+    A failed event is retried once its backoff has passed, and the events
+    after it wait for it so the invoice never sees them out of order. After
+    WEBHOOK_INBOX_MAX_ATTEMPTS failures the event is given up on. Applied
+    events are recorded in the dedupe store so retried deliveries of them
+    are rejected on arrival.
+
+    Args:
+        events (list): Pending WebhookEvent rows for a single invoice_key
+        webhook_inbox_db (Session): Webhook inbox database session the events belong to
+
+    Returns:
+        list: The applied events
+    """
+    invoice_db = invoice_session_local()
+    api_usage_db = api_usage_session_local()
+    applied = []
+
+    try:
+        for event in events:
+            event.attempts += 1
+
+            try:
+                if event.source == 'stripe':
+                    stripe_event = stripe.Event.construct_from(json.loads(event.payload), stripe.api_key)
+                    await apply_stripe_event(stripe_event, invoice_db, api_usage_db)
+                else:
+                    await apply_btcpay_event(json.loads(event.payload), invoice_db, api_usage_db)
+            except Exception as e:
+                invoice_db.rollback()
+                event.error = str(e)
+                log.error(f"webhook inbox: failed to apply {event.source} event {event.dedupe_key} (attempt {event.attempts}): {e}")
+
+                if event.attempts < WEBHOOK_INBOX_MAX_ATTEMPTS:
+                    event.next_attempt_at = time.time() + webhook_retry_delay(event.attempts)
+                    break
+
+                log.error(f"webhook inbox: giving up on {event.source} event {event.dedupe_key}")
+                event.processed_at = time.time()
+                continue
+
+            event.processed_at = time.time()
+            event.error = None
+            webhook_dedupe.mark_processed(webhook_inbox_db, event.dedupe_key, event.processed_at)
+            applied.append(event)
+            WEBHOOK_INBOX_LAG.labels(event.source).observe(event.processed_at - event.received_at)
+    finally:
+        api_usage_db.close()
+        invoice_db.close()
+
+    return applied
+
+async def process_webhook_inbox():
+    """
+    Apply one batch of pending inbox events that are due.
+
+    Events of different invoices are applied concurrently, events of the
+    same invoice one after another in the order they were received. An
+    invoice whose oldest pending event is waiting out its retry backoff is
+    skipped as a whole.
+
+    Returns:
+        int: Number of pending events fetched
+    """
+    webhook_inbox_db = webhook_inbox_session_local()
+    now = time.time()
+    waiting = aliased(WebhookEvent)
+
+    try:
+        events = webhook_inbox_db.query(WebhookEvent) \
+            .filter(WebhookEvent.processed_at == None,
+                    WebhookEvent.next_attempt_at <= now,
+                    ~webhook_inbox_db.query(waiting)
+                        .filter(waiting.invoice_key == WebhookEvent.invoice_key,
+                                waiting.processed_at == None,
+                                waiting.id < WebhookEvent.id,
+                                waiting.next_attempt_at > now)
+                        .exists()) \
+            .order_by(WebhookEvent.id) \
+            .limit(WEBHOOK_INBOX_BATCH_SIZE) \
+            .all()
+
+        events_by_invoice = {}
+        for event in events:
+            events_by_invoice.setdefault(event.invoice_key, []).append(event)
+
+        applied = await asyncio.gather(*(apply_webhook_events(group, webhook_inbox_db) for group in events_by_invoice.values()))
+        webhook_inbox_db.commit()
+
+        for event in (event for group in applied for event in group):
+            webhook_dedupe.remember(event.dedupe_key, event.processed_at)
+
+        return len(events)
+    finally:
+        webhook_inbox_db.close()
+
+async def consume_webhook_inbox():
+    """
+    Apply inbox events as they arrive, for as long as the app runs.
+
+    The consumer is woken by every stored event and also polls, so events
+    left pending by a restart or due for a retry are picked up. A wakeup
+    only applies events that are due, so it never spends a retry.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(webhook_inbox_wakeup.wait(), timeout=WEBHOOK_INBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+        webhook_inbox_wakeup.clear()
+
+        try:
+            while await process_webhook_inbox() == WEBHOOK_INBOX_BATCH_SIZE:
+                pass
+        except Exception as e:
+            log.error(f"webhook inbox: error processing events: {e}")
+
+async def flush_webhook_inbox(timeout):
+    """
+    Apply the pending inbox events at shutdown instead of leaving them for
+    the next start.
+
+    Args:
+        timeout (float): Seconds to spend at most, what is left is applied
+            at the next start
+    """
+    async def flush():
+        while await process_webhook_inbox() == WEBHOOK_INBOX_BATCH_SIZE:
+            pass
+
+    try:
+        await asyncio.wait_for(flush(), timeout=timeout)
+    except asyncio.TimeoutError:
+        log.warning("webhook inbox: shutdown flush timed out, the remaining events are applied at the next start")
+    except Exception as e:
+        log.error(f"webhook inbox: error flushing events at shutdown: {e}")
+
+async def prune_webhook_dedupe():
+    """
+    Periodically forget processed webhook events older than the retention window.
+    """
+    while True:
+        await asyncio.sleep(WEBHOOK_DEDUPE_PRUNE_SECONDS)
+
+        webhook_inbox_db = webhook_inbox_session_local()
+        try:
+            deleted = webhook_dedupe.prune(webhook_inbox_db)
+            if deleted:
+                log.info(f"webhook dedupe: pruned {deleted} rows older than the retention window")
+        except SQLAlchemyError as e:
+            log.error(f"webhook dedupe: error pruning processed events: {e}")
+        finally:
+            webhook_inbox_db.close()
+
+async def reconcile_orders():
+    """
+    Look up the pending orders at BTCPay and Stripe and store a synthetic
+    webhook event for every transition no webhook delivered.
+
+    Only orders older than reconcile_min_age_seconds are looked up, to give
+    the webhooks a chance, and none older than reconcile_lookback_hours.
+    Without pending orders no API call is made.
+
+    Returns:
+        int: Number of events stored in the webhook inbox
+    """
+    now = time.time()
+    current = settings
+    invoice_db = invoice_session_local()
+
+    try:
+        pending = invoice_db.query(Invoice.email, Invoice.created_at, Invoice.stripe_session_id, Invoice.btcpay_invoice_id) \
+            .filter(Invoice.order_state == "Processing Payment",
+                    Invoice.created_at >= datetime.fromtimestamp(now - current.reconcile_lookback_hours * 3600),
+                    Invoice.created_at <= datetime.fromtimestamp(now - current.reconcile_min_age_seconds)) \
+            .all()
+    finally:
+        invoice_db.close()
+
+    btcpay_pending = {row.btcpay_invoice_id: row.email for row in pending if row.btcpay_invoice_id}
+    stripe_pending = {row.stripe_session_id: row.email for row in pending if row.stripe_session_id}
+    events = []
+
+    if btcpay_pending:
+        since = min(row.created_at for row in pending if row.btcpay_invoice_id).timestamp() - RECONCILE_CLOCK_SLACK_SECONDS
+        try:
+            events.extend(await list_btcpay_changes(current, btcpay_pending, since))
+        except Exception as e:
+            log.error(f"reconcile: failed to list btcpay changes for {len(btcpay_pending)} pending orders: {e}")
+
+    if stripe_pending:
+        since = min(row.created_at for row in pending if row.stripe_session_id).timestamp() - RECONCILE_CLOCK_SLACK_SECONDS
+        try:
+            events.extend(await list_stripe_changes(stripe_pending, since))
+        except Exception as e:
+            log.error(f"reconcile: failed to list stripe changes for {len(stripe_pending)} pending orders: {e}")
+
+    stored = 0
+    webhook_inbox_db = webhook_inbox_session_local()
+
+    try:
+        for event in events:
+            if store_webhook_event(webhook_inbox_db, event.source, event.dedupe_key, event.event_type, event.invoice_key, event.payload):
+                stored += 1
+                RECONCILE_TRANSITIONS.labels(event.source, event.event_type).inc()
+                log.warning(f"reconcile: no webhook received for {event.source} {event.invoice_key}, applying {event.event_type}")
+    finally:
+        webhook_inbox_db.close()
+
+    return stored
+
+async def run_reconciler():
+    """
+    Reconcile the pending orders every reconcile_interval_seconds, for as long as the app runs.
+    """
+    while True:
+        await asyncio.sleep(settings.reconcile_interval_seconds)
+
+        try:
+            await reconcile_orders()
+        except Exception as e:
+            log.error(f"reconcile: error reconciling orders: {e}")
+
+async def collect_garbage(full_vacuum, reset_rate_limit_window):
+    """
+    Archive old terminal orders, then compact every database and report the space reclaimed.
+
+    Args:
+        full_vacuum (bool): Rebuild the databases with VACUUM and ANALYZE
+            instead of an incremental vacuum
+        reset_rate_limit_window (bool): Delete the checkout rate limit
+            counters, starting a new window
+    """
+    cutoff = datetime.fromtimestamp(time.time() - settings.invoice_retention_days * 86400)
+
+    invoice_db = invoice_session_local()
+    try:
+        archived = archive_terminal_invoices(invoice_db, archive_dir, cutoff, GC_BATCH_SIZE)
+        pruned = prune_order_events(invoice_db, cutoff, GC_BATCH_SIZE)
+    finally:
+        invoice_db.close()
+
+    if archived:
+        GC_ARCHIVED_INVOICES.labels().inc(archived)
+        log.info(f"gc: archived {archived} expired, failed and canceled orders created before {cutoff:%Y-%m-%d} to {archive_dir}")
+
+    if pruned:
+        log.info(f"gc: pruned {pruned} order events recorded before {cutoff:%Y-%m-%d}")
+
+    if reset_rate_limit_window:
+        rate_limit_db = rate_limit_session_local()
+        try:
+            async with timed_lock(rate_limit_lock, "rate_limit_lock"):
+                reset = reset_rate_limits(rate_limit_db, GC_BATCH_SIZE)
+        finally:
+            rate_limit_db.close()
+
+        log.info(f"gc: reset {reset} checkout rate limit counters")
+
+    for name, engine in database_engines.items():
+        # VACUUM can take a while on a big database, keep the event loop serving meanwhile
+        size, reclaimed = await asyncio.to_thread(compact_database, engine, full_vacuum)
+
+        DATABASE_SIZE.labels(name).set(size)
+        GC_RECLAIMED_BYTES.labels(name).inc(max(reclaimed, 0))
+        log.info(f"gc: {'vacuumed' if full_vacuum else 'incrementally vacuumed'} {name}, "
+                 f"size={size / 1e6:.2f}MB reclaimed={reclaimed / 1e6:.2f}MB")
+
+def read_gc_state():
+    try:
+        with open(gc_state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        now = time.time()
+        return {"last_full_vacuum": now, "last_rate_limit_reset": now}
+
+async def run_garbage_collector():
+    """
+    Collect garbage every gc_interval_seconds, for as long as the app runs.
+
+    When the full vacuum and the rate limit reset last ran is kept in a
+    file, so restarts don't keep pushing them back.
+    """
+    while True:
+        await asyncio.sleep(settings.gc_interval_seconds)
+
+        state = read_gc_state()
+        now = time.time()
+        full_vacuum = now - state["last_full_vacuum"] >= settings.vacuum_interval_hours * 3600
+        reset_rate_limit_window = now - state["last_rate_limit_reset"] >= settings.rate_limit_window_hours * 3600
+
+        try:
+            await collect_garbage(full_vacuum, reset_rate_limit_window)
+        except Exception as e:
+            log.error(f"gc: error collecting garbage: {e}")
+            continue
+
+        if full_vacuum:
+            state["last_full_vacuum"] = now
+        if reset_rate_limit_window:
+            state["last_rate_limit_reset"] = now
+
+        try:
+            with open(gc_state_file, 'w') as f:
+                json.dump(state, f)
+        except OSError as e:
+            log.error(f"gc: failed to write {gc_state_file}: {e}")
+
+async def maintain_s3_lifecycle():
+    """
+    Reconcile the bucket's lifecycle rules with the catalog at startup, and
+    again whenever the catalog or the S3 settings change.
+    """
+    applied = None
+
+    while True:
+        # Hold on to the current client, settings and catalog in case they are reloaded meanwhile
+        client, current, catalog = s3_client, settings, current_catalog()
+        wanted = (client, current.s3_bucket_name, current.s3_url_expiration_seconds, catalog)
+
+        if wanted != applied:
+            # Copies outlive their presigned URLs by at least a day
+            rules = expiration_rules(deployment_type, catalog.by_id, current.s3_url_expiration_seconds // 86400 + 1)
+
+            try:
+                changes = await asyncio.to_thread(reconcile_lifecycle, client, current.s3_bucket_name, deployment_type, rules)
+            except Exception as e:
+                log.error(f"s3: error reconciling the lifecycle of bucket {current.s3_bucket_name}: {e}")
+                await asyncio.sleep(S3_LIFECYCLE_RETRY_SECONDS)
+                continue
+
+            applied = wanted
+
+            if changes.added or changes.updated or changes.removed:
+                log.info(f"s3: updated the lifecycle of bucket {current.s3_bucket_name}, "
+                         f"added={changes.added} updated={changes.updated} removed={changes.removed}")
+            else:
+                log.info(f"s3: lifecycle of bucket {current.s3_bucket_name} is up to date ({len(rules)} rules)")
+
+        await asyncio.sleep(settings.catalog_reload_interval_seconds)
+
 #
 # API Endpoints
 #
@@ -788,38 +1562,72 @@ async def checkout(request: Request, invoice_db: Session = Depends(get_invoice_d
     Returns:
         dict: Response containing checkout link, order state, or error information
     """
-    body = await request.json()
-    payment_type = body.get('type', '')
-    product_id = body.get('id', '')
-    customer_email = body.get('email', '')
-    customer_city = body.get('city', '')
-    customer_state = body.get('state', '')
-    customer_zipcode = body.get('zipcode', '')
-    customer_country = body.get('country', '')
+    # Cheap rejections first, nothing below runs for a throttled or malformed request
+    client_ip = request.client.host if request.client else "unknown"
+    if not checkout_throttle.allow(client_ip):
+        CHECKOUT_REJECTIONS.labels("ip_throttled").inc()
+        log.warning(f"POST: /checkout: error_rate_limit_exceeded: ip={client_ip}")
+        return {"error": "error_checkout_rate_limit_exceeded"}
+
+    body, error, reason = parse_checkout_request(await request.body())
+    if body is None:
+        CHECKOUT_REJECTIONS.labels("invalid_request").inc()
+        log.error(f"POST: /checkout: {error}: {reason} ip={client_ip}")
+        return {"error": error}
+
+    trace = start_trace("checkout", payment_type=body.type)
 
-    log.info(f"POST: /checkout: payment_type={payment_type} customer_email={customer_email}")
+    try:
+        return await process_checkout(client_ip, body, invoice_db, rate_limit_db, api_usage_db)
+    finally:
+        finish_trace(trace)
+
+async def process_checkout(client_ip, body, invoice_db, rate_limit_db, api_usage_db):
+    """
+    Validate a checkout request and create the invoice for it.
+
+        client_ip (str): The client's address, 'unknown' if the server didn't report one
+        client_ip (str): The client's address, or 'unknown' 
+        body (CheckoutRequest): The validated request body
+        invoice_db (Session): Invoice database session
+        rate_limit_db (Session): Rate limit database session
+        api_usage_db (Session): API usage database session
+
+    Returns:
+        dict: Response containing checkout link, order state, or error information
+    """
+    payment_type = body.type
+    product_id = body.id
+    customer_email = body.email
+    customer_city = body.city
+    customer_state = body.state
+    customer_zipcode = body.zipcode
+    customer_country = body.country
 
-    if payment_type != 'btc' and  payment_type != 'stripe':
-        log.error(f"POST: /checkout: error_invalid_payment_type: {payment_type}")
-        return {"error": "error_invalid_payment_type"}
+    log.info("POST: /checkout", extra={"event": "checkout_request", "payment_type": payment_type, "email": customer_email})
 
     product = find_product(product_id)
     if product is None:
+        CHECKOUT_REJECTIONS.labels("invalid_product").inc()
         log.error(f"POST: /checkout: error_invalid_product_id: {product_id}")
         return {"error": "error_invalid_product_id"}
 
     try:
-        email_info = validate_email(customer_email, check_deliverability=True)
-        customer_email = email_info.normalized
+        with span("validate_email"):
+            customer_email = await email_checker.validate(customer_email)
     except EmailNotValidError as e:
         log.error(f"POST: /checkout: error_invalid_email: {e}")
         return {"error": "error_invalid_email"}
 
-    if await rate_limit_exceeded(customer_email, product_id, checkout_rate_limit, rate_limit_db):
-        log.error(f"POST: /checkout: error_rate_limit_exceeded: email={customer_email}, product_id={product_id} ip={request.client.host}")
+    with span("rate_limit_exceeded"):
+        limit_exceeded = await rate_limit_exceeded(customer_email, product_id, settings.checkout_rate_limit, rate_limit_db)
+
+    if limit_exceeded:
+        log.error(f"POST: /checkout: error_rate_limit_exceeded: email={customer_email}, product_id={product_id} ip={client_ip}")
         return {"error": "error_checkout_rate_limit_exceeded"}
 
     order_id = create_order_id()
+    set_trace_attribute("order_id", order_id)
 
     if payment_type == 'btc':
         return await checkout_btc(customer_email,
@@ -834,16 +1642,19 @@ async def checkout(request: Request, invoice_db: Session = Depends(get_invoice_d
 
     if payment_type == 'stripe':
         # Stripe handles location and sales tax for us
-        return await checkout_stripe(customer_email, order_id, invoice_db, product)
+        return await checkout_stripe(customer_email, order_id, invoice_db, product, api_usage_db)
 
 @app.post("/stripe-webhook")
-async def stripe_webhook(request: Request, invoice_db: Session = Depends(get_invoice_db), api_usage_db: Session = Depends(get_api_usage_db)):
+async def stripe_webhook(request: Request, webhook_inbox_db: Session = Depends(get_webhook_inbox_db)):
     """
     Handle Stripe webhook events.
 
+    The event is verified and appended to the webhook inbox, and the
+    response is sent right away. The inbox consumer applies it afterwards.
+
     Args:
         request (Request): The HTTP request containing the webhook data
-        invoice_db (Session): Database session
+        webhook_inbox_db (Session): Webhook inbox database session
 
     Returns:
         dict: Response indicating success or error
@@ -856,7 +1667,7 @@ async def stripe_webhook(request: Request, invoice_db: Session = Depends(get_inv
 
     try:
         # Verify the webhook signature
-        event = stripe.Webhook.construct_event(body, stripe_sig, stripe_webhook_secret)
+        event = stripe.Webhook.construct_event(body, stripe_sig, settings.stripe_webhook_secret)
     except ValueError as e:
         # Invalid payload
         log.error(f"POST: /stripe-webhook: error_invalid_payload: {e}")
@@ -866,102 +1677,99 @@ async def stripe_webhook(request: Request, invoice_db: Session = Depends(get_inv
         log.error(f"POST: /stripe-webhook: error_invalid_signature: {e}")
         raise HTTPException(status_code=400, detail=f"Invalid signature: {e}")
 
+    if event['type'] == 'radar.early_fraud_warning.created':
+        invoice_key = event['data']['object']['charge']
+    else:
+        invoice_key = event['data']['object']['id']
+
+    if not store_webhook_event(webhook_inbox_db, 'stripe', f"stripe:{event['id']}", event['type'], invoice_key, body):
+        log.info("duplicate webhook, doing nothing", extra={"event": "webhook_duplicate", "provider": "stripe",
+                                                            "event_id": event['id'], "event_type": event['type']})
+        return {"status": "success", "message": "Webhook already received"}
+
+    return {"status": "success", "message": "Webhook received"}
+
+async def apply_stripe_event(event, invoice_db, api_usage_db):
+    """
+    Apply a verified Stripe webhook event to the invoices DB.
+
+    Args:
+        event (stripe.Event): The Stripe event
+        invoice_db (Session): Invoice database session
+        api_usage_db (Session): API usage database session
+    """
     if event['type'] == 'radar.early_fraud_warning.created':
         efw = event['data']['object']
         log.warning(f"Stripe early fraud warning: id={efw.id} charge_id={efw.charge} actionable={efw.actionable} fraud_type={efw.fraud_type}")
         try:
-            refund = stripe.Refund.create(charge=efw.charge, reason="fraudulent")
+            with time_upstream('stripe'):
+                refund = stripe.Refund.create(charge=efw.charge, reason="fraudulent")
             log.warning(f"Auto-refunded charge {efw.charge}: refund_id={refund.id}")
         except Exception as e:
             log.error(f"Failed to auto-refund charge {efw.charge}: {str(e)}")
 
-        return {"status": "success", "message": "Webhook processed successfully"}
+        return
 
     session_id = event['data']['object']['id']
     payment_state = event['data']['object']['payment_status']
     email = event['data']['object']['customer_email']
-    invoice = invoice_db.query(Invoice).filter(Invoice.email == email).first()
-
-    log.info(f"stripe webhook: payment_state={payment_state} email={email}")
-
-    if event['type'] == 'checkout.session.completed' or event['type'] == 'checkout.session.async_payment_succeeded':
-        if invoice:
-            async with invoice_lock:
-                invoice_state = invoice.stripe_invoice_state
-                if invoice_state == 'paid':
-                    log.info(f"invoice (stripe): received webhook {event['type']} but state={invoice_state}. Doing nothing. email={email}")
-                    return {"status": "success", "message": "Invoice already paid"}
-
-                invoice.stripe_invoice_state = payment_state
-                log.info(f"invoice (stripe): state updated to {payment_state} for {email}")
-
-                if payment_state == 'paid':
-                    invoice.order_state = "Settled"
-                    success = await fulfill_order(email, invoice.order_id, invoice.product_id, "stripe", api_usage_db)
-
-                    if success:
-                        invoice.order_state = 'Fulfilled'
-                        invoice.fulfillment_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-                    else:
-                        log.error(f"failed to fulfill stripe order for email={email}, order_id={invoice.order_id}")
-                else: # unpaid
-                    invoice.order_state = "Canceled"
-
-                invoice_db.commit()
-
-                # Notify the frontend
-                async with stripe_webhook_lock:
-                    queue = stripe_webhook_queue_map[session_id]
-                    await queue.put({"order_state": invoice.order_state})
-        else:
-            log.warning(f"received webhook {event['type']} for {email} not present in invoices DB")
-
-        return {"status": "success", "message": "Webhook processed successfully"}
+    invoice = invoice_by_stripe_session(invoice_db, session_id)
+
+    log.info("received webhook", extra={"event": "webhook_received", "provider": "stripe", "event_type": event['type'],
+                                        "session_id": session_id, "payment_state": payment_state, "email": email})
+
+    if not invoice:
+        log.warning(f"received webhook {event['type']} for {email} not present in invoices DB")
+        return
+
+    async with timed_lock(invoice_lock, "invoice_lock"):
+        invoice_state = invoice.stripe_invoice_state
+        order_state = invoice.order_state
+        if invoice_state == 'paid':
+            log.info("invoice already paid, doing nothing", extra={"event": "invoice_state_unchanged", "order_id": invoice.order_id,
+                                                                   "payment_type": "stripe", "state": invoice_state,
+                                                                   "event_type": event['type'], "email": email})
+            return
+
+        if event['type'] == 'checkout.session.completed' or event['type'] == 'checkout.session.async_payment_succeeded':
+            invoice.stripe_invoice_state = payment_state
+            log.info("updated invoice", extra={"event": "invoice_state_change", "order_id": invoice.order_id, "payment_type": "stripe",
+                                               "session_id": session_id, "state": payment_state, "previous_state": invoice_state,
+                                               "email": email})
+
+            if payment_state == 'paid':
+                invoice.order_state = "Settled"
+                success = await fulfill_order(email, invoice.order_id, invoice.product_id, "stripe", api_usage_db)
+
+                if success:
+                    invoice.order_state = 'Fulfilled'
+                    invoice.fulfilled_at = datetime.now()
+                    invoice.fulfillment_time = invoice.fulfilled_at.strftime("%Y-%m-%dT%H:%M:%S")
+                else:
+                    log.error(f"failed to fulfill stripe order for email={email}, order_id={invoice.order_id}")
+            else: # unpaid
+                invoice.order_state = "Canceled"
+        elif event['type'] == 'checkout.session.async_payment_failed':
+            invoice.order_state = "Failed"
+        else: # checkout.session.expired
+            invoice.order_state = "Expired"
+
+        record_order_change(invoice_db, invoice, order_state, invoice_state)
+        invoice_db.commit()
 
-    elif event['type'] == 'checkout.session.async_payment_failed':
-        if invoice:
-            async with invoice_lock:
-                invoice_state = invoice.stripe_invoice_state
-                if invoice_state == 'paid':
-                    log.info(f"invoice (stripe): received webhook {event['type']} but state={invoice_state}. Doing nothing. email={email}")
-                    return {"status": "success", "message": "Invoice already paid"}
-
-                invoice.order_state = "Failed"
-                invoice_db.commit()
-
-                # Notify the frontend
-                async with stripe_webhook_lock:
-                    queue = stripe_webhook_queue_map[session_id]
-                    await queue.put({"order_state": invoice.order_state})
-        else:
-            log.warning(f"Received webhook {event['type']} for {email} not present in invoices DB")
-        return {"status": "success", "message": "Webhook processed successfully"}
-    else: # checkout.session.expired
-        if invoice:
-            async with invoice_lock:
-                invoice_state = invoice.stripe_invoice_state
-                if invoice_state == 'paid':
-                    log.info(f"invoice (stripe): received webhook {event['type']} but state={invoice_state}. Doing nothing. email={email}")
-                    return {"status": "success", "message": "Invoice already paid"}
-
-                invoice.order_state = "Expired"
-                invoice_db.commit()
-
-                # Notify the frontend
-                async with stripe_webhook_lock:
-                    queue = stripe_webhook_queue_map[session_id]
-                    await queue.put({"order_state": invoice.order_state})
-        else:
-            log.warning(f"Received webhook {event['type']} for {email} not present in invoices DB")
-        return {"status": "success", "message": "Webhook processed successfully"}
+        # Notify the frontend
+        async with timed_lock(stripe_webhook_lock, "stripe_webhook_lock"):
+            if session_id in stripe_webhook_queue_map:
+                await stripe_webhook_queue_map[session_id].put({"order_state": invoice.order_state})
 
-async def dequeue_stripe_webhook_data(session_id: str, invoice_db):
+async def dequeue_stripe_webhook_data(session_id: str, invoice_db, last_event_id=None):
     """
     Stream Stripe webhook events to the client.
 
     Args:
         session_id (str): The Stripe session ID to get events for
         invoice_db (Session): Invoice database session
+        last_event_id (str, optional): Last-Event-ID of a reconnecting client
 
     Yields:
         str: Server-sent event data
@@ -969,127 +1777,183 @@ async def dequeue_stripe_webhook_data(session_id: str, invoice_db):
     if session_id == None or session_id == "":
         yield f"event: error\ndata: session_id is empty\n\n"
 
-    while True:
-        queue_empty = True
-        try:
-            async with stripe_webhook_lock:
-                if session_id in stripe_webhook_queue_map:
-                    queue_empty = False
-                    queue = stripe_webhook_queue_map[session_id]
-                    data = await asyncio.wait_for(queue.get(), timeout=0.5)
-                    yield f"data: {json.dumps(data)}\n\n"
-                    invoice_db.expire_all()
-        except asyncio.TimeoutError:
-            invoice = invoice_db.query(Invoice).filter(Invoice.stripe_session_id == session_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: queue timeout stripe webhook\n\n"
-        except asyncio.CancelledError:
-            invoice = invoice_db.query(Invoice).filter(Invoice.stripe_session_id == session_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: queue cancelled stripe webhook\n\n"
-
-        if queue_empty:
-            invoice = invoice_db.query(Invoice).filter(Invoice.stripe_session_id == session_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: session_id {session_id} not found\n\n"
+    open_streams = SSE_OPEN_STREAMS.labels("stripe")
+    open_streams.inc()
+    last_state = last_event_id
 
-        await asyncio.sleep(2.0)
+    try:
+        yield sse_retry(SSE_RETRY_MS, SSE_RETRY_JITTER_MS)
+
+        # A resuming client already has the state, poll at a random point of
+        # the interval so a restart's reconnects don't all query at once
+        if last_event_id is not None:
+            await wait_for_drain(random.uniform(0, SSE_POLL_SECONDS))
+
+        while not sse_draining.is_set():
+            queue_empty = True
+            try:
+                async with timed_lock(stripe_webhook_lock, "stripe_webhook_lock"):
+                    if session_id in stripe_webhook_queue_map:
+                        queue_empty = False
+                        queue = stripe_webhook_queue_map[session_id]
+                        data = await asyncio.wait_for(queue.get(), timeout=0.5)
+                        yield order_state_message(data["order_state"], last_state)
+                        last_state = data["order_state"]
+                        invoice_db.expire_all()
+            except asyncio.TimeoutError:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.stripe_session_id == session_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: queue timeout stripe webhook\n\n"
+            except asyncio.CancelledError:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.stripe_session_id == session_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: queue cancelled stripe webhook\n\n"
+
+            if queue_empty:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.stripe_session_id == session_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: session_id {session_id} not found\n\n"
+
+            # Give the connection back to the pool between polls, the streams
+            # outnumber the pool's connections. Don't take invoice_lock while
+            # holding one either: the webhook that holds the lock needs a
+            # connection to finish, and a full pool blocks the event loop.
+            invoice_db.close()
+            await wait_for_drain(SSE_POLL_SECONDS)
+
+        # Shutting down, hand over any state still queued for the client and
+        # tell it to come back later, resuming from the last event id
+        order_state = latest_queued_state(stripe_webhook_queue_map.get(session_id))
+        if order_state is not None:
+            yield order_state_message(order_state, last_state)
+        yield sse_retry(SSE_DRAIN_RETRY_MS, SSE_DRAIN_RETRY_JITTER_MS)
+    finally:
+        open_streams.dec()
 
 
 @app.get("/stripe-webhook-events")
-async def stripe_webhook_events(session_id: str, invoice_db: Session = Depends(get_invoice_db)):
+async def stripe_webhook_events(session_id: str, invoice_db: Session = Depends(get_invoice_db),
+                                last_event_id: str | None = Header(None)):
     """
     Endpoint to stream Stripe webhook events to the client.
 
     Args:
         session_id (str): The Stripe session ID to get events for
         invoice_db (Session): Invoice db session
+        last_event_id (str, optional): Last-Event-ID header, sent by the browser on reconnect
 
     Returns:
         StreamingResponse: Server-sent events stream
     """
-    return StreamingResponse(dequeue_stripe_webhook_data(session_id, invoice_db), media_type="text/event-stream")
+    return StreamingResponse(dequeue_stripe_webhook_data(session_id, invoice_db, last_event_id), media_type="text/event-stream")
 
 @app.post("/btcpay-webhook")
-async def btcpay_webhook(request: Request, invoice_db: Session = Depends(get_invoice_db), api_usage_db: Session = Depends(get_api_usage_db)):
+async def btcpay_webhook(request: Request, webhook_inbox_db: Session = Depends(get_webhook_inbox_db)):
     """
     Handle BTCPay webhook events.
 
+    The event is verified and appended to the webhook inbox, and the
+    response is sent right away. The inbox consumer applies it afterwards.
+
     Args:
         request (Request): The HTTP request containing the webhook data
-        invoice_db (Session): Database session
+        webhook_inbox_db (Session): Webhook inbox database session
     """
     btcpay_sig_str = request.headers.get('BTCPay-Sig')
     body_bytes = await request.body()
 
-    if verify_btcpay_webhook(body_bytes, btcpay_sig_str, btcpay_webhook_secret):
-        json = await request.json()
-        state = json['type']
-        invoice_id = json['invoiceId']
-        metadata = json['metadata']
-        email = metadata['buyerEmail']
-        invoice = invoice_db.query(Invoice).filter(Invoice.email == email).first()
+    if not verify_btcpay_webhook(body_bytes, btcpay_sig_str or "", settings.btcpay_webhook_secret):
+        log.warning(f"btcpay webhook HMAC verification failed")
+        return
 
-        log.info(f"btcpay webhook: state={state} invoice_id={invoice_id} metadata={metadata} email={email}")
+    payload = json.loads(body_bytes)
+    state = payload['type']
+    invoice_id = payload['invoiceId']
 
-        if invoice:
-            async with invoice_lock:
-                if invoice.payment_type == 'stripe':
-                    log.warning(f"invoice (btcpay): email={email} received btcpay webhook but has a stripe invoice. Doing nothing")
-                    return
-
-                invoice_state = invoice.btcpay_invoice_state
-                if invoice_state == "InvoiceSettled":
-                    log.warning(f"invoice (btcpay): received webhook {state} but state={invoice_state}. Doing nothing. email={email}")
-                    return
-
-                invoice.btcpay_invoice_state = state
-                log.info(f"invoice (btcpay): state updated to {state} for {email}")
-
-                if state == "InvoiceSettled":
-                    invoice.order_state = "Settled"
-                    success = await fulfill_order(email, invoice.order_id, invoice.product_id, "btc", api_usage_db)
-
-                    if success:
-                        invoice.order_state = "Fulfilled"
-                        invoice.fulfillment_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-                    else:
-                        log.error(f"failed to fulfill btcpay order for email={email}, order_id={invoice.order_id}")
-                elif state == "InvoiceExpired":
-                    invoice.order_state = "Expired"
-                elif state == "InvoiceInvalid":
-                    invoice.order_state = "Failed"
-
-                invoice_db.commit()
-
-                # Notify the frontend of the state change
-                async with btcpay_webhook_lock:
-                    queue = btcpay_webhook_queue_map[invoice_id]
-                    await queue.put({"order_state": invoice.order_state})
-        else:
-            log.warning(f"received webhook {state} for {email} not present in invoices DB")
-    else:
-        log.warning(f"btcpay webhook HMAC verification failed")
+    # Retries keep their delivery id and a manual redelivery points back to
+    # it, so a later genuine transition to the same state isn't a duplicate
+    delivery_id = payload.get('originalDeliveryId') or payload.get('deliveryId')
+    dedupe_key = f"btcpay:{invoice_id}:{state}:{delivery_id}" if delivery_id else f"btcpay:{invoice_id}:{state}"
+
+    if not store_webhook_event(webhook_inbox_db, 'btcpay', dedupe_key, state, invoice_id, body_bytes):
+        log.info("duplicate webhook, doing nothing", extra={"event": "webhook_duplicate", "provider": "btcpay",
+                                                            "invoice_id": invoice_id, "event_type": state})
 
-async def dequeue_btcpay_webhook_data(invoice_id: str, invoice_db):
+async def apply_btcpay_event(payload, invoice_db, api_usage_db):
+    """
+    Apply a verified BTCPay webhook event to the invoices DB.
+
+    Args:
+        payload (dict): The BTCPay webhook payload
+        invoice_db (Session): Invoice database session
+        api_usage_db (Session): API usage database session
+    """
+    state = payload['type']
+    invoice_id = payload['invoiceId']
+    metadata = payload['metadata']
+    email = metadata['buyerEmail']
+    invoice = invoice_by_btcpay_invoice(invoice_db, invoice_id)
+
+    log.info("received webhook", extra={"event": "webhook_received", "provider": "btcpay", "event_type": state,
+                                        "invoice_id": invoice_id, "order_id": metadata.get('orderId'), "email": email})
+
+    if not invoice:
+        log.warning(f"received webhook {state} for {email} not present in invoices DB")
+        return
+
+    async with timed_lock(invoice_lock, "invoice_lock"):
+        invoice_state = invoice.btcpay_invoice_state
+        order_state = invoice.order_state
+        if invoice_state == "InvoiceSettled":
+            log.warning("invoice already settled, doing nothing", extra={"event": "invoice_state_unchanged", "order_id": invoice.order_id,
+                                                                         "payment_type": "btc", "state": invoice_state,
+                                                                         "event_type": state, "email": email})
+            return
+
+        invoice.btcpay_invoice_state = state
+        log.info("updated invoice", extra={"event": "invoice_state_change", "order_id": invoice.order_id, "payment_type": "btc",
+                                           "invoice_id": invoice_id, "state": state, "previous_state": invoice_state, "email": email})
+
+        if state == "InvoiceSettled":
+            invoice.order_state = "Settled"
+            success = await fulfill_order(email, invoice.order_id, invoice.product_id, "btc", api_usage_db)
+
+            if success:
+                invoice.order_state = "Fulfilled"
+                invoice.fulfilled_at = datetime.now()
+                invoice.fulfillment_time = invoice.fulfilled_at.strftime("%Y-%m-%dT%H:%M:%S")
+            else:
+                log.error(f"failed to fulfill btcpay order for email={email}, order_id={invoice.order_id}")
+        elif state == "InvoiceExpired":
+            invoice.order_state = "Expired"
+        elif state == "InvoiceInvalid":
+            invoice.order_state = "Failed"
+
+        record_order_change(invoice_db, invoice, order_state, invoice_state)
+        invoice_db.commit()
+
+        # Notify the frontend of the state change
+        async with timed_lock(btcpay_webhook_lock, "btcpay_webhook_lock"):
+            if invoice_id in btcpay_webhook_queue_map:
+                await btcpay_webhook_queue_map[invoice_id].put({"order_state": invoice.order_state})
+
+async def dequeue_btcpay_webhook_data(invoice_id: str, invoice_db, last_event_id=None):
     """
     Stream BTCPay webhook events to the client.
 
     Args:
         invoice_id (str): The BTCPay invoice ID to get events for
         invoice_db (Sesstion): Invoice database session
+        last_event_id (str, optional): Last-Event-ID of a reconnecting client
 
     Yields:
         str: Server-sent event data
@@ -1097,80 +1961,142 @@ async def dequeue_btcpay_webhook_data(invoice_id: str, invoice_db):
     if not invoice_id:
         yield f"event: error\ndata: invoice_id is empty\n\n"
 
-    while True:
-        queue_empty = True
-        try:
-            async with btcpay_webhook_lock:
-                if invoice_id in btcpay_webhook_queue_map:
-                    queue_empty = False
-                    queue = btcpay_webhook_queue_map[invoice_id]
-                    data = await asyncio.wait_for(queue.get(), timeout=0.5)
-                    yield f"data: {json.dumps(data)}\n\n"
-                    invoice_db.expire_all()
-        except asyncio.TimeoutError:
-            invoice = invoice_db.query(Invoice).filter(Invoice.btcpay_invoice_id == invoice_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: queue timeout btcpay webhook\n\n"
-        except asyncio.CancelledError:
-            invoice = invoice_db.query(Invoice).filter(Invoice.btcpay_invoice_id == invoice_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: queue cancelled btcpay webhook\n\n"
-
-        if queue_empty:
-            invoice = invoice_db.query(Invoice).filter(Invoice.btcpay_invoice_id == invoice_id).first()
-            if invoice:
-                async with invoice_lock:
-                    data = {"order_state": invoice.order_state}
-                    yield f"data: {json.dumps(data)}\n\n"
-            else:
-                yield f"event: error\ndata: invoice_id {invoice_id} not found\n\n"
+    open_streams = SSE_OPEN_STREAMS.labels("btcpay")
+    open_streams.inc()
+    last_state = last_event_id
 
-        await asyncio.sleep(2.0)
+    try:
+        yield sse_retry(SSE_RETRY_MS, SSE_RETRY_JITTER_MS)
+
+        # A resuming client already has the state, poll at a random point of
+        # the interval so a restart's reconnects don't all query at once
+        if last_event_id is not None:
+            await wait_for_drain(random.uniform(0, SSE_POLL_SECONDS))
+
+        while not sse_draining.is_set():
+            queue_empty = True
+            try:
+                async with timed_lock(btcpay_webhook_lock, "btcpay_webhook_lock"):
+                    if invoice_id in btcpay_webhook_queue_map:
+                        queue_empty = False
+                        queue = btcpay_webhook_queue_map[invoice_id]
+                        data = await asyncio.wait_for(queue.get(), timeout=0.5)
+                        yield order_state_message(data["order_state"], last_state)
+                        last_state = data["order_state"]
+                        invoice_db.expire_all()
+            except asyncio.TimeoutError:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.btcpay_invoice_id == invoice_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: queue timeout btcpay webhook\n\n"
+            except asyncio.CancelledError:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.btcpay_invoice_id == invoice_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: queue cancelled btcpay webhook\n\n"
+
+            if queue_empty:
+                invoice = invoice_db.query(Invoice.order_state).filter(Invoice.btcpay_invoice_id == invoice_id).first()
+                if invoice:
+                    yield order_state_message(invoice.order_state, last_state)
+                    last_state = invoice.order_state
+                else:
+                    yield f"event: error\ndata: invoice_id {invoice_id} not found\n\n"
+
+            # Give the connection back to the pool between polls, the streams
+            # outnumber the pool's connections. Don't take invoice_lock while
+            # holding one either: the webhook that holds the lock needs a
+            # connection to finish, and a full pool blocks the event loop.
+            invoice_db.close()
+            await wait_for_drain(SSE_POLL_SECONDS)
+
+        # Shutting down, hand over any state still queued for the client and
+        # tell it to come back later, resuming from the last event id
+        order_state = latest_queued_state(btcpay_webhook_queue_map.get(invoice_id))
+        if order_state is not None:
+            yield order_state_message(order_state, last_state)
+        yield sse_retry(SSE_DRAIN_RETRY_MS, SSE_DRAIN_RETRY_JITTER_MS)
+    finally:
+        open_streams.dec()
 
 @app.get("/btcpay-webhook-events")
-async def btcpay_webhook_events(invoice_id: str, invoice_db: Session = Depends(get_invoice_db)):
+async def btcpay_webhook_events(invoice_id: str, invoice_db: Session = Depends(get_invoice_db),
+                                last_event_id: str | None = Header(None)):
     """
     Stream BTCPay webhook events to the client.
 
     Args:
         invoice_id (str): The BTCPay invoice ID to get events for
+        last_event_id (str, optional): Last-Event-ID header, sent by the browser on reconnect
 
     Returns:
         StreamingResponse: Server-sent events stream
     """
-    return StreamingResponse(dequeue_btcpay_webhook_data(invoice_id, invoice_db), media_type="text/event-stream")
+    return StreamingResponse(dequeue_btcpay_webhook_data(invoice_id, invoice_db, last_event_id), media_type="text/event-stream")
 
 @app.get("/guides")
-async def get_guides():
+async def get_guides(request: Request):
     """
     Get a list of available guides.
 
+    The response is serialized when the catalog is loaded. Clients that
+    send the current ETag in If-None-Match get a 304 with no body.
+
+    Args:
+        request (Request): The HTTP request
+
     Returns:
-        dict
-    """
-    print(f"GET: /guides")
-    guide_list = []
-
-    for product in product_list:
-        if product['type'] == 'guide':
-            guide = {
-                "id": product['id'],
-                "title": product['title'],
-                "description": product['description'],
-                "price": product['price'],
-                "image": product['image']
-            }
-            guide_list.append(guide)
+        Response: The guide list JSON, or 304 Not Modified
+    """
+    catalog = current_catalog()
+    headers = {"ETag": catalog.guides_etag, "Cache-Control": guides_cache_control}
+
+    if etag_matches(request.headers.get("if-none-match"), catalog.guides_etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=catalog.guides_body, media_type="application/json", headers=headers)
 
-    return {"guides": guide_list}
+@app.get("/download/{order_id}/{file}")
+async def download(order_id: str, file: str, m: str, e: int, t: str, invoice_db: Session = Depends(get_invoice_db)):
+    """
+    Redirect a signed download link to a presigned URL of the file.
+
+    Args:
+        order_id (str): Order the file belongs to
+        file (str): Name of the file
+        m (str): Delivery mode code of the link
+        e (int): Unix time the link expires at
+        t (str): The link's token
+
+    Returns:
+        RedirectResponse: Redirect to the presigned URL
+    """
+    # Hold on to the current settings in case they are reloaded meanwhile
+    current = settings
+    mode = MODES_BY_CODE.get(m)
+
+    if mode is None or not current.download_link_secret or not verify_download(current.download_link_secret, order_id, file, mode, e, t):
+        log.warning(f"GET: /download: invalid or expired link for order_id={order_id}, file={file}")
+        raise HTTPException(status_code=403, detail="Invalid or expired download link")
+
+    invoice = invoice_db.get(Invoice, order_id)
+    if invoice is None or not (invoice_settled(invoice) or invoice_fulfilled(invoice)):
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    product = find_product(invoice.product_id)
+    product_file = next((f for f in product['file_list'] if os.path.basename(f) == file), None) if product else None
+    if product_file is None:
+        log.error(f"GET: /download: product_id={invoice.product_id} has no file={file} for order_id={order_id}")
+        raise HTTPException(status_code=404, detail="File not found")
+
+    key, content_disposition = order_file_object(invoice.email, order_id, product['id'], product_file, mode)
+    presigned_url = presigned_urls.get(s3_client, current.s3_bucket_name, key, content_disposition)
+
+    return RedirectResponse(presigned_url, status_code=302, headers={"Cache-Control": "no-store"})
 
 @app.get("/access-report")
 async def get_access_report(api_key: str):
@@ -1185,7 +2111,7 @@ async def get_access_report(api_key: str):
         StreamingResponse: HTML report generated by GoAccess
     """
     # Check API key using constant-time comparison to prevent timing attacks
-    if 'mycomize_api_key' not in config or not hmac.compare_digest(api_key, config['mycomize_api_key']):
+    if settings.mycomize_api_key is None or not hmac.compare_digest(api_key, settings.mycomize_api_key):
         log.warning(f"Invalid API key used to access nginx logs report")
         raise HTTPException(status_code=401, detail="Invalid API key")
 
@@ -1240,6 +2166,39 @@ async def get_access_report(api_key: str):
         log.error(f"Error generating access report: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generating access report: {str(e)}")
 
+def refresh_order_stats(invoice_db):
+    """
+    Bring the /invoice-stats figures up to date with the order event log.
+
+    The figures are seeded from the invoices on first use, and again if
+    events they haven't seen were pruned meanwhile, including when every
+    event was.
+
+    Args:
+        invoice_db (Session): Invoice database session
+
+    Returns:
+        OrderStats: The up to date figures
+    """
+    global order_stats
+
+    if order_stats is not None:
+        # An empty log reports (0, 0), so a last offset behind the stats means everything was pruned
+        first_offset, last_offset = order_event_offsets(invoice_db)
+        if first_offset > order_stats.offset + 1 or last_offset < order_stats.offset:
+            log.warning(f"invoice stats: events after offset {order_stats.offset} were pruned, rescanning the invoices")
+            order_stats = None
+
+    if order_stats is None:
+        order_stats = OrderStats.from_invoices(invoice_db)
+
+    while True:
+        events = read_order_events(invoice_db, order_stats.offset, ORDER_EVENTS_PAGE_SIZE)
+        for event in events:
+            order_stats.apply(event)
+        if len(events) < ORDER_EVENTS_PAGE_SIZE:
+            return order_stats
+
 @app.get("/invoice-stats")
 async def get_invoice_stats(api_key: str,
                            invoice_db: Session = Depends(get_invoice_db),
@@ -1257,73 +2216,20 @@ async def get_invoice_stats(api_key: str,
         dict: Invoice and API usage statistics
     """
     # Check API key using constant-time comparison to prevent timing attacks
-    if 'mycomize_api_key' not in config or not hmac.compare_digest(api_key, config['mycomize_api_key']):
+    if settings.mycomize_api_key is None or not hmac.compare_digest(api_key, settings.mycomize_api_key):
         log.warning(f"Invalid API key used to access invoice stats")
         raise HTTPException(status_code=401, detail="Invalid API key")
 
     log.info(f"GET: /invoice-stats: Retrieving invoice statistics")
 
     try:
-        # Get all invoices
-        invoices = invoice_db.query(Invoice).all()
-
-        # Count by state
-        state_counts = {
-            "Settled": 0,
-            "Fulfilled": 0,
-            "Processing Payment": 0,
-            "Failed": 0,
-            "Expired": 0,
-            "Canceled": 0
-        }
+        # Only the orders changed since the last call are read
+        stats = refresh_order_stats(invoice_db)
 
-        # Get current month and year for monthly sales calculation
         current_month = datetime.now().month
         current_year = datetime.now().year
         current_date = datetime.now().date()
 
-        # Monthly sales totals
-        monthly_sales = 0.0
-
-        # Sales by address for BTCPay invoices
-        btc_sales_by_address = {}
-
-        # Process each invoice
-        for invoice in invoices:
-            # Count by state
-            if invoice.order_state in state_counts:
-                state_counts[invoice.order_state] += 1
-
-            # Process if it's a fulfilled sale
-            if invoice_fulfilled(invoice) and invoice.fulfillment_time:
-                # Find the product to get its price
-                product = find_product(invoice.product_id)
-                if product:
-                    # Check if it's from the current month based on fulfillment_time
-                    fulfillment_date = datetime.strptime(invoice.fulfillment_time, "%Y-%m-%dT%H:%M:%S")
-                    if fulfillment_date.month == current_month and fulfillment_date.year == current_year:
-                        monthly_sales += product['price']
-
-                    # For BTCPay invoices, track sales by address
-                    if invoice.payment_type == 'btc' and hasattr(invoice, 'btcpay_city') and invoice.btcpay_city:
-                        # Create a unique address key
-                        address_key = f"{invoice.btcpay_city}, {invoice.btcpay_state}, {invoice.btcpay_postal_code}, {invoice.btcpay_country}"
-
-                        if address_key not in btc_sales_by_address:
-                            btc_sales_by_address[address_key] = {
-                                "city": invoice.btcpay_city,
-                                "state": invoice.btcpay_state,
-                                "postal_code": invoice.btcpay_postal_code,
-                                "country": invoice.btcpay_country,
-                                "total_sales": 0.0,
-                                "total_sales_tax": 0.0,
-                                "invoice_count": 0
-                            }
-
-                        btc_sales_by_address[address_key]["total_sales"] += product['price']
-                        btc_sales_by_address[address_key]["total_sales_tax"] += invoice.btcpay_sales_tax
-                        btc_sales_by_address[address_key]["invoice_count"] += 1
-
         # Get API usage statistics for current month
         api_usage_stats = {}
 
@@ -1361,12 +2267,8 @@ async def get_invoice_stats(api_key: str,
         }
 
         # Prepare the response
-        response = {
-            "invoice_counts": state_counts,
-            "monthly_sales": round(monthly_sales, 2),
-            "btc_sales_by_address": list(btc_sales_by_address.values()),
-            "api_usage": api_usage_stats
-        }
+        response = stats.report(current_catalog(), datetime.now())
+        response["api_usage"] = api_usage_stats
 
         return response
 
@@ -1376,3 +2278,127 @@ async def get_invoice_stats(api_key: str,
     except Exception as e:
         log.error(f"Error retrieving invoice stats: {e}")
         raise HTTPException(status_code=500, detail=f"Error retrieving invoice stats: {str(e)}")
+
+def order_event_message(event):
+    """Format an order event as a server-sent event, its offset is the event id."""
+    return f"id: {event['offset']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+def parse_offset(value):
+    """Parse an offset sent by a consumer, anything that isn't one reads from the start."""
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+@app.get("/order-events")
+async def get_order_events(api_key: str, after: int = 0, limit: int = ORDER_EVENTS_PAGE_SIZE,
+                           invoice_db: Session = Depends(get_invoice_db)):
+    """
+    Read a page of the order event log. Requires API key for authentication.
+
+    A consumer saves next_offset and passes it as after on its next call.
+    A first_offset above after + 1 means events were pruned before the
+    consumer read them.
+
+    Args:
+        api_key (str): API key for authentication
+        after (int): Offset of the last event the consumer has, 0 for all
+        limit (int): Maximum number of events, at most ORDER_EVENTS_PAGE_SIZE
+        invoice_db (Session): Invoice database session
+
+    Returns:
+        dict: events, next_offset, first_offset and last_offset
+    """
+    if settings.mycomize_api_key is None or not hmac.compare_digest(api_key, settings.mycomize_api_key):
+        log.warning(f"Invalid API key used to access order events")
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    after = max(after, 0)
+    events = read_order_events(invoice_db, after, min(max(limit, 1), ORDER_EVENTS_PAGE_SIZE))
+    first_offset, last_offset = order_event_offsets(invoice_db)
+
+    return {
+        "events": events,
+        "next_offset": events[-1]["offset"] if events else after,
+        "first_offset": first_offset,
+        "last_offset": last_offset,
+    }
+
+async def follow_order_events(after, invoice_db):
+    """
+    Stream the order event log from an offset, then every event as it is recorded.
+
+    Args:
+        after (int): Offset of the last event the consumer has
+        invoice_db (Session): Invoice database session
+
+    Yields:
+        str: Server-sent event data
+    """
+    open_streams = SSE_OPEN_STREAMS.labels("order_events")
+    open_streams.inc()
+    try:
+        yield sse_retry(SSE_RETRY_MS, SSE_RETRY_JITTER_MS)
+
+        while not sse_draining.is_set():
+            events = read_order_events(invoice_db, after, ORDER_EVENTS_PAGE_SIZE)
+            for event in events:
+                yield order_event_message(event)
+            if events:
+                after = events[-1]["offset"]
+            else:
+                yield ": keepalive\n\n"
+
+            # Same as the order state streams, don't hold a pooled connection between polls
+            invoice_db.close()
+            if len(events) < ORDER_EVENTS_PAGE_SIZE:
+                await wait_for_drain(ORDER_EVENTS_POLL_SECONDS)
+
+        yield sse_retry(SSE_DRAIN_RETRY_MS, SSE_DRAIN_RETRY_JITTER_MS)
+    finally:
+        open_streams.dec()
+
+@app.get("/order-events/stream")
+async def stream_order_events(api_key: str, after: int = 0, invoice_db: Session = Depends(get_invoice_db),
+                              last_event_id: str | None = Header(None)):
+    """
+    Follow the order event log as server-sent events. Requires API key for
+    authentication.
+
+    Args:
+        api_key (str): API key for authentication
+        after (int): Offset of the last event the consumer has, 0 for all
+        invoice_db (Session): Invoice database session
+        last_event_id (str, optional): Last-Event-ID header, a reconnecting
+            client resumes from it instead of after
+
+    Returns:
+        StreamingResponse: Server-sent events stream
+    """
+    if settings.mycomize_api_key is None or not hmac.compare_digest(api_key, settings.mycomize_api_key):
+        log.warning(f"Invalid API key used to access order events")
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    if last_event_id is not None:
+        after = parse_offset(last_event_id)
+
+    return StreamingResponse(follow_order_events(max(after, 0), invoice_db), media_type="text/event-stream")
+
+@app.get("/metrics")
+async def get_metrics(api_key: str):
+    """
+    Expose request, upstream, database, lock and SSE metrics in the
+    Prometheus text format. Requires API key for authentication.
+
+    Args:
+        api_key (str): API key for authentication
+
+    Returns:
+        PlainTextResponse: Metrics in the Prometheus exposition format
+    """
+    # Check API key using constant-time comparison to prevent timing attacks
+    if settings.mycomize_api_key is None or not hmac.compare_digest(api_key, settings.mycomize_api_key):
+        log.warning(f"Invalid API key used to access metrics")
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
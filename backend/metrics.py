@@ -0,0 +1,406 @@
+"""
+Lightweight Prometheus-style metrics for the backend.
+
+Metrics are plain in-process counters that are rendered in the Prometheus
+text exposition format by the /metrics endpoint. Recording a sample is a
+dict lookup plus a few additions, so instrumentation stays in the low
+microseconds even on the checkout and webhook hot paths.
+"""
+from bisect import bisect_left
+from time import perf_counter
+
+from sqlalchemy import event
+
+# Default latency buckets in seconds, from 1ms to 30s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY = []
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Timer:
+    """Context manager that observes the elapsed time of its block."""
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(perf_counter() - self.start)
+        return False
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *labelvalues):
+        """
+        Get the child metric for a set of label values.
+
+        Args:
+            *labelvalues (str): One value per label name, in order
+
+        Returns:
+            The child metric for the given label values
+        """
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self.children[labelvalues] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for labelvalues, child in sorted(self.children.items()):
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Counter(_Metric):
+    """A monotonically increasing counter."""
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, labelvalues, child):
+        labels = _format_labels(self.labelnames, labelvalues)
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "bucket_counts", "sum", "count")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """A histogram of observed values with fixed bucket upper bounds."""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def time(self, *labelvalues):
+        """
+        Time a block of code and observe its duration in seconds.
+
+        Args:
+            *labelvalues (str): One value per label name, in order
+
+        Returns:
+            _Timer: Context manager that records the block's duration
+        """
+        return _Timer(self.labels(*labelvalues))
+
+    def _render_child(self, labelvalues, child):
+        lines = []
+        cumulative = 0
+        bounds = self.upper_bounds + (float("inf"),)
+
+        for bound, count in zip(bounds, child.bucket_counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+def render_metrics():
+    """
+    Render every registered metric in the Prometheus text format.
+
+    Returns:
+        str: The exposition text
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+#
+# Backend metrics
+#
+HTTP_REQUEST_LATENCY = Histogram(
+    "mycomize_http_request_duration_seconds",
+    "Time from receiving a request to sending the response headers",
+    ["route"]
+)
+
+UPSTREAM_LATENCY = Histogram(
+    "mycomize_upstream_request_duration_seconds",
+    "Latency of calls to upstream services",
+    ["service"]
+)
+
+UPSTREAM_ERRORS = Counter(
+    "mycomize_upstream_errors_total",
+    "Calls to upstream services that raised an exception",
+    ["service"]
+)
+
+SQLITE_QUERY_LATENCY = Histogram(
+    "mycomize_sqlite_query_duration_seconds",
+    "Time spent executing SQLite statements",
+    ["database"]
+)
+
+SQLITE_COMMIT_LATENCY = Histogram(
+    "mycomize_sqlite_commit_duration_seconds",
+    "Time spent flushing and committing SQLite sessions",
+    ["database"]
+)
+
+LOCK_WAIT = Histogram(
+    "mycomize_lock_wait_seconds",
+    "Time spent waiting to acquire an asyncio lock",
+    ["lock"]
+)
+
+WEBHOOK_INBOX_LAG = Histogram(
+    "mycomize_webhook_inbox_lag_seconds",
+    "Time from storing a webhook in the inbox to applying it",
+    ["source"]
+)
+
+SSE_OPEN_STREAMS = Gauge(
+    "mycomize_sse_open_streams",
+    "Number of open server-sent event streams",
+    ["stream"]
+)
+
+GC_ARCHIVED_INVOICES = Counter(
+    "mycomize_gc_archived_invoices_total",
+    "Terminal orders archived and deleted by the garbage collector"
+)
+
+GC_RECLAIMED_BYTES = Counter(
+    "mycomize_gc_reclaimed_bytes_total",
+    "Bytes returned to the filesystem by vacuuming",
+    ["database"]
+)
+
+DATABASE_SIZE = Gauge(
+    "mycomize_database_size_bytes",
+    "Size of each SQLite database after its last compaction",
+    ["database"]
+)
+
+DELIVERY_URL_LATENCY = Histogram(
+    "mycomize_delivery_url_duration_seconds",
+    "Time to prepare the download URLs of an order, including S3 copies",
+    ["delivery_mode"]
+)
+
+CHECKOUT_REJECTIONS = Counter(
+    "mycomize_checkout_rejections_total",
+    "Checkout requests rejected before any I/O",
+    ["reason"]
+)
+
+RECONCILE_API_CALLS = Counter(
+    "mycomize_reconcile_api_calls_total",
+    "List calls made by the order reconciler",
+    ["provider"]
+)
+
+RECONCILE_TRANSITIONS = Counter(
+    "mycomize_reconcile_transitions_total",
+    "Order state transitions found by the reconciler that no webhook delivered",
+    ["provider", "event_type"]
+)
+
+LOG_RECORDS_DROPPED = Counter(
+    "mycomize_log_records_dropped_total",
+    "Log records dropped by event sampling or a full log queue",
+    ["reason"]
+)
+
+class _UpstreamTimer(_Timer):
+    __slots__ = ("service",)
+
+    def __init__(self, service):
+        super().__init__(UPSTREAM_LATENCY.labels(service))
+        self.service = service
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if exc_type is not None:
+            UPSTREAM_ERRORS.labels(self.service).inc()
+        return False
+
+def time_upstream(service):
+    """
+    Time a call to an upstream service, counting calls that raise.
+
+    Args:
+        service (str): Name of the upstream service, e.g. 'stripe'
+
+    Returns:
+        _UpstreamTimer: Context manager that records the call's duration
+    """
+    return _UpstreamTimer(service)
+
+class _TimedLock:
+    __slots__ = ("lock", "child")
+
+    def __init__(self, lock, child):
+        self.lock = lock
+        self.child = child
+
+    async def __aenter__(self):
+        start = perf_counter()
+        await self.lock.acquire()
+        self.child.observe(perf_counter() - start)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.lock.release()
+        return False
+
+def timed_lock(lock, name):
+    """
+    Acquire an asyncio lock, recording how long the acquisition waited.
+
+    Args:
+        lock (asyncio.Lock): The lock to acquire
+        name (str): Name of the lock used as the metric label
+
+    Returns:
+        _TimedLock: Async context manager holding the lock
+    """
+    return _TimedLock(lock, LOCK_WAIT.labels(name))
+
+def instrument_engine(engine, database):
+    """
+    Record the execution time of every statement run through an engine.
+
+    Args:
+        engine (Engine): SQLAlchemy engine to instrument
+        database (str): Name of the database used as the metric label
+    """
+    child = SQLITE_QUERY_LATENCY.labels(database)
+
+    # The start time lives on the statement's execution context, so a
+    # statement that raises leaves nothing behind on the connection
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_start_time = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "query_start_time", None)
+        if start is not None:
+            child.observe(perf_counter() - start)
+
+def instrument_sessionmaker(session_factory, database):
+    """
+    Record the time sessions spend in commit(), including the flush.
+
+    Args:
+        session_factory (sessionmaker): Session factory to instrument
+        database (str): Name of the database used as the metric label
+    """
+    child = SQLITE_COMMIT_LATENCY.labels(database)
+
+    @event.listens_for(session_factory, "before_commit")
+    def before_commit(session):
+        session.info["commit_start_time"] = perf_counter()
+
+    @event.listens_for(session_factory, "after_commit")
+    def after_commit(session):
+        start = session.info.pop("commit_start_time", None)
+        if start is not None:
+            child.observe(perf_counter() - start)
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording request latency for a fixed set of routes.
+
+    Latency is measured up to the response start, so streaming endpoints
+    report their time to first byte rather than the lifetime of the stream.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.children = {route: HTTP_REQUEST_LATENCY.labels(route) for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        child = self.children.get(scope.get("path")) if scope["type"] == "http" else None
+        if child is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        observed = False
+
+        async def send_wrapper(message):
+            nonlocal observed
+            if not observed and message["type"] == "http.response.start":
+                observed = True
+                child.observe(perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not observed:
+                child.observe(perf_counter() - start)
@@ -0,0 +1,273 @@
+"""
+Append-only log of order lifecycle events.
+
+Every change to an order appends an event to the order_events table of the
+invoices database, in the same transaction as the change, so the log never
+disagrees with the invoices. Each event carries a snapshot of the order
+after the change. Offsets are the table's AUTOINCREMENT ids: they only grow
+and are never reused, even once old events are pruned, so a consumer keeps
+the offset of the last event it handled and asks for the events after it.
+
+OrderStats folds the log into the /invoice-stats figures. It is seeded from
+one scan of the invoices and then only reads the events after its offset.
+"""
+import json
+import time
+
+from collections import Counter
+from database import Invoice, OrderEvent
+from datetime import datetime
+from sqlalchemy import func
+
+ORDER_CREATED = "order_created"
+ORDER_STATE_CHANGED = "order_state_changed"
+PAYMENT_STATE_CHANGED = "payment_state_changed"
+ORDER_ARCHIVED = "order_archived"
+
+ORDER_STATES = ("Settled", "Fulfilled", "Processing Payment", "Failed", "Expired", "Canceled")
+
+def payment_state(invoice):
+    """The payment provider's state of an order's invoice or session."""
+    return invoice.btcpay_invoice_state if invoice.payment_type == 'btc' else invoice.stripe_invoice_state
+
+def order_snapshot(invoice):
+    """
+    Get the fields of an order that events carry.
+
+    Args:
+        invoice (Invoice): The order
+
+    Returns:
+        dict: The order's snapshot
+    """
+    fulfilled_at = None
+    if invoice.fulfillment_time:
+        fulfilled_at = (invoice.fulfilled_at or datetime.strptime(invoice.fulfillment_time, "%Y-%m-%dT%H:%M:%S")).isoformat()
+
+    snapshot = {
+        "order_id": invoice.order_id,
+        "payment_type": invoice.payment_type,
+        "product_id": invoice.product_id,
+        "order_state": invoice.order_state,
+        "payment_state": payment_state(invoice),
+        "fulfilled_at": fulfilled_at,
+    }
+    if invoice.payment_type == 'btc' and invoice.btcpay_city:
+        snapshot["location"] = {
+            "city": invoice.btcpay_city,
+            "state": invoice.btcpay_state,
+            "postal_code": invoice.btcpay_postal_code,
+            "country": invoice.btcpay_country,
+        }
+        snapshot["sales_tax"] = invoice.btcpay_sales_tax or 0.0
+
+    return snapshot
+
+def append_order_event(db, event_type, invoice):
+    """
+    Add an event to the session, it is written when the session commits.
+
+    Args:
+        db (Session): Invoice database session
+        event_type (str): One of the event types above
+        invoice (Invoice): The order, as it is after the change
+    """
+    db.add(OrderEvent(
+        event_type=event_type,
+        order_id=invoice.order_id,
+        recorded_at=time.time(),
+        payload=json.dumps(order_snapshot(invoice), separators=(",", ":"))
+    ))
+
+def record_order_change(db, invoice, previous_order_state, previous_payment_state):
+    """
+    Add the event of a change to an order, if its order or payment state changed.
+
+    Args:
+        db (Session): Invoice database session
+        invoice (Invoice): The order, as it is after the change
+        previous_order_state (str): The order state before the change
+        previous_payment_state (str): The payment state before the change
+    """
+    if invoice.order_state != previous_order_state:
+        append_order_event(db, ORDER_STATE_CHANGED, invoice)
+    elif payment_state(invoice) != previous_payment_state:
+        append_order_event(db, PAYMENT_STATE_CHANGED, invoice)
+
+def read_order_events(db, after, limit):
+    """
+    Read the events that follow an offset.
+
+    Args:
+        db (Session): Invoice database session
+        after (int): Offset of the last event already handled, 0 for all
+        limit (int): Maximum number of events
+
+    Returns:
+        list: Events, oldest first, as dicts with the offset, type and
+            record time followed by the order's snapshot
+    """
+    rows = db.query(OrderEvent) \
+        .filter(OrderEvent.id > after) \
+        .order_by(OrderEvent.id) \
+        .limit(limit) \
+        .all()
+
+    return [
+        {"offset": row.id, "type": row.event_type, "recorded_at": row.recorded_at, **json.loads(row.payload)}
+        for row in rows
+    ]
+
+def order_event_offsets(db):
+    """
+    Get the offsets of the oldest and newest events in the log.
+
+    Returns:
+        tuple: (first offset, last offset), both 0 when the log is empty
+    """
+    first, last = db.query(func.min(OrderEvent.id), func.max(OrderEvent.id)).one()
+    return first or 0, last or 0
+
+class OrderStats:
+    """
+    Order counts and sales, kept up to date from the event log.
+
+    Applying an order snapshot is idempotent, so an event that is also in
+    the invoice scan the stats were seeded from is harmless. Prices are
+    looked up in the catalog when the report is built, as /invoice-stats
+    always did.
+
+    Args:
+        offset (int): Offset of the last event reflected in the stats
+    """
+
+    def __init__(self, offset=0):
+        self.offset = offset
+
+        # order_id -> order state
+        self.states = {}
+        self.state_counts = Counter()
+
+        # order_id -> (month, product_id, address key, sales tax), for fulfilled orders
+        self.fulfilled = {}
+        # "YYYY-MM" -> product_id -> fulfilled orders
+        self.monthly = {}
+        # address key -> location and product_id -> [orders, sales tax]
+        self.addresses = {}
+
+    @classmethod
+    def from_invoices(cls, invoice_db):
+        """
+        Seed the stats from every invoice.
+
+        The offset is read before the scan, so changes made meanwhile are
+        applied again, which changes nothing.
+        """
+        _, offset = order_event_offsets(invoice_db)
+        stats = cls(offset)
+
+        for invoice in invoice_db.query(Invoice).yield_per(1000):
+            stats.add(order_snapshot(invoice))
+
+        return stats
+
+    def apply(self, event):
+        """Apply an event read by read_order_events()."""
+        if event["type"] == ORDER_ARCHIVED:
+            self.remove(event["order_id"])
+        else:
+            self.add(event)
+        self.offset = event["offset"]
+
+    def add(self, order):
+        order_id = order["order_id"]
+        previous = self.states.get(order_id)
+        if previous == order["order_state"]:
+            return
+
+        if previous is not None:
+            self.state_counts[previous] -= 1
+        self.states[order_id] = order["order_state"]
+        self.state_counts[order["order_state"]] += 1
+
+        if order["order_state"] == "Fulfilled" and order["fulfilled_at"]:
+            self._add_sale(order)
+        else:
+            self._remove_sale(order_id)
+
+    def remove(self, order_id):
+        previous = self.states.pop(order_id, None)
+        if previous is not None:
+            self.state_counts[previous] -= 1
+        self._remove_sale(order_id)
+
+    def _remove_sale(self, order_id):
+        sale = self.fulfilled.pop(order_id, None)
+        if sale is not None:
+            month, product_id, address_key, sales_tax = sale
+            self.monthly[month][product_id] -= 1
+            if address_key is not None:
+                totals = self.addresses[address_key]["products"][product_id]
+                totals[0] -= 1
+                totals[1] -= sales_tax
+
+    def _add_sale(self, order):
+        if order["order_id"] in self.fulfilled:
+            return
+
+        month = order["fulfilled_at"][:7]
+        product_id = order["product_id"]
+        self.monthly.setdefault(month, Counter())[product_id] += 1
+
+        address_key = None
+        location = order.get("location")
+        if location is not None:
+            address_key = f"{location['city']}, {location['state']}, {location['postal_code']}, {location['country']}"
+            address = self.addresses.setdefault(address_key, {"location": location, "products": {}})
+            totals = address["products"].setdefault(product_id, [0, 0.0])
+            totals[0] += 1
+            totals[1] += order["sales_tax"]
+
+        self.fulfilled[order["order_id"]] = (month, product_id, address_key, order.get("sales_tax", 0.0))
+
+    def report(self, catalog, now):
+        """
+        Build the invoice figures of /invoice-stats.
+
+        Args:
+            catalog (CatalogSnapshot): Current catalog, for product prices
+            now (datetime): Current time, picks the month of monthly_sales
+
+        Returns:
+            dict: invoice_counts, monthly_sales and btc_sales_by_address
+        """
+        monthly_sales = sum(
+            catalog.by_id[product_id]['price'] * count
+            for product_id, count in self.monthly.get(f"{now:%Y-%m}", {}).items()
+            if product_id in catalog.by_id
+        )
+
+        btc_sales_by_address = []
+        for address in self.addresses.values():
+            invoice_count, total_sales, total_sales_tax = 0, 0.0, 0.0
+
+            for product_id, (count, sales_tax) in address["products"].items():
+                product = catalog.by_id.get(product_id)
+                if product is not None:
+                    invoice_count += count
+                    total_sales += product['price'] * count
+                    total_sales_tax += sales_tax
+
+            if invoice_count > 0:
+                btc_sales_by_address.append({
+                    **address["location"],
+                    "total_sales": total_sales,
+                    "total_sales_tax": total_sales_tax,
+                    "invoice_count": invoice_count,
+                })
+
+        return {
+            "invoice_counts": {state: self.state_counts[state] for state in ORDER_STATES},
+            "monthly_sales": round(monthly_sales, 2),
+            "btc_sales_by_address": btc_sales_by_address,
+        }
@@ -0,0 +1,156 @@
+"""
+Reconciliation of order states against BTCPay and Stripe.
+
+A lost webhook leaves an invoice in "Processing Payment" for good. The
+reconciler lists the BTCPay invoices and Stripe checkout sessions created
+since the oldest pending local order, in paginated bulk calls, and turns
+every terminal state the local invoice hasn't seen into a synthetic webhook
+event. The events go through the webhook inbox, so they are applied by the
+same code as real webhooks. A real delivery's dedupe key carries its BTCPay
+delivery id, which the reconciler can't know, so a delivery that turns up
+after its reconciled event is not rejected as a duplicate. Applying it
+changes nothing: a settled invoice ignores later webhooks, and an expired
+or invalid one is set to the state it is already in.
+"""
+import json
+import logging
+import httpx
+import stripe
+
+from metrics import RECONCILE_API_CALLS, time_upstream
+from typing import NamedTuple
+
+log = logging.getLogger("mycomize-backend")
+
+PAGE_SIZE = 100
+
+# BTCPay invoice statuses that end an invoice, and the webhook they stand in for
+BTCPAY_TERMINAL_STATUSES = {
+    "Settled": "InvoiceSettled",
+    "Expired": "InvoiceExpired",
+    "Invalid": "InvoiceInvalid",
+}
+
+class ReconcileEvent(NamedTuple):
+    """A synthetic webhook event, with the arguments of store_webhook_event()."""
+    source: str
+    dedupe_key: str
+    event_type: str
+    invoice_key: str
+    payload: bytes
+
+async def list_btcpay_changes(settings, pending, since):
+    """
+    List the BTCPay invoices that reached a terminal status and turn those
+    of pending local invoices into InvoiceSettled/Expired/Invalid events.
+
+    Paging stops once every pending invoice has been seen.
+
+    Args:
+        settings (Settings): Settings with the BTCPay URL, store and API key
+        pending (dict): Emails of the pending local invoices by BTCPay invoice id
+        since (float): Unix time, invoices created before it are not listed
+
+    Returns:
+        list: ReconcileEvent for each missed transition
+    """
+    url = f"{settings.btcpay_url}/api/v1/stores/{settings.btcpay_store_id}/invoices"
+    headers = {"Authorization": f"token {settings.btcpay_api_key}"}
+    params = [("startDate", int(since)), ("take", PAGE_SIZE)] + [("status", status) for status in BTCPAY_TERMINAL_STATUSES]
+
+    events = []
+    remaining = set(pending)
+    skip = 0
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while remaining:
+            RECONCILE_API_CALLS.labels("btcpay").inc()
+            with time_upstream('btcpay'):
+                response = await client.get(url, headers=headers, params=params + [("skip", skip)])
+            response.raise_for_status()
+            page = response.json()
+
+            for remote in page:
+                if remote['id'] not in remaining:
+                    continue
+                remaining.discard(remote['id'])
+
+                event_type = BTCPAY_TERMINAL_STATUSES.get(remote['status'])
+                if event_type is None:
+                    continue
+
+                metadata = dict(remote.get('metadata') or {})
+                metadata.setdefault('buyerEmail', pending[remote['id']])
+                payload = {"type": event_type, "invoiceId": remote['id'], "metadata": metadata, "reconciled": True}
+
+                # Keyed without a delivery id, this never matches a real delivery's key
+                events.append(ReconcileEvent('btcpay', f"btcpay:{remote['id']}:{event_type}", event_type,
+                                             remote['id'], json.dumps(payload).encode('utf-8')))
+
+            if len(page) < PAGE_SIZE:
+                break
+            skip += PAGE_SIZE
+
+    return events
+
+async def list_stripe_changes(pending, since):
+    """
+    List the Stripe checkout sessions created since a time, newest first,
+    and turn the paid or expired ones of pending local invoices into
+    checkout.session.completed/expired events.
+
+    Paging stops once every pending session has been seen. A failed async
+    payment can't be told apart from one still in progress by the session
+    alone, those are left to the webhook.
+
+    Args:
+        pending (dict): Emails of the pending local invoices by Stripe session id
+        since (float): Unix time, sessions created before it are not listed
+
+    Returns:
+        list: ReconcileEvent for each missed transition
+    """
+    events = []
+    remaining = set(pending)
+    params = {"limit": PAGE_SIZE, "created": {"gte": int(since)}}
+
+    while remaining:
+        RECONCILE_API_CALLS.labels("stripe").inc()
+        with time_upstream('stripe'):
+            page = await stripe.checkout.Session.list_async(**params)
+
+        for session in page.data:
+            if session.id not in remaining:
+                continue
+            remaining.discard(session.id)
+
+            if session.status == 'complete' and session.payment_status == 'paid':
+                event_type = 'checkout.session.completed'
+            elif session.status == 'expired':
+                event_type = 'checkout.session.expired'
+            else:
+                continue
+
+            payload = {
+                "id": f"evt_reconcile_{session.id}",
+                "object": "event",
+                "type": event_type,
+                "data": {
+                    "object": {
+                        "id": session.id,
+                        "object": "checkout.session",
+                        "payment_status": session.payment_status,
+                        "customer_email": session.customer_email or pending[session.id],
+                    }
+                },
+                "reconciled": True,
+            }
+
+            events.append(ReconcileEvent('stripe', f"stripe:reconcile:{session.id}:{event_type}", event_type,
+                                         session.id, json.dumps(payload).encode('utf-8')))
+
+        if not page.has_more or not page.data:
+            break
+        params["starting_after"] = page.data[-1].id
+
+    return events
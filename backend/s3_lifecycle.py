@@ -0,0 +1,114 @@
+"""
+Expiration of per-order S3 copies.
+
+Products in 'copy' delivery mode copy their files under
+{deployment_type}/{product_id}/customers/ for every order. A lifecycle rule
+per catalog product expires those copies once their presigned URLs have
+expired, including products that have since moved to 'direct' delivery.
+The bucket's lifecycle configuration is reconciled against the catalog:
+the current configuration is read, the rules of this deployment are merged
+into it, and it is only written back when a rule was added or changed.
+Rules that belong to anything else in the bucket are left alone.
+"""
+import logging
+
+from botocore.exceptions import ClientError
+from metrics import time_upstream
+from typing import NamedTuple
+
+log = logging.getLogger("mycomize-backend")
+
+# The rule the backend used to install for the first product that sold
+LEGACY_RULE_ID = "expire-3-days"
+
+class LifecycleChanges(NamedTuple):
+    """Rule IDs changed by a lifecycle reconcile."""
+    added: list
+    updated: list
+    removed: list
+
+def customer_prefix(deployment_type, product_id):
+    return f"{deployment_type}/{product_id}/customers/"
+
+def expiration_rules(deployment_type, product_ids, expiration_days):
+    """
+    Build the lifecycle rules that expire the per-order copies of products.
+
+    Args:
+        deployment_type (str): 'prod' or 'dev'
+        product_ids (iterable): IDs of the products
+        expiration_days (int): Days after which a copy is deleted
+
+    Returns:
+        list: Lifecycle rules, one per product
+    """
+    return [{
+        'ID': f"mycomize-{deployment_type}-{product_id}-customers",
+        'Filter': {'Prefix': customer_prefix(deployment_type, product_id)},
+        'Status': 'Enabled',
+        'Expiration': {'Days': expiration_days},
+    } for product_id in sorted(set(product_ids))]
+
+def get_lifecycle_rules(client, bucket):
+    try:
+        with time_upstream('s3'):
+            response = client.get_bucket_lifecycle_configuration(Bucket=bucket)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'NoSuchLifecycleConfiguration':
+            return []
+        raise
+
+    return response.get('Rules', [])
+
+def reconcile_lifecycle(client, bucket, deployment_type, rules):
+    """
+    Merge rules into a bucket's lifecycle configuration, writing it only
+    when something differs.
+
+    Rules are matched by ID and replaced when they differ. The legacy rule
+    of this deployment is removed, since the new rules cover its prefix.
+
+    Args:
+        client (S3.Client): The S3 client
+        bucket (str): Name of the bucket
+        deployment_type (str): 'prod' or 'dev'
+        rules (list): Rules built by expiration_rules()
+
+    Returns:
+        LifecycleChanges: IDs of the added, updated and removed rules
+
+    Raises:
+        ClientError: If S3 rejects the read or the write
+    """
+    current = get_lifecycle_rules(client, bucket)
+    wanted = {rule['ID']: rule for rule in rules}
+    changes = LifecycleChanges([], [], [])
+    merged = []
+
+    for rule in current:
+        rule_id = rule.get('ID')
+
+        if rule_id == LEGACY_RULE_ID and rule.get('Filter', {}).get('Prefix', '').startswith(f"{deployment_type}/"):
+            changes.removed.append(rule_id)
+            continue
+
+        if rule_id in wanted:
+            new_rule = wanted.pop(rule_id)
+            if any(rule.get(key) != value for key, value in new_rule.items()):
+                changes.updated.append(rule_id)
+            merged.append(new_rule)
+        else:
+            merged.append(rule)
+
+    for rule_id, rule in wanted.items():
+        changes.added.append(rule_id)
+        merged.append(rule)
+
+    if changes.added or changes.updated or changes.removed:
+        with time_upstream('s3'):
+            client.put_bucket_lifecycle_configuration(
+                Bucket=bucket,
+                LifecycleConfiguration={'Rules': merged}
+            )
+
+    return changes
@@ -0,0 +1,332 @@
+"""
+Typed, validated backend settings loaded from config/config.json.
+
+The file is polled for changes while the backend runs. A changed file is
+parsed and validated into a new Settings object, which the backend swaps
+in with a single assignment, so rotating an API key or changing a rate
+limit doesn't need a restart (and doesn't drop open SSE streams). A file
+that fails validation is logged and the current settings stay in place.
+"""
+import asyncio
+import json
+import logging
+
+from catalog import file_signature
+from dataclasses import dataclass, fields
+from typing import Optional
+
+log = logging.getLogger("mycomize-backend")
+
+FRONTEND_DEV_HTTP_URL = "http://localhost:5173"
+
+# Info events logged on every checkout, and the fraction of them that is kept
+DEFAULT_LOG_SAMPLE_RATES = {
+    "checkout_request": 0.1,
+    "checkout_rate_limit": 0.1,
+    "stripe_checkout": 0.1,
+    "address_validated": 0.1,
+    "sales_tax_computed": 0.1,
+}
+
+# Settings that are wired into the app at startup, changing them takes a restart
+RESTART_REQUIRED = ("deployment_type", "products_file", "catalog_reload_interval_seconds", "config_reload_interval_seconds")
+
+class SettingsError(Exception):
+    """Raised when the config file is missing a setting or a setting is invalid."""
+
+def _require(config, key, expected_type):
+    if key not in config:
+        raise SettingsError(f"missing required setting '{key}'")
+    return _check(key, config[key], expected_type)
+
+def _optional(config, key, expected_type, default=None):
+    value = config.get(key, default)
+    return value if value is None else _check(key, value, expected_type)
+
+def _check(key, value, expected_type):
+    # bool is a subclass of int, don't accept true/false for a number
+    if isinstance(value, bool) and expected_type is not bool:
+        raise SettingsError(f"setting '{key}' must be {expected_type.__name__}, got {value!r}")
+    if expected_type is float and isinstance(value, int):
+        return float(value)
+    if not isinstance(value, expected_type):
+        raise SettingsError(f"setting '{key}' must be {expected_type.__name__}, got {value!r}")
+    return value
+
+@dataclass(frozen=True)
+class Settings:
+    """Backend settings. Build with Settings.from_config() to validate them."""
+    deployment_type: str
+
+    # BTCPay
+    btcpay_url: str
+    btcpay_store_id: str
+    btcpay_api_key: str
+    btcpay_webhook_secret: str
+    btcpay_invoice_expiration_minutes: int
+
+    # Rate limits
+    checkout_rate_limit: int
+    checkout_ip_rate_per_minute: float
+    checkout_ip_burst: int
+
+    # Colorado GIS
+    colorado_gis_url: str
+    colorado_gis_key: str
+
+    # Google maps
+    google_maps_api_key: str
+    google_maps_addr_validation_url: str
+
+    # Stripe, the keys are those of the current deployment
+    stripe_secret_key: str
+    stripe_webhook_secret: str
+    stripe_api_base: Optional[str]
+
+    # MailerSend
+    mailersend_template_id: str
+    mailersend_api_key: str
+    mailersend_api_base: Optional[str]
+
+    # AWS
+    aws_access_key_id: str
+    aws_secret_access_key: str
+    aws_region: str
+    s3_bucket_name: str
+    s3_endpoint_url: Optional[str]
+    s3_url_expiration_seconds: int
+
+    # Built-in product list, used while there is no catalog file
+    fundamentals_price: float
+    fundamentals_stripe_price_id: str
+    fundamentals_s3_files: list
+    fundamentals_delivery_mode: str
+
+    frontend_url: str
+    mycomize_api_key: Optional[str]
+
+    # Signed download links, emails carry raw presigned URLs while unset
+    backend_url: Optional[str]
+    download_link_secret: Optional[str]
+    download_link_expiration_days: float
+
+    # Email deliverability
+    email_deliverability_positive_ttl_seconds: float
+    email_deliverability_negative_ttl_seconds: float
+    email_deliverability_max_concurrency: int
+    email_domain_allowlist: list
+
+    # Webhook dedupe
+    webhook_dedupe_retention_days: float
+    webhook_dedupe_cache_size: int
+
+    # Tracing
+    trace_export_file: Optional[str]
+    trace_collector_url: Optional[str]
+    trace_slow_request_ms: float
+
+    # Logging
+    log_sample_rates: dict
+
+    # Garbage collection and compaction
+    gc_interval_seconds: float
+    invoice_retention_days: float
+    rate_limit_window_hours: float
+    vacuum_interval_hours: float
+
+    # Order reconciliation
+    reconcile_interval_seconds: float
+    reconcile_lookback_hours: float
+    reconcile_min_age_seconds: float
+
+    # Catalog and config reloading
+    products_file: str
+    catalog_reload_interval_seconds: float
+    guides_cache_max_age_seconds: int
+    config_reload_interval_seconds: float
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Validate a parsed config file and build settings from it.
+
+        Args:
+            config (dict): The parsed config/config.json
+
+        Returns:
+            Settings: The validated settings
+
+        Raises:
+            SettingsError: If a setting is missing or invalid
+        """
+        if not isinstance(config, dict):
+            raise SettingsError("the config file must contain a JSON object")
+
+        deployment_type = _require(config, 'deployment_type', str)
+        if deployment_type not in ('prod', 'dev'):
+            raise SettingsError(f"setting 'deployment_type' must be 'prod' or 'dev', got {deployment_type!r}")
+
+        settings = cls(
+            deployment_type=deployment_type,
+            btcpay_url=_require(config, 'btcpay_url', str),
+            btcpay_store_id=_require(config, 'btcpay_store_id', str),
+            btcpay_api_key=_require(config, 'btcpay_api_key', str),
+            btcpay_webhook_secret=_require(config, 'btcpay_webhook_secret', str),
+            btcpay_invoice_expiration_minutes=_require(config, 'btcpay_invoice_expiration_minutes', int),
+            checkout_rate_limit=_require(config, 'checkout_rate_limit', int),
+            checkout_ip_rate_per_minute=_optional(config, 'checkout_ip_rate_per_minute', float, 10),
+            checkout_ip_burst=_optional(config, 'checkout_ip_burst', int, 20),
+            colorado_gis_url=_require(config, 'colorado_gis_url', str),
+            colorado_gis_key=_require(config, 'colorado_gis_key', str),
+            google_maps_api_key=_require(config, 'google_maps_api_key', str),
+            google_maps_addr_validation_url=_require(config, 'google_maps_addr_validation_url', str),
+            stripe_secret_key=_require(config, f'stripe_secret_key_{deployment_type}', str),
+            stripe_webhook_secret=_require(config, f'stripe_webhook_secret_{deployment_type}', str),
+            stripe_api_base=_optional(config, 'stripe_api_base', str),
+            mailersend_template_id=_require(config, 'mailersend_template_id', str),
+            mailersend_api_key=_require(config, 'mailersend_api_key', str),
+            mailersend_api_base=_optional(config, 'mailersend_api_base', str),
+            aws_access_key_id=_require(config, 'aws_access_key_id', str),
+            aws_secret_access_key=_require(config, 'aws_secret_access_key', str),
+            aws_region=_require(config, 'aws_region', str),
+            s3_bucket_name=_require(config, 's3_bucket_name', str),
+            s3_endpoint_url=_optional(config, 's3_endpoint_url', str),
+            s3_url_expiration_seconds=_optional(config, 's3_url_expiration_seconds', int, 172800),  # 2 days
+            fundamentals_price=_require(config, 'fundamentals_price', float),
+            fundamentals_stripe_price_id=_require(config, f'fundamentals_stripe_price_id_{deployment_type}', str),
+            fundamentals_s3_files=_require(config, 'fundamentals_s3_files', list),
+            fundamentals_delivery_mode=_optional(config, 'fundamentals_delivery_mode', str, 'copy'),
+            frontend_url=_require(config, 'frontend_url', str) if deployment_type == 'prod' else FRONTEND_DEV_HTTP_URL,
+            mycomize_api_key=_optional(config, 'mycomize_api_key', str),
+            backend_url=_optional(config, 'backend_url', str),
+            download_link_secret=_optional(config, 'download_link_secret', str),
+            download_link_expiration_days=_optional(config, 'download_link_expiration_days', float, 30),
+            email_deliverability_positive_ttl_seconds=_optional(config, 'email_deliverability_positive_ttl_seconds', float, 86400),
+            email_deliverability_negative_ttl_seconds=_optional(config, 'email_deliverability_negative_ttl_seconds', float, 900),
+            email_deliverability_max_concurrency=_optional(config, 'email_deliverability_max_concurrency', int, 8),
+            email_domain_allowlist=_optional(config, 'email_domain_allowlist', list, []),
+            webhook_dedupe_retention_days=_optional(config, 'webhook_dedupe_retention_days', float, 30),
+            webhook_dedupe_cache_size=_optional(config, 'webhook_dedupe_cache_size', int, 10000),
+            trace_export_file=_optional(config, 'trace_export_file', str),
+            trace_collector_url=_optional(config, 'trace_collector_url', str),
+            trace_slow_request_ms=_optional(config, 'trace_slow_request_ms', float, 2000),
+            log_sample_rates=_optional(config, 'log_sample_rates', dict, DEFAULT_LOG_SAMPLE_RATES),
+            gc_interval_seconds=_optional(config, 'gc_interval_seconds', float, 3600),
+            invoice_retention_days=_optional(config, 'invoice_retention_days', float, 90),
+            rate_limit_window_hours=_optional(config, 'rate_limit_window_hours', float, 24),
+            vacuum_interval_hours=_optional(config, 'vacuum_interval_hours', float, 168),
+            reconcile_interval_seconds=_optional(config, 'reconcile_interval_seconds', float, 300),
+            reconcile_lookback_hours=_optional(config, 'reconcile_lookback_hours', float, 72),
+            reconcile_min_age_seconds=_optional(config, 'reconcile_min_age_seconds', float, 300),
+            products_file=_optional(config, 'products_file', str, 'config/products.json'),
+            catalog_reload_interval_seconds=_optional(config, 'catalog_reload_interval_seconds', float, 5),
+            guides_cache_max_age_seconds=_optional(config, 'guides_cache_max_age_seconds', int, 300),
+            config_reload_interval_seconds=_optional(config, 'config_reload_interval_seconds', float, 5),
+        )
+
+        for key in ('btcpay_invoice_expiration_minutes', 'checkout_rate_limit', 'checkout_ip_rate_per_minute', 'checkout_ip_burst',
+                    's3_url_expiration_seconds',
+                    'email_deliverability_max_concurrency', 'webhook_dedupe_cache_size',
+                    'gc_interval_seconds', 'invoice_retention_days', 'rate_limit_window_hours', 'vacuum_interval_hours',
+                    'reconcile_interval_seconds', 'reconcile_lookback_hours', 'download_link_expiration_days',
+                    'catalog_reload_interval_seconds', 'config_reload_interval_seconds'):
+            if getattr(settings, key) <= 0:
+                raise SettingsError(f"setting '{key}' must be positive, got {getattr(settings, key)!r}")
+
+        if settings.fundamentals_price < 0:
+            raise SettingsError(f"setting 'fundamentals_price' must not be negative, got {settings.fundamentals_price!r}")
+
+        if settings.fundamentals_delivery_mode not in ('copy', 'direct'):
+            raise SettingsError(f"setting 'fundamentals_delivery_mode' must be 'copy' or 'direct', got {settings.fundamentals_delivery_mode!r}")
+
+        for event, rate in settings.log_sample_rates.items():
+            if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+                raise SettingsError(f"setting 'log_sample_rates' must map events to a fraction from 0 to 1, got {event!r}: {rate!r}")
+
+        for key in ('btcpay_url', 'colorado_gis_url', 'google_maps_addr_validation_url', 'frontend_url'):
+            if not getattr(settings, key).startswith(('http://', 'https://')):
+                raise SettingsError(f"setting '{key}' must be an http(s) URL, got {getattr(settings, key)!r}")
+
+        if settings.backend_url is not None and not settings.backend_url.startswith(('http://', 'https://')):
+            raise SettingsError(f"setting 'backend_url' must be an http(s) URL, got {settings.backend_url!r}")
+
+        return settings
+
+    @property
+    def download_links_enabled(self):
+        return bool(self.backend_url and self.download_link_secret)
+
+    def changed(self, other):
+        """
+        Get the names of the settings that differ between two Settings.
+
+        Returns:
+            set: Names of the changed settings
+        """
+        return {field.name for field in fields(self) if getattr(self, field.name) != getattr(other, field.name)}
+
+def load_settings(path):
+    """
+    Read and validate a config file.
+
+    Args:
+        path (str): Path of the config file
+
+    Returns:
+        Settings: The validated settings
+
+    Raises:
+        SettingsError: If the file can't be parsed or fails validation
+    """
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SettingsError(f"failed to read {path}: {e}")
+
+    return Settings.from_config(config)
+
+async def watch_settings(path, current, on_change):
+    """
+    Poll the config file and hand validated changes to on_change, for as
+    long as the app runs.
+
+    Args:
+        path (str): Path of the config file
+        current (Settings): The settings currently in use
+        on_change (callable): Called with (old, new) Settings when the file
+            changes to valid settings
+    """
+    signature = file_signature(path)
+
+    while True:
+        await asyncio.sleep(current.config_reload_interval_seconds)
+
+        new_signature = file_signature(path)
+        if new_signature == signature or new_signature is None:
+            continue
+        signature = new_signature
+
+        try:
+            new = load_settings(path)
+        except SettingsError as e:
+            log.error(f"config: not reloading {path}, keeping the current settings: {e}")
+            continue
+
+        changed = current.changed(new)
+        if not changed:
+            continue
+
+        restart_required = changed.intersection(RESTART_REQUIRED)
+        if restart_required:
+            log.error(f"config: not reloading {path}, {', '.join(sorted(restart_required))} can't change without a restart")
+            continue
+
+        log.info(f"config: reloading {path}, changed: {', '.join(sorted(changed))}")
+        try:
+            on_change(current, new)
+        except Exception as e:
+            # Keep watching, a fixed config file is picked up on its next change
+            log.error(f"config: failed to apply {path}, keeping the current settings: {e}")
+            continue
+        current = new
@@ -0,0 +1,42 @@
+import importlib
+import importlib.util
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+def load_tool(module_name, file_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(BACKEND_DIR, "tool", file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def alarm():
+    """The alarm tool, loaded from its script (its file name isn't importable)."""
+    return load_tool("mycomize_alarm", "mycomize-alarm.py")
+
+@pytest.fixture(scope="session")
+def migrate_tool():
+    """The migration tool, loaded from its script."""
+    return load_tool("mycomize_migrate", "mycomize-migrate.py")
+
+@pytest.fixture(scope="session")
+def database(tmp_path_factory):
+    """
+    The database module. Importing it creates the backend's databases under
+    ./data, so it is imported from a scratch directory.
+    """
+    scratch = tmp_path_factory.mktemp("backend")
+    for deployment_type in ("prod", "dev"):
+        os.makedirs(scratch / "data" / deployment_type)
+
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        return importlib.import_module("database")
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,141 @@
+import subprocess
+
+SERVICES = ["mycomize-backend", "nginx"]
+
+def systemctl(returncode, stdout="", stderr=""):
+    def run(args, **kwargs):
+        return subprocess.CompletedProcess(args, returncode, stdout=stdout, stderr=stderr)
+    return run
+
+def failing_systemctl(args, **kwargs):
+    raise OSError("Failed to connect to bus")
+
+def capture_messages(alarm, monkeypatch):
+    messages = []
+    monkeypatch.setattr(alarm, "send_telegram_message", lambda bot_token, chat_id, message: messages.append(message) or True)
+    return messages
+
+def test_services_active_parses_batched_output(alarm):
+    run = systemctl(0, "ActiveState=active\n\nActiveState=failed\n")
+    assert alarm.systemd_services_active(SERVICES, run) == {"mycomize-backend": True, "nginx": False}
+
+def test_services_active_is_unknown_when_systemctl_fails(alarm):
+    assert alarm.systemd_services_active(SERVICES, systemctl(1, stderr="Unit foo.service not found.")) is None
+    assert alarm.systemd_services_active(SERVICES, failing_systemctl) is None
+
+def test_failed_check_keeps_previous_state_and_sends_nothing(alarm, monkeypatch):
+    messages = capture_messages(alarm, monkeypatch)
+    state = {"mycomize-backend": True, "nginx": False}
+
+    for run in (systemctl(1, stderr="Failed to get properties"), failing_systemctl):
+        assert alarm.check_systemd_services("token", "chat", state, run) == {"mycomize-backend": True, "nginx": False}
+
+    assert messages == []
+
+def test_check_alerts_on_transitions(alarm, monkeypatch):
+    messages = capture_messages(alarm, monkeypatch)
+    state = {"mycomize-backend": True, "nginx": False}
+
+    alarm.check_systemd_services("token", "chat", state, systemctl(0, "ActiveState=inactive\n\nActiveState=active\n"))
+
+    assert state == {"mycomize-backend": False, "nginx": True}
+    assert len(messages) == 2
+    assert "Service Down" in messages[0] and "mycomize-backend" in messages[0]
+    assert "Service Recovered" in messages[1] and "nginx" in messages[1]
+
+def test_init_assumes_active_when_systemctl_fails(alarm, monkeypatch):
+    messages = capture_messages(alarm, monkeypatch)
+
+    state = alarm.init_systemd_checks("token", "chat", SERVICES, systemctl(1, stderr="Failed to get properties"))
+
+    assert state == {"mycomize-backend": True, "nginx": True}
+    assert "unknown" in messages[0]
+
+def order_event(offset):
+    return {
+        "offset": offset,
+        "type": "order_state_changed",
+        "recorded_at": 1760000000.0 + offset,
+        "order_id": f"{offset:08x}-6b1e-4c6f-9d2a-5f3e8c1b7a90",
+        "payment_type": "stripe",
+        "product_id": 1,
+        "order_state": "Settled" if offset % 10 == 0 else "Fulfilled",
+        "payment_state": "complete",
+        "fulfilled_at": None,
+    }
+
+def serve_order_events(alarm, monkeypatch, events):
+    def fetch_order_events(backend_url, api_key, after):
+        page = [event for event in events if event["offset"] > after][:alarm.ORDER_EVENTS_PAGE_SIZE]
+        return {
+            "events": page,
+            "next_offset": page[-1]["offset"] if page else after,
+            "first_offset": events[0]["offset"],
+            "last_offset": events[-1]["offset"],
+        }
+    monkeypatch.setattr(alarm, "fetch_order_events", fetch_order_events)
+
+def test_order_event_backlog_is_split_into_messages_telegram_accepts(alarm, monkeypatch, tmp_path):
+    state_file = str(tmp_path / "order-events.json")
+    alarm.save_order_events_offset(state_file, 0)
+    serve_order_events(alarm, monkeypatch, [order_event(offset) for offset in range(1, 101)])
+    messages = capture_messages(alarm, monkeypatch)
+
+    alarm.check_order_events("token", "chat", "http://backend", "key", state_file)
+
+    assert len(messages) > 1
+    assert all(len(message) <= alarm.TELEGRAM_MAX_MESSAGE_LENGTH for message in messages)
+    sent = "\n".join(messages)
+    assert all(f"\n{offset} order_state_changed" in sent for offset in range(1, 101))
+    assert alarm.load_order_events_offset(state_file) == 100
+
+def test_order_events_resume_after_the_last_message_sent(alarm, monkeypatch, tmp_path):
+    state_file = str(tmp_path / "order-events.json")
+    alarm.save_order_events_offset(state_file, 0)
+    serve_order_events(alarm, monkeypatch, [order_event(offset) for offset in range(1, 101)])
+
+    messages = []
+    def send_once(bot_token, chat_id, message):
+        if messages:
+            return False
+        messages.append(message)
+        return True
+    monkeypatch.setattr(alarm, "send_telegram_message", send_once)
+
+    alarm.check_order_events("token", "chat", "http://backend", "key", state_file)
+
+    sent_offset = alarm.load_order_events_offset(state_file)
+    assert 0 < sent_offset < 100
+    assert f"\n{sent_offset} order_state_changed" in messages[0]
+    assert f"\n{sent_offset + 1} order_state_changed" not in messages[0]
+
+    messages = capture_messages(alarm, monkeypatch)
+    alarm.check_order_events("token", "chat", "http://backend", "key", state_file)
+
+    assert f"\n{sent_offset + 1} order_state_changed" in messages[0]
+    assert alarm.load_order_events_offset(state_file) == 100
+
+def test_log_check_rescans_the_window_of_a_failed_scan(alarm, monkeypatch):
+    scans = []
+    results = iter([False, True, True])
+    def check_backend_log_with_fields(bot_token, chat_id, backend_service, level, fields, since):
+        scans.append(since)
+        return next(results)
+    monkeypatch.setattr(alarm, "check_backend_log_with_fields", check_backend_log_with_fields)
+
+    log_check = alarm.make_log_check("token", "chat", "error", {"level": "ERROR"}, 120)
+    for _ in range(3):
+        log_check()
+
+    # The failed first scan's window is scanned again, only a successful scan moves it on
+    assert scans[1] == scans[0]
+    assert scans[2] > scans[1]
+
+def test_log_scan_reports_journalctl_failures(alarm, monkeypatch):
+    monkeypatch.setattr(alarm.subprocess, "run", systemctl(1, stderr="Failed to open journal"))
+    assert alarm.check_backend_log_with_fields("token", "chat", "mycomize-backend", "error", {"level": "ERROR"}, 0) is False
+
+    messages = capture_messages(alarm, monkeypatch)
+    monkeypatch.setattr(alarm.subprocess, "run", systemctl(0, '{"level":"ERROR","logger":"mycomize-backend","msg":"boom"}\n'))
+    assert alarm.check_backend_log_with_fields("token", "chat", "mycomize-backend", "error", {"level": "ERROR"}, 0) is True
+    assert "boom" in messages[0]
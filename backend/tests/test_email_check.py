@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+
+import dns.resolver
+import pytest
+
+import email_check
+
+from email_check import EmailDeliverabilityChecker
+from email_validator import EmailUndeliverableError
+
+class MxRecord:
+    def __init__(self, exchange, preference=10):
+        self.exchange = exchange
+        self.preference = preference
+
+class StubResolver:
+    """
+    Answers MX queries from a table, and counts the queries it gets.
+
+    Args:
+        answers (dict): domain -> list of MX exchanges, or an exception
+            class raised for every query of the domain
+        delay (float): Seconds each query takes
+    """
+
+    def __init__(self, answers, delay=0.0):
+        self.answers = answers
+        self.delay = delay
+        self.queries = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, domain, rdtype):
+        with self.lock:
+            self.queries.append((domain, rdtype))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            answer = self.answers[domain]
+            if isinstance(answer, type) and issubclass(answer, Exception):
+                raise answer
+            if rdtype != "MX":
+                raise dns.resolver.NoAnswer
+            return [MxRecord(exchange) for exchange in answer]
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def mx_queries(self, domain):
+        return sum(1 for queried, rdtype in self.queries if queried == domain and rdtype == "MX")
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(email_check, "time", clock)
+    return clock
+
+def test_concurrent_lookups_of_a_domain_share_one_query():
+    resolver = StubResolver({"example.com": ["mx.example.com."]}, delay=0.1)
+    checker = EmailDeliverabilityChecker(dns_resolver=resolver)
+
+    async def validate_all():
+        return await asyncio.gather(*(checker.validate(f"user{i}@example.com") for i in range(10)))
+
+    assert asyncio.run(validate_all()) == [f"user{i}@example.com" for i in range(10)]
+    assert resolver.mx_queries("example.com") == 1
+
+def test_results_are_cached_until_their_ttl_expires(clock):
+    resolver = StubResolver({"example.com": ["mx.example.com."]})
+    checker = EmailDeliverabilityChecker(positive_ttl=60, dns_resolver=resolver)
+
+    async def validate():
+        return await checker.validate("user@example.com")
+
+    asyncio.run(validate())
+    clock.now += 59
+    asyncio.run(validate())
+    assert resolver.mx_queries("example.com") == 1
+    assert checker.hits == 1
+
+    clock.now += 2
+    asyncio.run(validate())
+    assert resolver.mx_queries("example.com") == 2
+
+def test_undeliverable_results_use_the_negative_ttl(clock):
+    resolver = StubResolver({"missing.example": dns.resolver.NXDOMAIN})
+    checker = EmailDeliverabilityChecker(positive_ttl=3600, negative_ttl=10, dns_resolver=resolver)
+
+    async def validate():
+        with pytest.raises(EmailUndeliverableError):
+            await checker.validate("user@missing.example")
+
+    asyncio.run(validate())
+    asyncio.run(validate())
+    assert resolver.mx_queries("missing.example") == 1
+
+    clock.now += 11
+    asyncio.run(validate())
+    assert resolver.mx_queries("missing.example") == 2
+
+@pytest.mark.parametrize("answer", [dns.resolver.NXDOMAIN, dns.resolver.NoAnswer], ids=["nxdomain", "no-mx"])
+def test_nxdomain_and_no_mx_domains_are_rejected(answer):
+    # NoAnswer is also the stub's answer to the A and AAAA fallbacks
+    checker = EmailDeliverabilityChecker(dns_resolver=StubResolver({"bad.example": answer}))
+
+    async def validate():
+        await checker.validate("user@bad.example")
+
+    with pytest.raises(EmailUndeliverableError):
+        asyncio.run(validate())
+
+def test_null_mx_domain_is_rejected():
+    checker = EmailDeliverabilityChecker(dns_resolver=StubResolver({"nomail.example": ["."]}))
+
+    async def validate():
+        await checker.validate("user@nomail.example")
+
+    with pytest.raises(EmailUndeliverableError):
+        asyncio.run(validate())
+
+def test_lookups_in_flight_are_bounded_by_the_semaphore():
+    domains = [f"domain{i}.example" for i in range(8)]
+    resolver = StubResolver({domain: [f"mx.{domain}."] for domain in domains}, delay=0.05)
+    checker = EmailDeliverabilityChecker(max_concurrency=2, dns_resolver=resolver)
+
+    async def validate_all():
+        await asyncio.gather(*(checker.validate(f"user@{domain}") for domain in domains))
+
+    asyncio.run(validate_all())
+    assert len(resolver.queries) == len(domains)
+    assert resolver.max_active == 2
+
+def test_allowlisted_domains_are_not_looked_up():
+    resolver = StubResolver({})
+    checker = EmailDeliverabilityChecker(allowlist=["Example.com"], dns_resolver=resolver)
+
+    assert asyncio.run(checker.validate("user@example.com")) == "user@example.com"
+    assert resolver.queries == []
@@ -0,0 +1,24 @@
+from ip_throttle import IpThrottle
+
+def test_throttled_client_does_not_drain_its_subnet():
+    throttle = IpThrottle(rate=1, burst=2, subnet_factor=4)
+
+    # A hot address floods well past its own burst
+    results = [throttle.allow("10.0.0.1", now=100.0) for _ in range(50)]
+    assert results[:2] == [True, True]
+    assert not any(results[2:])
+
+    # Only its admitted requests were charged to the /24, so a neighbour still gets through
+    assert throttle.allow("10.0.0.2", now=100.0)
+    assert throttle.allow("10.0.0.2", now=100.0)
+    assert not throttle.allow("10.0.0.2", now=100.0)
+
+def test_subnet_bucket_limits_rotating_clients():
+    throttle = IpThrottle(rate=1, burst=2, subnet_factor=4)
+
+    results = [throttle.allow(f"10.0.0.{i}", now=100.0) for i in range(1, 21)]
+    assert results.count(True) == 8
+    assert not any(results[8:])
+
+    # A client in another subnet is unaffected
+    assert throttle.allow("10.0.1.1", now=100.0)
@@ -0,0 +1,40 @@
+import pytest
+
+from metrics import Histogram, instrument_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+import metrics
+
+@pytest.fixture
+def engine(monkeypatch):
+    latency = Histogram("test_query_duration_seconds", "Query latency", ["database"])
+    metrics.REGISTRY.remove(latency)
+    monkeypatch.setattr(metrics, "SQLITE_QUERY_LATENCY", latency)
+
+    engine = create_engine("sqlite://")
+    instrument_engine(engine, "test")
+    return engine, latency.labels("test")
+
+def test_statements_are_timed(engine):
+    engine, child = engine
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        conn.execute(text("SELECT 2"))
+
+    assert child.count == 2
+
+def test_failed_statement_leaves_no_state_on_the_connection(engine):
+    engine, child = engine
+
+    with engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                conn.execute(text("SELECT * FROM missing_table"))
+        conn.execute(text("SELECT 1"))
+
+        assert "query_start_time" not in conn.info
+        assert "query_start_time" not in conn.connection.info
+
+    assert child.count == 1
@@ -0,0 +1,58 @@
+import random
+import sqlite3
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from sqlalchemy import create_engine
+
+STATES = ["Fulfilled"] * 6 + ["Expired", "Processing Payment", "Canceled", "Failed"]
+
+def create_invoices_db(database, path, btc_share, orders=2000):
+    """Create the backend's schema and fill it with orders of both providers, then ANALYZE it."""
+    engine = create_engine(f"sqlite:///{path}")
+    database.Base.metadata.create_all(engine)
+    engine.dispose()
+
+    rng = random.Random(1)
+    now = datetime(2026, 10, 1)
+    conn = sqlite3.connect(path)
+
+    for i in range(orders):
+        btc = rng.random() < btc_share
+        created = now - timedelta(minutes=37 * i)
+        conn.execute(
+            "INSERT INTO invoices (order_id, email, payment_type, order_state, checkout_link, product_id, "
+            "created_at_time, created_at, stripe_session_id, btcpay_invoice_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (f"order-{i}", f"customer{i % 700}@example.com", "btc" if btc else "stripe", rng.choice(STATES),
+             "https://checkout.example.com", "fundamentals", created.strftime("%Y-%m-%dT%H:%M:%S"), created,
+             None if btc else f"cs_{i}", f"inv_{i}" if btc else None)
+        )
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+# A database with orders of one provider only leaves the other's payment
+# reference all NULL, which once turned its webhook lookups into scans
+@pytest.mark.parametrize("btc_share", [0.3, 0.0, 1.0], ids=["mixed", "stripe-only", "btc-only"])
+def test_access_patterns_use_their_indexes(database, migrate_tool, tmp_path, btc_share):
+    path = str(tmp_path / "invoices.db")
+    create_invoices_db(database, path, btc_share)
+
+    assert migrate_tool.check_plans(path)
+
+def test_migrated_schema_matches_the_backend(database, migrate_tool, tmp_path):
+    path = str(tmp_path / "invoices.db")
+    create_invoices_db(database, path, 0.0)
+
+    migrate_tool.migrate(path)
+
+    conn = sqlite3.connect(path)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'invoices'")}
+    conn.close()
+
+    assert {index.name for index in database.Invoice.__table__.indexes} <= indexes
+    assert migrate_tool.check_plans(path)
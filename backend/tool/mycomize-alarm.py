@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
+import asyncio
+import random
 import subprocess
 import time
 import requests
 import json
+import gzip
 import logging
 import os
+import re
 import shutil
+import sqlite3
 from datetime import datetime
 
 # Setup logging
@@ -19,6 +24,37 @@ logger = logging.getLogger(__name__)
 # Configuration
 CONFIG_FILE = '../config/alarm-config.json'
 
+# Database backup settings
+BACKUP_SUFFIX = '.backup.gz'
+BACKUP_GENERATIONS = 12
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_SLEEP = 0.05
+
+# Timeouts for blocking calls made by checks, in seconds
+TELEGRAM_TIMEOUT = 10
+JOURNALCTL_TIMEOUT = 30
+BACKEND_TIMEOUT = 10
+
+# Backend log scans: (check name, level, fields a JSON log line must have),
+# journalctl is asked for lines that have the first field.
+# A field matches one value or any of a tuple of values.
+LOG_CHECKS = [
+    ('log-error', 'error', {'level': 'ERROR', 'logger': 'mycomize-backend'}),
+    ('log-warning', 'warning', {'level': 'WARNING', 'logger': 'mycomize-backend'}),
+]
+
+# Order events are read from the backend's event log, from the offset saved here
+ORDER_EVENTS_STATE_FILE = '../data/alarm-order-events.json'
+ORDER_EVENTS_PAGE_SIZE = 500
+
+# Telegram rejects messages longer than 4096 characters, order events are
+# split across messages that stay below this, leaving room for the header
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+ORDER_EVENTS_HEADER_ALLOWANCE = 128
+
+# Fields shown first when a log line is sent, the others follow as key=value
+LOG_SUMMARY_FIELDS = ('ts', 'level', 'func', 'msg')
+
 def load_config():
     """Load configuration from alarm-config.json file."""
     try:
@@ -43,7 +79,7 @@ def send_telegram_message(bot_token, chat_id, message):
     }
 
     try:
-        response = requests.post(url, data=data)
+        response = requests.post(url, data=data, timeout=TELEGRAM_TIMEOUT)
         response.raise_for_status()
         logger.info("Telegram message sent successfully")
         return True
@@ -51,43 +87,93 @@ def send_telegram_message(bot_token, chat_id, message):
         logger.error(f"Error sending Telegram message: {e}")
         return False
 
-def systemd_service_is_active(service_name):
-    """Check if a systemd service is active."""
+def parse_systemctl_show(output, service_names):
+    """
+    Parse `systemctl show --property=ActiveState` output for several units.
+
+    systemctl prints one block of properties per unit, separated by a blank
+    line, in the same order the units were given on the command line.
+    """
+    blocks = output.strip().split('\n\n') if output.strip() else []
+    states = {}
+
+    for service, block in zip(service_names, blocks):
+        properties = dict(
+            line.split('=', 1) for line in block.splitlines() if '=' in line
+        )
+        states[service] = properties.get('ActiveState') == 'active'
+
+    # Any unit systemctl did not report on is treated as inactive
+    for service in service_names:
+        states.setdefault(service, False)
+
+    return states
+
+def systemd_services_active(service_names, run=subprocess.run):
+    """
+    Check which systemd services are active with a single systemctl call.
+
+    Args:
+        service_names (list): Names of the systemd units to check
+        run (callable, optional): Command runner with the signature of
+            subprocess.run. Defaults to subprocess.run.
+
+    Returns:
+        dict: Mapping of service name to True if active, False otherwise,
+            or None if systemctl failed and the states are unknown
+    """
+    if not service_names:
+        return {}
+
     try:
-        result = subprocess.run(
-            ['systemctl', 'is-active', service_name],
+        result = run(
+            ['systemctl', 'show', '--property=ActiveState', '--', *service_names],
             capture_output=True,
             text=True,
             check=False
         )
 
-        return result.stdout.strip() == 'active'
+        if result.returncode != 0:
+            logger.error(f"Error checking service status: {result.stderr.strip()}")
+            return None
+
+        return parse_systemctl_show(result.stdout, service_names)
     except Exception as e:
         logger.error(f"Error checking service status: {e}")
-        return False
+        return None
+
+def init_systemd_checks(bot_token, chat_id, systemd_services_list, run=subprocess.run):
+    systemd_state = systemd_services_active(systemd_services_list, run)
 
-def init_systemd_checks(bot_token, chat_id, systemd_services_list):
-    systemd_state = {}
-
-    for s in systemd_services_list:
-        active = systemd_service_is_active(s)
-        systemd_state[s] = active
-
-        status = "active" if active else "inactive"
-        send_telegram_message(
-            bot_token,
-            chat_id,
-            f"🔔 *Telegram Alarm Started*\n"
-            f"Monitoring systemd service: `{s}`\n"
-            f"Current status: `{status}`\n"
-            f"Time: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`"
+    if systemd_state is None:
+        # Assume the services are up, the next check alerts on any that aren't
+        systemd_state = {service: True for service in systemd_services_list}
+        status_lines = "\n".join(f"`{s}`: `unknown`" for s in systemd_state)
+    else:
+        status_lines = "\n".join(
+            f"`{s}`: `{'active' if active else 'inactive'}`" for s, active in systemd_state.items()
         )
 
+    send_telegram_message(
+        bot_token,
+        chat_id,
+        f"🔔 *Telegram Alarm Started*\n"
+        f"Monitoring systemd services:\n"
+        f"{status_lines}\n"
+        f"Time: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`"
+    )
+
     return systemd_state
 
-def check_systemd_services(bot_token, chat_id, systemd_state):
+def check_systemd_services(bot_token, chat_id, systemd_state, run=subprocess.run):
+    current_state = systemd_services_active(list(systemd_state), run)
+
+    # An error says nothing about the services, keep the last known states
+    if current_state is None:
+        return systemd_state
+
     for service, was_active in systemd_state.items():
-        is_active = systemd_service_is_active(service)
+        is_active = current_state[service]
 
         if was_active and not is_active:
             logger.warning(f"Service {service} has stopped!")
@@ -113,33 +199,72 @@ def check_systemd_services(bot_token, chat_id, systemd_state):
 
     return systemd_state
 
-def check_backend_log_with_pattern(bot_token, chat_id, backend_service, level, pattern):
+def field_values(value):
+    return value if isinstance(value, tuple) else (value,)
+
+def journal_prefilter(fields):
+    """
+    Build a journalctl --grep pattern for the first field of a log check,
+    so journalctl only hands over candidate lines.
+    """
+    name, value = next(iter(fields.items()))
+    values = "|".join(re.escape(json.dumps(v)) for v in field_values(value))
+    return f'"{re.escape(name)}":({values})'
+
+def log_entry_matches(entry, fields):
+    return all(entry.get(name) in field_values(value) for name, value in fields.items())
+
+def format_log_entry(entry):
+    summary = " ".join(str(entry.get(name, '')) for name in LOG_SUMMARY_FIELDS)
+    details = " ".join(f"{name}={value}" for name, value in entry.items()
+                       if name not in LOG_SUMMARY_FIELDS and name != 'logger')
+    return f"{summary} {details}".rstrip()
+
+def check_backend_log_with_fields(bot_token, chat_id, backend_service, level, fields, since=None):
+    """
+    Send the backend log lines with the given fields logged since a time.
+
+    Returns:
+        bool: True if the log was scanned and any matches were sent
+    """
     try:
-        # Calculate timestamp for ~ 2 minutes ago
-        two_min_ago = datetime.now().timestamp() - 125
-        since_time = datetime.fromtimestamp(two_min_ago).strftime('%Y-%m-%d %H:%M:%S')
+        # Scan from the given time, or ~ 2 minutes ago
+        if since is None:
+            since = datetime.now().timestamp() - 125
+        since_time = datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M:%S')
 
         # Run journalctl command with --since argument
         result = subprocess.run(
             [
                 'sudo', 'journalctl', '-u', backend_service, '-o', 'cat',
-                '--grep', pattern,
+                '--grep', journal_prefilter(fields),
                 '--since', since_time
              ],
             capture_output=True,
             text=True,
-            check=False
+            check=False,
+            timeout=JOURNALCTL_TIMEOUT
         )
 
         if result.returncode != 0:
             logger.error(f"Error checking {backend_service} {level}: {result.stderr}")
-            return
+            return False
+
+        lines = []
+        for line in result.stdout.splitlines():
+            # Anything that isn't a backend JSON log line (uvicorn's own output, journal notices) is skipped
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and log_entry_matches(entry, fields):
+                lines.append(format_log_entry(entry))
 
-        output = result.stdout.strip()
+        output = "\n".join(lines)
 
-        if output != '-- No entries --':
+        if output:
             if level == 'info':
-                send_telegram_message(
+                return send_telegram_message(
                     bot_token,
                     chat_id,
                     f"✅ *INFO: mycomize backend info*\n"
@@ -147,63 +272,363 @@ def check_backend_log_with_pattern(bot_token, chat_id, backend_service, level, p
                     f"Time: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`"
                 )
             else:
-                send_telegram_message(
+                return send_telegram_message(
                     bot_token,
                     chat_id,
                     f"🚨 *ALERT: mycomize backend {level}*\n"
                     f"```\n{output}\n```\n"
                     f"Time: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`"
                 )
+
+        return True
     except Exception as e:
         logger.error(f"Error checking {backend_service} {level}: {e}")
+        return False
+
+def load_order_events_offset(state_file):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)['offset']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_order_events_offset(state_file, offset):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'offset': offset}, f)
+    os.replace(tmp_file, state_file)
+
+def fetch_order_events(backend_url, api_key, after):
+    """Fetch a page of order events from the backend."""
+    response = requests.get(
+        f"{backend_url.rstrip('/')}/order-events",
+        params={'api_key': api_key, 'after': after, 'limit': ORDER_EVENTS_PAGE_SIZE},
+        timeout=BACKEND_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+def format_order_event(event):
+    line = f"{event['offset']} {event['type']}: order_id={event['order_id']} type={event['payment_type']} state={event['order_state']}"
+    if event.get('payment_state'):
+        line += f" payment_state={event['payment_state']}"
+    return line
+
+def order_event_batches(events, max_length=TELEGRAM_MAX_MESSAGE_LENGTH - ORDER_EVENTS_HEADER_ALLOWANCE):
+    """Split events into batches whose formatted lines fit in one message."""
+    batch, length = [], 0
+    for event in events:
+        line_length = len(format_order_event(event)) + 1
+        if batch and length + line_length > max_length:
+            yield batch
+            batch, length = [], 0
+        batch.append(event)
+        length += line_length
+    if batch:
+        yield batch
+
+def check_order_events(bot_token, chat_id, backend_url, api_key, state_file):
+    """
+    Send the order events recorded since the last run, and alert on orders
+    that were paid but couldn't be fulfilled.
+
+    Events are split across messages that fit Telegram's length limit, and
+    the offset of the last event sent is saved after every message, so
+    nothing is sent twice and nothing is skipped across restarts. A first
+    run starts at the end of the log.
+    """
+    try:
+        after = load_order_events_offset(state_file)
+        if after is None:
+            after = fetch_order_events(backend_url, api_key, 0)['last_offset']
+            save_order_events_offset(state_file, after)
+            logger.info(f"Following order events from offset {after}")
+            return
+
+        while True:
+            page = fetch_order_events(backend_url, api_key, after)
+            if page['first_offset'] > after + 1:
+                logger.warning(f"Order events {after + 1} to {page['first_offset'] - 1} were pruned before they were read")
+
+            events = page['events']
+            if not events:
+                return
+
+            for batch in order_event_batches(events):
+                lines = "\n".join(format_order_event(event) for event in batch)
+                unfulfilled = [event for event in batch if event['order_state'] == 'Settled']
+                if unfulfilled:
+                    header = "🚨 *ALERT: mycomize order paid but not fulfilled*"
+                else:
+                    header = "✅ *INFO: mycomize order events*"
+
+                if not send_telegram_message(
+                    bot_token,
+                    chat_id,
+                    f"{header}\n"
+                    f"```\n{lines}\n```\n"
+                    f"Time: `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`"
+                ):
+                    return
+
+                after = batch[-1]['offset']
+                save_order_events_offset(state_file, after)
 
-def backup_databases(backup_dir, db_dir):
-    """Backup all .db files in the specified directory."""
+            if len(events) < ORDER_EVENTS_PAGE_SIZE:
+                return
+    except Exception as e:
+        logger.error(f"Error checking order events: {e}")
+
+def database_signature(db_path):
+    """Return a cheap change signature for a database and its WAL file."""
+    signature = []
+
+    for path in (db_path, db_path + '-wal'):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+
+    return tuple(signature)
+
+def rotate_backups(backup_dir, filename, generations):
+    """Delete all but the newest `generations` compressed backups of a database."""
+    prefix = f"{filename}."
+    backups = sorted(
+        f for f in os.listdir(backup_dir)
+        if f.startswith(prefix) and f.endswith(BACKUP_SUFFIX)
+    )
+
+    for old_backup in backups[:-generations]:
+        os.remove(os.path.join(backup_dir, old_backup))
+        logger.info(f"Removed old backup {old_backup}")
+
+def backup_database(db_path, backup_dir, filename):
+    """
+    Take an online backup of a single SQLite database.
+
+    The sqlite3 backup API copies the database in small page steps and sleeps
+    between steps so the backend can keep writing while the backup runs. The
+    copy is verified with an integrity check before it is compressed.
+
+    Returns:
+        int: Number of bytes written to the compressed backup file
+    """
+    tmp_path = os.path.join(backup_dir, f".{filename}.tmp")
+    timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+    backup_path = os.path.join(backup_dir, f"{filename}.{timestamp}{BACKUP_SUFFIX}")
+
+    # The uncompressed copy is removed whatever happens, a failed backup
+    # leaves nothing partial or corrupt in the backup directory
+    try:
+        src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+
+                result = dst.execute('PRAGMA integrity_check').fetchone()[0]
+                if result != 'ok':
+                    raise sqlite3.DatabaseError(f"integrity check failed for backup of {db_path}: {result}")
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+        try:
+            with open(tmp_path, 'rb') as f_in, gzip.open(backup_path + '.tmp', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+            os.replace(backup_path + '.tmp', backup_path)
+        except BaseException:
+            if os.path.exists(backup_path + '.tmp'):
+                os.remove(backup_path + '.tmp')
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return os.path.getsize(backup_path)
+
+def backup_databases(backup_dir, db_dir, backup_state=None, generations=BACKUP_GENERATIONS):
+    """
+    Backup all .db files in the specified directory.
+
+    Databases whose change signature matches the one recorded in
+    `backup_state` during the previous run are skipped.
+    """
     if not backup_dir or not db_dir:
         logger.warning("Missing backup directory or database directory, skipping database backup")
         return
-    
+
+    if backup_state is None:
+        backup_state = {}
+
     try:
         # Create backup directory if it doesn't exist
         os.makedirs(backup_dir, exist_ok=True)
-        
+
         if not os.path.exists(db_dir):
             logger.warning(f"Database directory {db_dir} does not exist, skipping backup")
             return
-            
+
+        db_files_found = 0
         db_files_backed_up = 0
-        
+        bytes_written = 0
+        start_time = time.monotonic()
+
         # Find all .db files in the directory
         for filename in os.listdir(db_dir):
             if filename.endswith('.db'):
+                db_files_found += 1
                 db_path = os.path.join(db_dir, filename)
-                backup_path = os.path.join(backup_dir, f"{filename}.backup")
-                
-                # Using shutil for file copy - safer for binary files than subprocess
-                shutil.copy2(db_path, backup_path)
-                logger.info(f"Backed up {db_path} to {backup_path}")
+                signature = database_signature(db_path)
+
+                if backup_state.get(db_path) == signature:
+                    logger.info(f"Skipping backup of {db_path}, unchanged since last backup")
+                    continue
+
+                try:
+                    written = backup_database(db_path, backup_dir, filename)
+                except (sqlite3.Error, OSError) as e:
+                    logger.error(f"Error backing up {db_path}: {e}")
+                    continue
+
+                rotate_backups(backup_dir, filename, generations)
+                backup_state[db_path] = signature
+
+                logger.info(f"Backed up {db_path} to {backup_dir} ({written} bytes)")
                 db_files_backed_up += 1
-                
-        if db_files_backed_up == 0:
+                bytes_written += written
+
+        duration = time.monotonic() - start_time
+
+        if db_files_found == 0:
             logger.warning(f"No .db files found in {db_dir}")
         else:
-            logger.info(f"Backed up {db_files_backed_up} database files")
-            
+            logger.info(
+                f"Backed up {db_files_backed_up} of {db_files_found} database files "
+                f"in {duration:.2f} seconds ({bytes_written} bytes written)"
+            )
+
         return True
     except Exception as e:
         logger.error(f"Error backing up databases: {e}")
         return False
 
-def main():
-    """Main function to monitor service and send alerts."""
-    config = load_config()
+class CheckStats:
+    """Latency and outcome counters for one scheduled check."""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, seconds, failed=False, timed_out=False):
+        self.runs += 1
+        self.failures += int(failed)
+        self.timeouts += int(timed_out)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.last_seconds = seconds
+
+    def summary(self):
+        avg = self.total_seconds / self.runs if self.runs else 0.0
+        return (
+            f"runs={self.runs} failures={self.failures} timeouts={self.timeouts} "
+            f"avg={avg:.3f}s max={self.max_seconds:.3f}s last={self.last_seconds:.3f}s"
+        )
+
+def check_schedule(config, name, interval, timeout, jitter=0):
+    """
+    Look up the schedule of a check, applying overrides from the `checks`
+    section of the config, e.g. {"checks": {"backup": {"interval": 600}}}.
+    """
+    overrides = config.get('checks', {}).get(name, {})
+    return (
+        overrides.get('interval', interval),
+        overrides.get('timeout', timeout),
+        overrides.get('jitter', jitter)
+    )
+
+async def run_check(name, func, interval, timeout, jitter, stats):
+    """
+    Run a blocking check in a worker thread every `interval` seconds.
+
+    Each run is bounded by `timeout` so a hung journalctl or Telegram call
+    only delays its own check. A random delay of up to `jitter` seconds is
+    added to every sleep so checks sharing an interval do not run in lockstep.
+    A run that is still going after timing out is never overlapped by the next.
+    """
+    task = None
+
+    while True:
+        start = time.monotonic()
+        failed = False
+        timed_out = False
+
+        if task is not None and not task.done():
+            logger.warning(f"Check {name} is still running from a previous run, skipping")
+            await asyncio.sleep(interval)
+            continue
+
+        task = asyncio.ensure_future(asyncio.to_thread(func))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            logger.error(f"Check {name} timed out after {timeout} seconds")
+        except Exception as e:
+            failed = True
+            logger.error(f"Check {name} failed: {e}")
+
+        elapsed = time.monotonic() - start
+        stats.record(elapsed, failed, timed_out)
+
+        await asyncio.sleep(max(0.0, interval - elapsed) + random.uniform(0, jitter))
+
+async def report_check_stats(check_stats, interval):
+    """Periodically log per-check latency metrics."""
+    while True:
+        await asyncio.sleep(interval)
+        for name, stats in check_stats.items():
+            logger.info(f"Check {name}: {stats.summary()}")
+
+def make_log_check(bot_token, chat_id, level, fields, check_interval):
+    """
+    Create a log scan that picks up where its previous successful run left
+    off, so a scan that fails or times out is covered by the next one.
+    """
+    scan_state = {'since': datetime.now().timestamp() - check_interval}
+
+    def log_check():
+        scan_started = datetime.now().timestamp()
+        if check_backend_log_with_fields(bot_token, chat_id, 'mycomize-backend', level, fields, scan_state['since']):
+            scan_state['since'] = scan_started
+
+    return log_check
+
+async def run_checks(config):
+    """Main coroutine to monitor services and send alerts."""
     bot_token = config.get('telegram_bot_token')
     chat_id = config.get('telegram_chat_id')
     check_interval = config.get('check_interval', 120)  # seconds
     systemd_services = config.get('systemd_services', [])
     backup_dir = config.get('backup_directory')
     db_dir = config.get('db_dir')
-    
+    backup_generations = config.get('backup_generations', BACKUP_GENERATIONS)
+    backup_interval = config.get('backup_interval', 300)  # seconds
+    metrics_interval = config.get('metrics_interval', 3600)  # seconds
+    backend_url = config.get('backend_url')
+    api_key = config.get('mycomize_api_key')
+    order_events_state_file = config.get('order_events_state_file', ORDER_EVENTS_STATE_FILE)
+    backup_state = {}
+
     if backup_dir and db_dir:
         logger.info(f"Database backups will be stored in: {backup_dir}")
         logger.info(f"Database directory to scan for .db files: {db_dir}")
@@ -214,44 +639,62 @@ def main():
         logger.error("Telegram bot token or chat ID not configured.")
         exit(1)
 
-    systemd_state = None
+    # Each check: (name, blocking function, interval, timeout, jitter)
+    checks = []
+
     if systemd_services:
         logger.info(f"Initializing systemd service monitoring for: {', '.join(systemd_services)}")
-        systemd_state = init_systemd_checks(bot_token, chat_id, systemd_services)
+        systemd_state = await asyncio.to_thread(init_systemd_checks, bot_token, chat_id, systemd_services)
+
+        checks.append((
+            'systemd',
+            lambda: check_systemd_services(bot_token, chat_id, systemd_state),
+            *check_schedule(config, 'systemd', 30, 20, 1)
+        ))
+
+    for name, level, fields in LOG_CHECKS:
+        interval, timeout, jitter = check_schedule(config, name, check_interval, 60, 5)
+        checks.append((
+            name,
+            make_log_check(bot_token, chat_id, level, fields, interval),
+            interval,
+            timeout,
+            jitter
+        ))
+
+    if backend_url and api_key:
+        checks.append((
+            'order-events',
+            lambda: check_order_events(bot_token, chat_id, backend_url, api_key, order_events_state_file),
+            *check_schedule(config, 'order-events', check_interval, 60, 5)
+        ))
+    else:
+        logger.warning("Missing backend_url or mycomize_api_key in config, order events disabled")
 
-    logger.info(f"Monitoring started with check interval of {check_interval} seconds")
-    
-    # Perform initial backup
     if backup_dir and db_dir:
-        backup_databases(backup_dir, db_dir)
-        
-    # Track time for database backups (every 5 minutes)
-    last_backup_time = time.time()
-    backup_interval = 300  # 5 minutes in seconds
+        checks.append((
+            'backup',
+            lambda: backup_databases(backup_dir, db_dir, backup_state, backup_generations),
+            *check_schedule(config, 'backup', backup_interval, 240, 0)
+        ))
+
+    check_stats = {name: CheckStats() for name, *_ in checks}
+
+    for name, _, interval, timeout, jitter in checks:
+        logger.info(f"Scheduling check {name}: interval={interval}s timeout={timeout}s jitter={jitter}s")
+
+    await asyncio.gather(
+        report_check_stats(check_stats, metrics_interval),
+        *(
+            run_check(name, func, interval, timeout, jitter, check_stats[name])
+            for name, func, interval, timeout, jitter in checks
+        )
+    )
 
-    while True:
-        # Check systemd services if configured
-        if systemd_state is not None:
-            systemd_state = check_systemd_services(bot_token, chat_id, systemd_state)
-
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'error', "mycomize-backend:.* ERROR")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'warning', "mycomize-backend:.* WARNING")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: invoice (stripe)")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: invoice (btcpay)")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: stripe webhook:")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: btcpay webhook:")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: fulfilling order")
-        check_backend_log_with_pattern(bot_token, chat_id, 'mycomize-backend', 'info', "INFO: sent fulfillment email")
-        
-        # Check if it's time for a database backup
-        current_time = time.time()
-        if backup_dir and db_dir and (current_time - last_backup_time) >= backup_interval:
-            logger.info("Performing scheduled database backup")
-            backup_databases(backup_dir, db_dir)
-            last_backup_time = current_time
-
-        # Sleep for the specified interval
-        time.sleep(check_interval)
+def main():
+    """Main function to monitor service and send alerts."""
+    config = load_config()
+    asyncio.run(run_checks(config))
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,1063 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the mycomize backend.
+
+The e2e scenario starts the backend in a scratch working directory against
+local stand-ins for BTCPay, Stripe, Google Maps, Colorado GIS, MailerSend and
+S3. It then drives concurrent customers through /checkout, fires the matching
+webhook and waits for the order state on the SSE stream. Other scenarios
+benchmark individual components in-process.
+
+Results are written as JSON so runs can be compared over time.
+
+Run with the backend's virtual environment, e.g.:
+    python3 tool/mycomize-bench.py e2e --customers 200 --concurrency 50
+    python3 tool/mycomize-bench.py e2e --delivery-mode direct --upstream-latency-ms 50
+    python3 tool/mycomize-bench.py email-cache
+    python3 tool/mycomize-bench.py orders --orders 1000000
+    python3 tool/mycomize-bench.py guides --customers 20000
+    python3 tool/mycomize-bench.py reconcile --customers 250
+    python3 tool/mycomize-bench.py checkout-flood --customers 20000 --concurrency 50
+    python3 tool/mycomize-bench.py ip-throttle --ips 5000000
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+import httpx
+import uvicorn
+
+from fastapi import FastAPI, Request, Response
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_EMAIL_DOMAIN = "mycomize-bench.com"
+BTCPAY_STORE_ID = "bench-store"
+BTCPAY_WEBHOOK_SECRET = "bench-btcpay-secret"
+STRIPE_WEBHOOK_SECRET = "whsec_bench"
+PRODUCT_ID = "fundamentals"
+
+#
+# Helpers
+#
+def free_port():
+    """Find a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def summarize(samples_ms):
+    """Summarize a list of latencies in milliseconds."""
+    values = sorted(samples_ms)
+    if not values:
+        return {"count": 0}
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3),
+    }
+
+def git_commit():
+    """Get the commit the benchmark is running against, if known."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR, capture_output=True, text=True, check=False
+        )
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def write_results(results, output):
+    """Write benchmark results as JSON and print them."""
+    if output is None:
+        timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        output = os.path.join("bench-results", f"{results['scenario']}-{timestamp}.json")
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+
+#
+# Upstream stand-ins
+#
+def create_stub_app(state, latency):
+    """
+    Create a FastAPI app standing in for every upstream service.
+
+    Args:
+        state (dict): Shared state recording the invoices and sessions created
+        latency (float): Simulated upstream latency in seconds
+
+    Returns:
+        FastAPI: The stub app
+    """
+    stub = FastAPI()
+
+    async def upstream_delay():
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    @stub.post("/maps")
+    async def google_maps_validate_address(request: Request):
+        body = await request.json()
+        await upstream_delay()
+        state["maps_calls"] += 1
+
+        # addressLines is "{city}, {state} {postal_code}"
+        city, rest = body["address"]["addressLines"][0].split(", ", 1)
+        region, postal_code = rest.rsplit(" ", 1)
+
+        return {
+            "result": {
+                "address": {
+                    "addressComponents": [{"confirmationLevel": "CONFIRMED"}] * 4,
+                    "postalAddress": {
+                        "locality": city,
+                        "administrativeArea": region,
+                        "postalCode": postal_code,
+                        "regionCode": body["address"]["regionCode"],
+                    },
+                }
+            }
+        }
+
+    @stub.post("/gis")
+    async def colorado_gis_sales_tax():
+        await upstream_delay()
+        return {"totalSalesTax": 0.029}
+
+    @stub.post("/btcpay/api/v1/stores/{store_id}/invoices")
+    async def btcpay_create_invoice(store_id: str, request: Request):
+        body = await request.json()
+        await upstream_delay()
+
+        invoice_id = "BENCH" + secrets.token_hex(8).upper()
+        state["btcpay"][body["metadata"]["buyerEmail"]] = (invoice_id, body["metadata"]["orderId"])
+        state["btcpay_invoices"].append({
+            "id": invoice_id,
+            "status": "Settled" if state["pay_all"] else "New",
+            "createdTime": int(time.time()),
+            "metadata": body["metadata"],
+        })
+
+        return {
+            "id": invoice_id,
+            "status": "New",
+            "checkoutLink": f"https://btcpay.invalid/i/{invoice_id}",
+        }
+
+    @stub.post("/stripe/v1/checkout/sessions")
+    async def stripe_create_session(request: Request):
+        form = await request.form()
+        await upstream_delay()
+
+        session_id = "cs_bench_" + secrets.token_hex(12)
+        state["stripe"][form["customer_email"]] = (session_id, form.get("metadata[order_id]"))
+        state["stripe_sessions"].append({
+            "id": session_id,
+            "object": "checkout.session",
+            "status": "complete" if state["pay_all"] else "open",
+            "payment_status": "paid" if state["pay_all"] else "unpaid",
+            "customer_email": form["customer_email"],
+            "created": int(time.time()),
+        })
+
+        return {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.invalid/{session_id}",
+            "payment_status": "unpaid",
+        }
+
+    @stub.get("/btcpay/api/v1/stores/{store_id}/invoices")
+    async def btcpay_list_invoices(store_id: str, request: Request):
+        await upstream_delay()
+        state["list_calls"]["btcpay"] += 1
+
+        query = request.query_params
+        statuses = query.getlist("status")
+        start_date = int(query.get("startDate", 0))
+        skip = int(query.get("skip", 0))
+        take = int(query.get("take", 100))
+
+        invoices = [invoice for invoice in reversed(state["btcpay_invoices"])
+                    if invoice["createdTime"] >= start_date and (not statuses or invoice["status"] in statuses)]
+        return invoices[skip:skip + take]
+
+    @stub.get("/stripe/v1/checkout/sessions")
+    async def stripe_list_sessions(request: Request):
+        await upstream_delay()
+        state["list_calls"]["stripe"] += 1
+
+        query = request.query_params
+        limit = int(query.get("limit", 10))
+        created_gte = int(query.get("created[gte]", 0))
+
+        sessions = [session for session in reversed(state["stripe_sessions"]) if session["created"] >= created_gte]
+        if "starting_after" in query:
+            ids = [session["id"] for session in sessions]
+            sessions = sessions[ids.index(query["starting_after"]) + 1:]
+
+        return {"object": "list", "url": "/v1/checkout/sessions", "has_more": len(sessions) > limit, "data": sessions[:limit]}
+
+    @stub.post("/mailersend/email")
+    async def mailersend_send_email():
+        await upstream_delay()
+        state["emails_sent"] += 1
+        return Response(status_code=202)
+
+    @stub.api_route("/{path:path}", methods=["GET", "PUT", "HEAD", "DELETE"])
+    async def s3(path: str, request: Request):
+        await upstream_delay()
+
+        if "lifecycle" in request.query_params:
+            if request.method == "PUT":
+                state["s3_lifecycle"] = await request.body()
+                return Response(status_code=200)
+
+            if state["s3_lifecycle"] is None:
+                return Response(
+                    status_code=404,
+                    media_type="application/xml",
+                    content="<Error><Code>NoSuchLifecycleConfiguration</Code>"
+                            "<Message>The lifecycle configuration does not exist</Message></Error>",
+                )
+            return Response(status_code=200, media_type="application/xml", content=state["s3_lifecycle"])
+
+        if request.method == "PUT" and "x-amz-copy-source" in request.headers:
+            state["s3_copies"] += 1
+            return Response(
+                status_code=200,
+                media_type="application/xml",
+                content="<CopyObjectResult><ETag>\"bench\"</ETag>"
+                        "<LastModified>2024-01-01T00:00:00.000Z</LastModified></CopyObjectResult>",
+            )
+
+        return Response(status_code=200)
+
+    return stub
+
+def new_stub_state(pay_all=False):
+    """
+    State shared with the upstream stand-ins.
+
+    Args:
+        pay_all (bool): Report every invoice and checkout session as paid
+            when they are listed, without a webhook being sent
+    """
+    return {
+        "btcpay": {},
+        "stripe": {},
+        "btcpay_invoices": [],
+        "stripe_sessions": [],
+        "pay_all": pay_all,
+        "list_calls": {"btcpay": 0, "stripe": 0},
+        "maps_calls": 0,
+        "emails_sent": 0,
+        "s3_copies": 0,
+        "s3_lifecycle": None,
+    }
+
+def start_stub_server(state, latency):
+    """Run the upstream stand-ins in a background thread and return their URL."""
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        create_stub_app(state, latency), host="127.0.0.1", port=port, log_level="warning"
+    ))
+
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return server, f"http://127.0.0.1:{port}"
+
+#
+# Backend under test
+#
+def bench_config(stub_url, args):
+    """Build a backend config.json pointing every upstream at the stand-ins."""
+    return {
+        "deployment_type": "dev",
+        "btcpay_url": f"{stub_url}/btcpay",
+        "btcpay_store_id": BTCPAY_STORE_ID,
+        "btcpay_api_key": "bench",
+        "btcpay_webhook_secret": BTCPAY_WEBHOOK_SECRET,
+        "btcpay_invoice_expiration_minutes": 30,
+        "checkout_rate_limit": 1000000,
+        "checkout_ip_rate_per_minute": 1000000000,
+        "checkout_ip_burst": 1000000,
+        "colorado_gis_url": f"{stub_url}/gis",
+        "colorado_gis_key": "bench",
+        "google_maps_api_key": "bench",
+        "google_maps_addr_validation_url": f"{stub_url}/maps",
+        "stripe_secret_key_prod": "sk_test_bench",
+        "stripe_secret_key_dev": "sk_test_bench",
+        "stripe_webhook_secret_prod": STRIPE_WEBHOOK_SECRET,
+        "stripe_webhook_secret_dev": STRIPE_WEBHOOK_SECRET,
+        "stripe_api_base": f"{stub_url}/stripe",
+        "mailersend_template_id": "bench",
+        "mailersend_api_key": "bench",
+        "mailersend_api_base": f"{stub_url}/mailersend",
+        "aws_access_key_id": "bench",
+        "aws_secret_access_key": "bench",
+        "aws_region": "us-east-1",
+        "s3_bucket_name": "bench-bucket",
+        "s3_endpoint_url": stub_url,
+        "fundamentals_price": 20.0,
+        "fundamentals_stripe_price_id_prod": "price_bench",
+        "fundamentals_stripe_price_id_dev": "price_bench",
+        "fundamentals_s3_files": ["guides/fundamentals.pdf", "guides/fundamentals.epub"],
+        "fundamentals_delivery_mode": args.delivery_mode,
+        "frontend_url": "https://mycomize.invalid",
+        "mycomize_api_key": "bench",
+        "email_domain_allowlist": [BENCH_EMAIL_DOMAIN],
+    }
+
+def start_backend(workdir, config):
+    """Start the backend with uvicorn in a scratch working directory."""
+    os.makedirs(os.path.join(workdir, "config"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "data", "dev"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "data", "prod"), exist_ok=True)
+
+    with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=BACKEND_DIR)
+    log_file = open(os.path.join(workdir, "backend.log"), "w")
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"backend exited during startup, see {log_file.name}")
+        try:
+            if httpx.get(f"{url}/guides", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError(f"backend did not start within 30 seconds, see {log_file.name}")
+
+def stop_backend(process, timeout=10):
+    """Stop the backend, killing it if open SSE streams hold up shutdown."""
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def btcpay_webhook_request(invoice_id, order_id, email):
+    """Build a signed BTCPay InvoiceSettled webhook."""
+    body = json.dumps({
+        "deliveryId": secrets.token_hex(8),
+        "webhookId": "bench",
+        "originalDeliveryId": secrets.token_hex(8),
+        "isRedelivery": False,
+        "type": "InvoiceSettled",
+        "timestamp": int(time.time()),
+        "storeId": BTCPAY_STORE_ID,
+        "invoiceId": invoice_id,
+        "metadata": {"buyerEmail": email, "orderId": order_id},
+    }).encode()
+
+    signature = hmac.new(BTCPAY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return "/btcpay-webhook", body, {"BTCPay-Sig": f"sha256={signature}", "Content-Type": "application/json"}
+
+def stripe_webhook_request(session_id, order_id, email):
+    """Build a signed Stripe checkout.session.completed webhook."""
+    body = json.dumps({
+        "id": "evt_bench_" + secrets.token_hex(12),
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {
+            "object": {
+                "id": session_id,
+                "object": "checkout.session",
+                "payment_status": "paid",
+                "customer_email": email,
+                "metadata": {"order_id": order_id},
+            }
+        },
+    })
+
+    timestamp = int(time.time())
+    signature = hmac.new(STRIPE_WEBHOOK_SECRET.encode(), f"{timestamp}.{body}".encode(), hashlib.sha256).hexdigest()
+    return "/stripe-webhook", body.encode(), {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+
+async def run_customer(client, index, run_id, payment_type, state, args, samples):
+    """Drive one customer through checkout, the payment webhook and the SSE stream."""
+    email = f"customer{index}-{run_id}@{BENCH_EMAIL_DOMAIN}"
+
+    start = time.perf_counter()
+    response = await client.post("/checkout", json={
+        "type": payment_type,
+        "id": PRODUCT_ID,
+        "email": email,
+        "city": "Denver",
+        "state": "CO",
+        "zipcode": "80202",
+        "country": "US",
+    })
+    samples["checkout"].append((time.perf_counter() - start) * 1000)
+
+    if response.status_code != 200 or "checkout_link" not in response.json():
+        samples["errors"].append(f"checkout: {response.status_code} {response.text[:200]}")
+        return
+
+    if payment_type == "btc":
+        invoice_id, order_id = state["btcpay"][email]
+        stream_url = f"/btcpay-webhook-events?invoice_id={invoice_id}"
+        webhook = btcpay_webhook_request(invoice_id, order_id, email)
+    else:
+        session_id, order_id = state["stripe"][email]
+        stream_url = f"/stripe-webhook-events?session_id={session_id}"
+        webhook = stripe_webhook_request(session_id, order_id, email)
+
+    async def fire_webhook():
+        path, body, headers = webhook
+        webhook_start = time.perf_counter()
+        webhook_response = await client.post(path, content=body, headers=headers)
+        samples["webhook"].append((time.perf_counter() - webhook_start) * 1000)
+        if webhook_response.status_code != 200:
+            samples["errors"].append(f"webhook: {webhook_response.status_code} {webhook_response.text[:200]}")
+        return webhook_start
+
+    try:
+        async with asyncio.timeout(args.event_timeout):
+            async with client.stream("GET", stream_url) as stream:
+                webhook_task = None
+
+                async for line in stream.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+
+                    # The first event is the current state, pay once the stream is open
+                    if webhook_task is None:
+                        webhook_task = asyncio.create_task(fire_webhook())
+                        continue
+
+                    if json.loads(line[5:]).get("order_state") == "Fulfilled":
+                        webhook_start = await webhook_task
+                        samples["event_delivery"].append((time.perf_counter() - webhook_start) * 1000)
+                        break
+
+                if args.hold > 0:
+                    await asyncio.sleep(args.hold)
+    except TimeoutError:
+        samples["errors"].append(f"sse: no Fulfilled event within {args.event_timeout}s for {email}")
+
+async def drive_customers(backend_url, state, args):
+    run_id = secrets.token_hex(4)
+    samples = {"checkout": [], "webhook": [], "event_delivery": [], "errors": []}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency * 3, max_keepalive_connections=args.concurrency * 3)
+
+    async with httpx.AsyncClient(base_url=backend_url, timeout=args.event_timeout, limits=limits) as client:
+        async def customer(index):
+            payment_type = args.payment_type if args.payment_type != "mixed" else ("btc", "stripe")[index % 2]
+            async with semaphore:
+                await run_customer(client, index, run_id, payment_type, state, args, samples)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(customer(i) for i in range(args.customers)))
+        wall = time.perf_counter() - start
+
+    return samples, wall
+
+def scenario_e2e(args):
+    """Full checkout -> webhook -> SSE flow against local upstream stand-ins."""
+    state = new_stub_state()
+    stub_server, stub_url = start_stub_server(state, args.upstream_latency_ms / 1000)
+    workdir = tempfile.mkdtemp(prefix="mycomize-bench-")
+    backend = None
+
+    try:
+        backend, backend_url = start_backend(workdir, bench_config(stub_url, args))
+        samples, wall = asyncio.run(drive_customers(backend_url, state, args))
+    finally:
+        if backend is not None:
+            stop_backend(backend)
+        stub_server.should_exit = True
+        if args.keep_workdir:
+            print(f"Backend working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    completed = len(samples["event_delivery"])
+
+    return {
+        "params": {
+            "customers": args.customers,
+            "concurrency": args.concurrency,
+            "payment_type": args.payment_type,
+            "upstream_latency_ms": args.upstream_latency_ms,
+            "hold": args.hold,
+            "delivery_mode": args.delivery_mode,
+        },
+        "wall_seconds": round(wall, 3),
+        "throughput": {
+            "checkouts_per_second": round(len(samples["checkout"]) / wall, 3),
+            "completed_orders_per_second": round(completed / wall, 3),
+        },
+        "checkout_latency_ms": summarize(samples["checkout"]),
+        "webhook_latency_ms": summarize(samples["webhook"]),
+        "event_delivery_delay_ms": summarize(samples["event_delivery"]),
+        "upstream": {"emails_sent": state["emails_sent"], "s3_copies": state["s3_copies"]},
+        "errors": {"count": len(samples["errors"]), "first": samples["errors"][:10]},
+    }
+
+def scenario_email_cache(args):
+    """Email validation throughput with a cold and a warm deliverability cache."""
+    sys.path.insert(0, BACKEND_DIR)
+    from email_check import EmailDeliverabilityChecker
+
+    class StubMX:
+        def __init__(self, domain):
+            self.preference = 10
+            self.exchange = f"mx.{domain}."
+
+    class StubResolver:
+        """Answers every MX query after a fixed delay, like a slow DNS server."""
+        lookups = 0
+
+        def resolve(self, domain, rdtype):
+            StubResolver.lookups += 1
+            time.sleep(args.dns_latency_ms / 1000)
+            return [StubMX(domain)]
+
+    emails = [f"customer{i}@domain{i % args.domains}.com" for i in range(args.customers)]
+    checker = EmailDeliverabilityChecker(dns_resolver=StubResolver(), max_concurrency=args.concurrency)
+
+    async def validate_all():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def validate(email):
+            async with semaphore:
+                start = time.perf_counter()
+                await checker.validate(email)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(validate(email) for email in emails))
+        return latencies, time.perf_counter() - start
+
+    async def run():
+        results = {}
+        for phase in ("cold", "warm"):
+            lookups_before = StubResolver.lookups
+            latencies, wall = await validate_all()
+            results[phase] = {
+                "validations_per_second": round(len(emails) / wall, 3),
+                "dns_lookups": StubResolver.lookups - lookups_before,
+                "latency_ms": summarize(latencies),
+            }
+        return results
+
+    return {
+        "params": {
+            "validations": args.customers,
+            "domains": args.domains,
+            "concurrency": args.concurrency,
+            "dns_latency_ms": args.dns_latency_ms,
+        },
+        **asyncio.run(run()),
+    }
+
+def process_cpu_seconds(pid):
+    """CPU time used by a process so far, from /proc (Linux only)."""
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the parenthesized command name; utime and stime are fields 14 and 15
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def scenario_guides(args):
+    """
+    Throughput of GET /guides, fresh and revalidated with If-None-Match.
+
+    A single Python client tops out well below what the backend can serve,
+    so the backend's CPU time per request is reported as well.
+    """
+    workdir = tempfile.mkdtemp(prefix="mycomize-bench-")
+    backend = None
+
+    # No upstream is called, point them all at a closed port
+    config = bench_config("http://127.0.0.1:9", args)
+
+    async def fetch_all(backend, backend_url, headers):
+        semaphore = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        latencies = []
+        statuses = {}
+
+        cpu_start = process_cpu_seconds(backend.pid)
+
+        async with httpx.AsyncClient(base_url=backend_url, limits=limits) as client:
+            async def fetch():
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.get("/guides", headers=headers)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(fetch() for _ in range(args.customers)))
+            wall = time.perf_counter() - start
+
+        cpu_seconds = process_cpu_seconds(backend.pid) - cpu_start
+
+        return {
+            "requests_per_second": round(args.customers / wall, 1),
+            "backend_cpu_ms_per_request": round(cpu_seconds * 1000 / args.customers, 3),
+            "status_codes": statuses,
+            "latency_ms": summarize(latencies),
+        }
+
+    try:
+        backend, backend_url = start_backend(workdir, config)
+        etag = httpx.get(f"{backend_url}/guides").headers.get("etag")
+
+        results = {"fresh": asyncio.run(fetch_all(backend, backend_url, {}))}
+        if etag is not None:
+            results["revalidated"] = asyncio.run(fetch_all(backend, backend_url, {"If-None-Match": etag}))
+    finally:
+        if backend is not None:
+            stop_backend(backend)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "params": {"requests": args.customers, "concurrency": args.concurrency},
+        **results,
+    }
+
+def scenario_orders(args):
+    """Invoice lookup latency on the checkout and webhook paths in a large orders table."""
+    workdir = tempfile.mkdtemp(prefix="mycomize-bench-")
+    os.makedirs(os.path.join(workdir, "data", "dev"))
+    os.makedirs(os.path.join(workdir, "data", "prod"))
+
+    # The database module opens data/<deployment>/*.db relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    try:
+        from database import (
+            Invoice, DevInvoiceSessionLocal, dev_invoice_engine,
+            latest_customer_invoice, invoice_by_stripe_session, invoice_by_btcpay_invoice
+        )
+
+        customers = max(1, args.orders // args.orders_per_customer)
+        product_ids = [f"product-{i}" for i in range(args.products)]
+        created_base = datetime(2024, 1, 1)
+        rng = random.Random(0)
+        order_ids = [f"{n:08X}" for n in rng.sample(range(16 ** 8), args.orders)]
+
+        def order(i):
+            created_at = created_base + timedelta(seconds=i)
+            row = {
+                "order_id": order_ids[i],
+                "email": f"customer{i % customers}@{BENCH_EMAIL_DOMAIN}",
+                "payment_type": "stripe" if i % 2 else "btc",
+                "order_state": "Fulfilled",
+                "checkout_link": "https://checkout.invalid",
+                "product_id": product_ids[(i // customers) % len(product_ids)],
+                "created_at_time": created_at.strftime("%Y-%m-%dT%H:%M:%S"),
+                "created_at": created_at,
+                "stripe_session_id": f"cs_{order_ids[i]}" if i % 2 else None,
+                "btcpay_invoice_id": None if i % 2 else f"inv_{order_ids[i]}",
+            }
+            return row
+
+        start = time.perf_counter()
+        with dev_invoice_engine.begin() as conn:
+            for first in range(0, args.orders, 10000):
+                conn.execute(Invoice.__table__.insert(), [order(i) for i in range(first, min(first + 10000, args.orders))])
+        load_seconds = time.perf_counter() - start
+
+        lookups = {"checkout_latest_order": [], "stripe_webhook": [], "btcpay_webhook": [], "order_id": []}
+        db = DevInvoiceSessionLocal()
+
+        try:
+            for _ in range(args.lookups):
+                i = rng.randrange(args.orders)
+                row = order(i)
+                queries = {
+                    "checkout_latest_order": lambda: latest_customer_invoice(db, row["email"], row["product_id"]),
+                    "order_id": lambda: db.get(Invoice, row["order_id"]),
+                }
+                if row["stripe_session_id"]:
+                    queries["stripe_webhook"] = lambda: invoice_by_stripe_session(db, row["stripe_session_id"])
+                else:
+                    queries["btcpay_webhook"] = lambda: invoice_by_btcpay_invoice(db, row["btcpay_invoice_id"])
+
+                for name, query in queries.items():
+                    start = time.perf_counter()
+                    invoice = query()
+                    lookups[name].append((time.perf_counter() - start) * 1000)
+                    if invoice is None:
+                        raise RuntimeError(f"{name}: order {row['order_id']} not found")
+                    # Don't let the identity map answer the next lookup
+                    db.expunge_all()
+        finally:
+            db.close()
+
+        db_size = os.path.getsize(os.path.join(workdir, "data", "dev", "invoices.db"))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "params": {
+            "orders": args.orders,
+            "orders_per_customer": args.orders_per_customer,
+            "products": args.products,
+            "lookups": args.lookups,
+        },
+        "load": {
+            "seconds": round(load_seconds, 3),
+            "orders_per_second": round(args.orders / load_seconds, 1),
+            "database_bytes": db_size,
+        },
+        "lookup_latency_ms": {name: summarize(samples) for name, samples in lookups.items()},
+    }
+
+def scenario_reconcile(args):
+    """
+    Recovery of orders whose webhook was lost.
+
+    The upstream stand-ins report every invoice and checkout session as paid
+    but no webhook is sent, so each order is only fulfilled once the
+    reconciler finds the payment. The list calls it makes are counted at the
+    stand-ins, during recovery and over a few idle passes afterwards.
+    """
+    state = new_stub_state(pay_all=True)
+    stub_server, stub_url = start_stub_server(state, args.upstream_latency_ms / 1000)
+    workdir = tempfile.mkdtemp(prefix="mycomize-bench-")
+    backend = None
+
+    config = dict(bench_config(stub_url, args),
+                  reconcile_interval_seconds=args.reconcile_interval,
+                  reconcile_min_age_seconds=0)
+
+    async def run(backend_url):
+        run_id = secrets.token_hex(4)
+        recovery = []
+        errors = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency * 3, max_keepalive_connections=args.concurrency * 3)
+
+        async with httpx.AsyncClient(base_url=backend_url, timeout=args.event_timeout, limits=limits) as client:
+            async def customer(index):
+                payment_type = args.payment_type if args.payment_type != "mixed" else ("btc", "stripe")[index % 2]
+                email = f"customer{index}-{run_id}@{BENCH_EMAIL_DOMAIN}"
+
+                async with semaphore:
+                    response = await client.post("/checkout", json={
+                        "type": payment_type, "id": PRODUCT_ID, "email": email,
+                        "city": "Denver", "state": "CO", "zipcode": "80202", "country": "US",
+                    })
+                    if response.status_code != 200 or "checkout_link" not in response.json():
+                        errors.append(f"checkout: {response.status_code} {response.text[:200]}")
+                        return
+
+                    paid_at = time.perf_counter()
+                    if payment_type == "btc":
+                        stream_url = f"/btcpay-webhook-events?invoice_id={state['btcpay'][email][0]}"
+                    else:
+                        stream_url = f"/stripe-webhook-events?session_id={state['stripe'][email][0]}"
+
+                    try:
+                        async with asyncio.timeout(args.event_timeout):
+                            async with client.stream("GET", stream_url) as stream:
+                                async for line in stream.aiter_lines():
+                                    if line.startswith("data:") and json.loads(line[5:]).get("order_state") == "Fulfilled":
+                                        recovery.append((time.perf_counter() - paid_at) * 1000)
+                                        break
+                    except TimeoutError:
+                        errors.append(f"sse: order of {email} not reconciled within {args.event_timeout}s")
+
+            start = time.perf_counter()
+            await asyncio.gather(*(customer(i) for i in range(args.customers)))
+            wall = time.perf_counter() - start
+
+            calls_recovery = dict(state["list_calls"])
+            await asyncio.sleep(args.reconcile_interval * 3)
+            calls_idle = {provider: state["list_calls"][provider] - calls_recovery[provider] for provider in calls_recovery}
+
+            metrics = await client.get("/metrics", params={"api_key": "bench"})
+            reconcile_metrics = [line for line in metrics.text.splitlines() if line.startswith("mycomize_reconcile_")]
+
+        return {
+            "wall_seconds": round(wall, 3),
+            "recovery_delay_ms": summarize(recovery),
+            "list_calls": {"recovery": calls_recovery, "idle_passes": calls_idle},
+            "backend_metrics": reconcile_metrics,
+            "upstream": {"emails_sent": state["emails_sent"]},
+            "errors": {"count": len(errors), "first": errors[:10]},
+        }
+
+    try:
+        backend, backend_url = start_backend(workdir, config)
+        results = asyncio.run(run(backend_url))
+    finally:
+        if backend is not None:
+            stop_backend(backend)
+        stub_server.should_exit = True
+        if args.keep_workdir:
+            print(f"Backend working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "params": {
+            "customers": args.customers,
+            "concurrency": args.concurrency,
+            "payment_type": args.payment_type,
+            "reconcile_interval": args.reconcile_interval,
+        },
+        **results,
+    }
+
+# Bodies of the checkout flood, each is rejected without any I/O
+BAD_CHECKOUT_BODIES = {
+    "malformed_json": b'{"type": "btc", "email": ',
+    "not_an_object": b'[]',
+    "bad_payment_type": {"type": "paypal", "id": PRODUCT_ID, "email": f"flood@{BENCH_EMAIL_DOMAIN}"},
+    "bad_email": {"type": "stripe", "id": PRODUCT_ID, "email": "not-an-email"},
+    "oversized_field": {"type": "btc", "id": PRODUCT_ID, "email": f"flood@{BENCH_EMAIL_DOMAIN}",
+                        "city": "x" * 10000, "state": "CO", "zipcode": "80202", "country": "US"},
+    "missing_location": {"type": "btc", "id": PRODUCT_ID, "email": f"flood@{BENCH_EMAIL_DOMAIN}"},
+    "unknown_product": {"type": "stripe", "id": "no-such-guide", "email": f"flood@{BENCH_EMAIL_DOMAIN}"},
+}
+
+async def flood_checkout(backend_url, bodies, args):
+    """Send args.customers bad checkout requests, cycling through bodies."""
+    samples = []
+    codes = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    encoded = [body if isinstance(body, bytes) else json.dumps(body).encode() for body in bodies.values()]
+
+    async with httpx.AsyncClient(base_url=backend_url, timeout=30, limits=limits) as client:
+        async def request(index):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/checkout", content=encoded[index % len(encoded)],
+                                             headers={"Content-Type": "application/json"})
+                samples.append((time.perf_counter() - start) * 1000)
+
+                code = response.json().get("error", "accepted") if response.status_code == 200 else f"http_{response.status_code}"
+                codes[code] = codes.get(code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request(i) for i in range(args.customers)))
+        wall = time.perf_counter() - start
+
+    return {
+        "requests_per_second": round(len(samples) / wall, 3),
+        "latency_ms": summarize(samples),
+        "responses": codes,
+    }
+
+def scenario_checkout_flood(args):
+    """
+    Rejection throughput under a flood of bad /checkout requests.
+
+    The first phase sends a mix of malformed and invalid requests with the
+    per-IP throttle out of the way, none of them may reach DNS, the database
+    or an upstream. The second phase tightens the throttle with a config
+    reload and floods from the one client IP, so all but the burst are
+    rejected by its token bucket before the body is read.
+    """
+    state = new_stub_state()
+    stub_server, stub_url = start_stub_server(state, args.upstream_latency_ms / 1000)
+    workdir = tempfile.mkdtemp(prefix="mycomize-bench-")
+    backend = None
+
+    config = dict(bench_config(stub_url, args), config_reload_interval_seconds=0.2)
+
+    try:
+        backend, backend_url = start_backend(workdir, config)
+        invalid = asyncio.run(flood_checkout(backend_url, BAD_CHECKOUT_BODIES, args))
+
+        with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+            json.dump(dict(config, checkout_ip_rate_per_minute=60, checkout_ip_burst=20), f, indent=2)
+        time.sleep(1)
+
+        throttled = asyncio.run(flood_checkout(backend_url, {"unknown_product": BAD_CHECKOUT_BODIES["unknown_product"]}, args))
+    finally:
+        if backend is not None:
+            stop_backend(backend)
+        stub_server.should_exit = True
+        if args.keep_workdir:
+            print(f"Backend working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # The cost of the checks themselves, without HTTP in the way
+    sys.path.insert(0, BACKEND_DIR)
+    from checkout_request import parse_checkout_request
+    from ip_throttle import IpThrottle
+
+    encoded = [body if isinstance(body, bytes) else json.dumps(body).encode() for body in BAD_CHECKOUT_BODIES.values()]
+    start = time.perf_counter()
+    for i in range(args.customers):
+        parse_checkout_request(encoded[i % len(encoded)])
+    parse_us = (time.perf_counter() - start) / args.customers * 1e6
+
+    throttle = IpThrottle(rate=1, burst=20)
+    start = time.perf_counter()
+    for i in range(args.customers):
+        throttle.allow(f"10.0.{i % 256}.{i % 200}")
+    throttle_us = (time.perf_counter() - start) / args.customers * 1e6
+
+    return {
+        "params": {"requests": args.customers, "concurrency": args.concurrency},
+        "in_process_us": {"parse_checkout_request": round(parse_us, 3), "ip_throttle_allow": round(throttle_us, 3)},
+        "invalid": invalid,
+        "throttled": throttled,
+        "upstream": {
+            "maps_calls": state["maps_calls"],
+            "btcpay_invoices": len(state["btcpay_invoices"]),
+            "stripe_sessions": len(state["stripe_sessions"]),
+        },
+    }
+
+def scenario_ip_throttle(args):
+    """
+    Memory and throughput of the /checkout IP throttle at millions of
+    distinct client addresses.
+
+    Every request comes from a new random IPv4 address, with one abusive
+    client mixed in every hundred requests. The table must stay at its
+    fixed size, and the abusive client must stay throttled while the
+    distinct addresses churn through the table.
+    """
+    import tracemalloc
+
+    sys.path.insert(0, BACKEND_DIR)
+    from ip_throttle import IpThrottle
+
+    rng = random.Random(0)
+    checkpoints = sorted({min(args.ips, n) for n in (10000, 100000, 250000, 500000, 1000000, args.ips)})
+
+    def run(throttle, record=None):
+        abusive_allowed = 0
+        for i in range(1, args.ips + 1):
+            throttle.allow(f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}", now=i / 1000)
+            if i % 100 == 0 and throttle.allow("198.51.100.7", now=i / 1000):
+                abusive_allowed += 1
+            if record is not None and i in checkpoints:
+                record(i)
+        return abusive_allowed
+
+    # Memory, traced separately since tracing slows everything down
+    memory = {}
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    throttle = IpThrottle(rate=10 / 60, burst=20, max_entries=args.throttle_entries)
+    run(throttle, lambda i: memory.__setitem__(str(i), round((tracemalloc.get_traced_memory()[0] - baseline) / 1e6, 2)))
+    tracemalloc.stop()
+
+    throttle = IpThrottle(rate=10 / 60, burst=20, max_entries=args.throttle_entries)
+    start = time.perf_counter()
+    abusive_allowed = run(throttle)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "params": {"ips": args.ips, "throttle_entries": args.throttle_entries},
+        "memory_mb_after_ips": memory,
+        "allow_calls_per_second": round((args.ips + args.ips // 100) / elapsed, 3),
+        "allow_us": round(elapsed / (args.ips + args.ips // 100) * 1e6, 3),
+        "abusive_client": {"requests": args.ips // 100, "allowed": abusive_allowed},
+        "entries": {"clients": len(throttle.clients.entries), "subnets": len(throttle.subnets.entries)},
+        "evictions": {"clients": throttle.clients.evictions, "subnets": throttle.subnets.evictions},
+    }
+
+SCENARIOS = {
+    "e2e": scenario_e2e,
+    "email-cache": scenario_email_cache,
+    "orders": scenario_orders,
+    "guides": scenario_guides,
+    "reconcile": scenario_reconcile,
+    "checkout-flood": scenario_checkout_flood,
+    "ip-throttle": scenario_ip_throttle,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mycomize backend")
+    parser.add_argument("scenario", choices=SCENARIOS, help="Benchmark scenario to run")
+    parser.add_argument("--customers", type=int, default=100, help="Number of customers/requests (default: 100)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Customers in flight at once (default: 20)")
+    parser.add_argument("--payment-type", choices=["btc", "stripe", "mixed"], default="mixed", help="e2e: payment type (default: mixed)")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0, help="e2e: simulated latency of every upstream call")
+    parser.add_argument("--event-timeout", type=float, default=30, help="e2e: seconds to wait for the Fulfilled SSE event")
+    parser.add_argument("--hold", type=float, default=0, help="e2e: seconds to hold each SSE stream open after fulfillment")
+    parser.add_argument("--delivery-mode", choices=["copy", "direct"], default="copy", help="e2e: how the guide files are delivered (default: copy)")
+    parser.add_argument("--keep-workdir", action="store_true", help="e2e: keep the backend working directory and log")
+    parser.add_argument("--domains", type=int, default=20, help="email-cache: number of distinct email domains")
+    parser.add_argument("--dns-latency-ms", type=float, default=30, help="email-cache: simulated DNS lookup latency")
+    parser.add_argument("--orders", type=int, default=1000000, help="orders: number of orders in the invoices table")
+    parser.add_argument("--orders-per-customer", type=int, default=4, help="orders: average orders per customer")
+    parser.add_argument("--products", type=int, default=3, help="orders: number of distinct products")
+    parser.add_argument("--lookups", type=int, default=10000, help="orders: number of sampled lookups of each kind")
+    parser.add_argument("--reconcile-interval", type=float, default=1, help="reconcile: seconds between reconciler passes")
+    parser.add_argument("--ips", type=int, default=1000000, help="ip-throttle: number of distinct client addresses")
+    parser.add_argument("--throttle-entries", type=int, default=50000, help="ip-throttle: buckets kept per level (default: 50000)")
+    parser.add_argument("--output", help="Path of the JSON results file (default: bench-results/<scenario>-<time>.json)")
+    args = parser.parse_args()
+
+    results = {
+        "scenario": args.scenario,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+    }
+    results.update(SCENARIOS[args.scenario](args))
+
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()
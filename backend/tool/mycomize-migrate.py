@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Online schema migrations for the invoices database.
+
+Every migration step is idempotent and only ever holds the write lock for a
+short statement or a small batch, so it can run against the live prod
+database while the backend keeps serving. Steps that have been applied are
+recorded in PRAGMA user_version.
+
+Rolling out a schema change:
+    1. python3 tool/mycomize-migrate.py migrate ../data/prod/invoices.db
+    2. Deploy and restart the backend
+    3. Run migrate again to backfill rows written by the old backend
+    4. python3 tool/mycomize-migrate.py check-plans ../data/prod/invoices.db
+
+check-plans runs EXPLAIN QUERY PLAN for the backend's invoice access
+patterns and exits non-zero if any of them stops using its index.
+"""
+
+import argparse
+import logging
+import sqlite3
+import sys
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+)
+logger = logging.getLogger("mycomize-migrate")
+
+# How long a migration statement waits for the backend to release the lock
+BUSY_TIMEOUT_MS = 5000
+
+# Rows updated per backfill or copy transaction, and the pause between them
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_BATCH_SLEEP = 0.01
+
+def column_names(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def add_column(conn, table, column, column_type):
+    if column not in column_names(conn, table):
+        logger.info(f"adding column {table}.{column}")
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        conn.commit()
+
+def create_index(conn, name, table, columns, where=None):
+    logger.info(f"creating index {name} on {table} ({', '.join(columns)})" + (f" where {where}" if where else ""))
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})" + (f" WHERE {where}" if where else ""))
+    conn.commit()
+
+def drop_index(conn, name):
+    logger.info(f"dropping index {name}")
+    conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.commit()
+
+def backfill(conn, table, column, expression):
+    """
+    Set a NULL column from an expression in small batches.
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+        table (str): Table name
+        column (str): Column to fill where it is NULL
+        expression (str): SQL expression computing the value, rows where it
+            is NULL are left alone
+
+    Returns:
+        int: Number of rows updated
+    """
+    updated = 0
+
+    while True:
+        cursor = conn.execute(
+            f"UPDATE {table} SET {column} = {expression} WHERE rowid IN "
+            f"(SELECT rowid FROM {table} WHERE {column} IS NULL AND {expression} IS NOT NULL LIMIT ?)",
+            (BACKFILL_BATCH_SIZE,)
+        )
+        conn.commit()
+
+        updated += cursor.rowcount
+        if cursor.rowcount < BACKFILL_BATCH_SIZE:
+            break
+        time.sleep(BACKFILL_BATCH_SLEEP)
+
+    logger.info(f"backfilled {updated} rows of {table}.{column}")
+    return updated
+
+#
+# Migrations, applied in order. Each must be safe to run more than once.
+#
+def migrate_datetime_columns_and_lookup_indexes(conn):
+    """
+    Add DateTime columns next to the string timestamps, and composite
+    indexes that let the SSE state polls be answered from the index alone.
+    """
+    add_column(conn, "invoices", "created_at", "DATETIME")
+    add_column(conn, "invoices", "fulfilled_at", "DATETIME")
+
+    create_index(conn, "ix_invoices_stripe_session_state", "invoices", ["stripe_session_id", "order_state"])
+    create_index(conn, "ix_invoices_btcpay_invoice_state", "invoices", ["btcpay_invoice_id", "order_state"])
+
+    # Superseded by the composite indexes above, which share their leading column
+    drop_index(conn, "ix_invoices_stripe_session_id")
+    drop_index(conn, "ix_invoices_btcpay_invoice_id")
+
+def backfill_datetime_columns(conn):
+    # Backfills are re-run on every migrate, to catch rows written by a
+    # backend that predates the columns
+    backfill(conn, "invoices", "created_at", "datetime(created_at_time)")
+    backfill(conn, "invoices", "fulfilled_at", "datetime(fulfillment_time)")
+
+INVOICE_COLUMNS = [
+    "order_id", "email", "payment_type", "order_state", "checkout_link", "product_id",
+    "created_at_time", "fulfillment_time", "created_at", "fulfilled_at",
+    "stripe_session_id", "stripe_invoice_state", "btcpay_invoice_id", "btcpay_invoice_state",
+    "btcpay_city", "btcpay_state", "btcpay_postal_code", "btcpay_country", "btcpay_sales_tax",
+]
+
+ORDER_KEYED_INVOICES_TABLE = """
+CREATE TABLE invoices_new (
+    order_id VARCHAR NOT NULL,
+    email VARCHAR NOT NULL,
+    payment_type VARCHAR NOT NULL,
+    order_state VARCHAR NOT NULL,
+    checkout_link VARCHAR NOT NULL,
+    product_id VARCHAR NOT NULL,
+    created_at_time VARCHAR NOT NULL,
+    fulfillment_time VARCHAR,
+    created_at DATETIME,
+    fulfilled_at DATETIME,
+    stripe_session_id VARCHAR,
+    stripe_invoice_state VARCHAR,
+    btcpay_invoice_id VARCHAR,
+    btcpay_invoice_state VARCHAR,
+    btcpay_city VARCHAR,
+    btcpay_state VARCHAR,
+    btcpay_postal_code VARCHAR,
+    btcpay_country VARCHAR,
+    btcpay_sales_tax FLOAT,
+    PRIMARY KEY (order_id)
+)
+"""
+
+ORDER_KEYED_INVOICES_INDEXES = [
+    ("ix_invoices_customer_orders", ["email", "product_id", "created_at"]),
+    ("ix_invoices_stripe_session_state", ["stripe_session_id", "order_state"]),
+    ("ix_invoices_btcpay_invoice_state", ["btcpay_invoice_id", "order_state"]),
+]
+
+def primary_key(conn, table):
+    return [row[1] for row in sorted(conn.execute(f"PRAGMA table_info({table})"), key=lambda row: row[5]) if row[5]]
+
+def migrate_order_keyed_invoices(conn):
+    """
+    Rebuild invoices with order_id as the primary key, so a customer can
+    hold many orders.
+
+    SQLite can't change a primary key in place, so rows are copied into a
+    new table in small batches while triggers mirror concurrent writes to
+    it. Only the final swap and the index builds hold the write lock.
+    """
+    if primary_key(conn, "invoices") == ["order_id"]:
+        logger.info("invoices is already keyed by order_id")
+        return
+
+    columns = ", ".join(INVOICE_COLUMNS)
+    new_values = ", ".join(f"NEW.{column}" for column in INVOICE_COLUMNS)
+
+    # Clean up after an interrupted run
+    for trigger in ("invoices_copy_insert", "invoices_copy_update", "invoices_copy_delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS invoices_new")
+
+    conn.execute(ORDER_KEYED_INVOICES_TABLE)
+    conn.execute(f"CREATE TRIGGER invoices_copy_insert AFTER INSERT ON invoices BEGIN "
+                 f"INSERT OR REPLACE INTO invoices_new ({columns}) VALUES ({new_values}); END")
+    conn.execute(f"CREATE TRIGGER invoices_copy_update AFTER UPDATE ON invoices BEGIN "
+                 f"DELETE FROM invoices_new WHERE order_id = OLD.order_id; "
+                 f"INSERT OR REPLACE INTO invoices_new ({columns}) VALUES ({new_values}); END")
+    conn.execute("CREATE TRIGGER invoices_copy_delete AFTER DELETE ON invoices BEGIN "
+                 "DELETE FROM invoices_new WHERE order_id = OLD.order_id; END")
+    conn.commit()
+
+    # Each batch reads the rows as of its own transaction, so it never
+    # overwrites a newer version written through the triggers
+    copied = 0
+    last_rowid = 0
+
+    while True:
+        rows = conn.execute("SELECT rowid FROM invoices WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                            (last_rowid, BACKFILL_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        first_rowid, last_rowid = rows[0][0], rows[-1][0]
+        conn.execute(f"INSERT OR REPLACE INTO invoices_new ({columns}) "
+                     f"SELECT {columns} FROM invoices WHERE rowid BETWEEN ? AND ?", (first_rowid, last_rowid))
+        conn.commit()
+
+        copied += len(rows)
+        time.sleep(BACKFILL_BATCH_SLEEP)
+
+    logger.info(f"copied {copied} invoices, swapping tables")
+
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("DROP TRIGGER invoices_copy_insert")
+    conn.execute("DROP TRIGGER invoices_copy_update")
+    conn.execute("DROP TRIGGER invoices_copy_delete")
+    conn.execute("DROP TABLE invoices")
+    conn.execute("ALTER TABLE invoices_new RENAME TO invoices")
+    for name, index_columns in ORDER_KEYED_INVOICES_INDEXES:
+        conn.execute(f"CREATE INDEX {name} ON invoices ({', '.join(index_columns)})")
+    conn.commit()
+
+def migrate_state_created_index(conn):
+    """
+    Index orders by state and age for garbage collection and reconciliation.
+    """
+    create_index(conn, "ix_invoices_state_created", "invoices", ["order_state", "created_at"])
+
+def migrate_partial_payment_indexes(conn):
+    """
+    Index payment references only on the orders paid that way. On a
+    database with orders of one provider only, ANALYZE found the other
+    provider's column all NULL and the webhook lookups fell back to scans.
+    """
+    create_index(conn, "ix_invoices_stripe_sessions", "invoices", ["stripe_session_id", "order_state"],
+                 where="stripe_session_id IS NOT NULL")
+    create_index(conn, "ix_invoices_btcpay_invoices", "invoices", ["btcpay_invoice_id", "order_state"],
+                 where="btcpay_invoice_id IS NOT NULL")
+
+    # Superseded by the partial indexes above
+    drop_index(conn, "ix_invoices_stripe_session_state")
+    drop_index(conn, "ix_invoices_btcpay_invoice_state")
+
+MIGRATIONS = [
+    (migrate_datetime_columns_and_lookup_indexes, backfill_datetime_columns),
+    (migrate_order_keyed_invoices, None),
+    (migrate_state_created_index, None),
+    (migrate_partial_payment_indexes, None),
+]
+
+def migrate(db_path):
+    """
+    Apply pending migrations and run every backfill.
+
+    Args:
+        db_path (str): Path of the invoices database
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        logger.info(f"{db_path}: schema version {version}, latest {len(MIGRATIONS)}")
+
+        for number, (schema_step, backfill_step) in enumerate(MIGRATIONS, start=1):
+            if number > version:
+                logger.info(f"applying migration {number}: {schema_step.__name__}")
+                schema_step(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+
+            if backfill_step is not None:
+                backfill_step(conn)
+
+        conn.execute("ANALYZE invoices")
+        conn.commit()
+    finally:
+        conn.close()
+
+#
+# Query plan checks
+#
+# (description, SQL as issued by the backend, text the plan must contain)
+PLAN_CHECKS = [
+    ("checkout lookup of a customer's latest order",
+     "SELECT * FROM invoices WHERE invoices.email = ? AND invoices.product_id = ? ORDER BY invoices.created_at DESC LIMIT ? OFFSET ?",
+     "USING INDEX ix_invoices_customer_orders (email=? AND product_id=?)"),
+    ("invoice lookup by order_id",
+     "SELECT * FROM invoices WHERE invoices.order_id = ?",
+     "USING INDEX sqlite_autoindex_invoices_1 (order_id=?)"),
+    ("stripe webhook invoice lookup",
+     "SELECT * FROM invoices WHERE invoices.stripe_session_id = ? LIMIT ? OFFSET ?",
+     "USING INDEX ix_invoices_stripe_sessions (stripe_session_id=?)"),
+    ("btcpay webhook invoice lookup",
+     "SELECT * FROM invoices WHERE invoices.btcpay_invoice_id = ? LIMIT ? OFFSET ?",
+     "USING INDEX ix_invoices_btcpay_invoices (btcpay_invoice_id=?)"),
+    ("stripe SSE state poll",
+     "SELECT invoices.order_state FROM invoices WHERE invoices.stripe_session_id = ? LIMIT ? OFFSET ?",
+     "USING COVERING INDEX ix_invoices_stripe_sessions (stripe_session_id=?)"),
+    ("btcpay SSE state poll",
+     "SELECT invoices.order_state FROM invoices WHERE invoices.btcpay_invoice_id = ? LIMIT ? OFFSET ?",
+     "USING COVERING INDEX ix_invoices_btcpay_invoices (btcpay_invoice_id=?)"),
+    ("garbage collection of terminal orders",
+     "SELECT * FROM invoices WHERE invoices.order_state IN (?, ?, ?) AND invoices.created_at < ? LIMIT ? OFFSET ?",
+     "USING INDEX ix_invoices_state_created (order_state=? AND created_at<?)"),
+    ("reconciliation of pending orders",
+     "SELECT invoices.email, invoices.created_at, invoices.stripe_session_id, invoices.btcpay_invoice_id FROM invoices "
+     "WHERE invoices.order_state = ? AND invoices.created_at >= ? AND invoices.created_at <= ?",
+     "USING INDEX ix_invoices_state_created (order_state=? AND created_at>? AND created_at<?)"),
+]
+
+def query_plan(conn, sql):
+    parameters = (None,) * sql.count("?")
+    return " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters))
+
+def check_plans(db_path):
+    """
+    Check that every invoice access pattern uses its intended index.
+
+    Args:
+        db_path (str): Path of the invoices database
+
+    Returns:
+        bool: True if every plan matched
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    ok = True
+
+    try:
+        for description, sql, expected in PLAN_CHECKS:
+            plan = query_plan(conn, sql)
+            # A sort means the index doesn't match the ORDER BY
+            if expected in plan and "TEMP B-TREE" not in plan:
+                logger.info(f"ok: {description}: {plan}")
+            else:
+                logger.error(f"FAIL: {description}: expected '{expected}', got: {plan}")
+                ok = False
+    finally:
+        conn.close()
+
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the mycomize invoices database")
+    parser.add_argument("command", choices=["migrate", "check-plans"], help="Apply migrations or check query plans")
+    parser.add_argument("database", help="Path of the invoices database, e.g. ../data/prod/invoices.db")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.database)
+    elif not check_plans(args.database):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
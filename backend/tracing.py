@@ -0,0 +1,255 @@
+"""
+Lightweight per-request span tracing.
+
+A trace is started for a request and stored in a context variable, so any
+coroutine awaited while handling the request can time a stage with
+`span(name)` without having the trace passed to it. When the trace finishes
+its spans can be exported as OTLP/JSON to a local file and/or an
+OpenTelemetry collector, and requests slower than a threshold are logged
+with their per-stage breakdown.
+"""
+import asyncio
+import contextvars
+import httpx
+import json
+import logging
+import secrets
+import time
+
+log = logging.getLogger("mycomize-backend")
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# Exporter settings, set by configure_tracing()
+trace_export_file = None
+trace_collector_url = None
+trace_slow_request_ms = 2000
+
+# Keep references to in-flight collector exports so they are not garbage collected
+pending_exports = set()
+
+def configure_tracing(export_file=None, collector_url=None, slow_request_ms=2000):
+    """
+    Configure where finished traces are exported.
+
+    Args:
+        export_file (str, optional): Path of a file to append OTLP/JSON lines to
+        collector_url (str, optional): OTLP/HTTP traces URL of a collector,
+            e.g. http://localhost:4318/v1/traces
+        slow_request_ms (float, optional): Traces at least this long are logged
+            with their breakdown. Defaults to 2000.
+    """
+    global trace_export_file, trace_collector_url, trace_slow_request_ms
+
+    trace_export_file = export_file
+    trace_collector_url = collector_url
+    trace_slow_request_ms = slow_request_ms
+
+class Span:
+    """A timed stage of a trace."""
+    __slots__ = ("name", "span_id", "start", "end", "start_time_ns", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.start_time_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = False
+
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        self.error = exc_type is not None
+        return False
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_noop_span = _NoopSpan()
+
+class Trace:
+    """A request-level trace made up of sequential child spans."""
+
+    def __init__(self, name, **attributes):
+        self.root = Span(name)
+        self.trace_id = secrets.token_hex(16)
+        self.attributes = dict(attributes)
+        self.spans = []
+        self.token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def span(self, name):
+        span = Span(name)
+        self.spans.append(span)
+        return span
+
+    def breakdown(self):
+        """
+        Get the duration of every stage in milliseconds.
+
+        Returns:
+            dict: Stage name to duration in ms, plus the total as 'total'
+        """
+        stages = {}
+        for span in self.spans:
+            stages[span.name] = round(stages.get(span.name, 0.0) + span.duration_ms(), 2)
+        stages["total"] = round(self.root.duration_ms(), 2)
+        return stages
+
+    def to_otlp(self):
+        """
+        Convert the trace to an OTLP/JSON ExportTraceServiceRequest.
+
+        Returns:
+            dict: The OTLP/JSON payload
+        """
+        root_end_ns = self.root.start_time_ns + int(self.root.duration_ms() * 1e6)
+        attributes = [
+            {"key": key, "value": {"stringValue": str(value)}}
+            for key, value in self.attributes.items()
+        ]
+
+        otlp_spans = [{
+            "traceId": self.trace_id,
+            "spanId": self.root.span_id,
+            "name": self.root.name,
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": str(self.root.start_time_ns),
+            "endTimeUnixNano": str(root_end_ns),
+            "attributes": attributes,
+        }]
+
+        for span in self.spans:
+            otlp_spans.append({
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": self.root.span_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span.start_time_ns),
+                "endTimeUnixNano": str(span.start_time_ns + int(span.duration_ms() * 1e6)),
+                "status": {"code": 2 if span.error else 1},
+            })
+
+        return {
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": [{"key": "service.name", "value": {"stringValue": "mycomize-backend"}}]
+                },
+                "scopeSpans": [{
+                    "scope": {"name": "mycomize-backend"},
+                    "spans": otlp_spans,
+                }],
+            }]
+        }
+
+def start_trace(name, **attributes):
+    """
+    Start a trace and make it current for the running task.
+
+    Args:
+        name (str): Name of the root span, e.g. 'checkout'
+        **attributes: Attributes attached to the root span
+
+    Returns:
+        Trace: The new trace, which must be passed to finish_trace()
+    """
+    trace = Trace(name, **attributes)
+    trace.token = current_trace.set(trace)
+    return trace
+
+def span(name):
+    """
+    Time a stage of the current trace.
+
+    Args:
+        name (str): Name of the stage
+
+    Returns:
+        Span: Context manager timing the stage, or a no-op outside a trace
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return _noop_span
+    return trace.span(name)
+
+def set_trace_attribute(key, value):
+    """Set an attribute on the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.set_attribute(key, value)
+
+def finish_trace(trace):
+    """
+    Finish a trace, log it if it was slow and hand it to the exporters.
+
+    Args:
+        trace (Trace): The trace returned by start_trace()
+    """
+    trace.root.end = time.perf_counter()
+    current_trace.reset(trace.token)
+
+    breakdown = trace.breakdown()
+    if breakdown["total"] >= trace_slow_request_ms:
+        attributes = " ".join(f"{key}={value}" for key, value in trace.attributes.items())
+        log.warning(f"slow {trace.root.name}: {attributes} trace_id={trace.trace_id} breakdown_ms={json.dumps(breakdown)}")
+
+    if trace_export_file is None and trace_collector_url is None:
+        return
+
+    payload = trace.to_otlp()
+
+    if trace_export_file is not None:
+        try:
+            with open(trace_export_file, "a") as f:
+                f.write(json.dumps(payload) + "\n")
+        except OSError as e:
+            log.error(f"failed to export trace to {trace_export_file}: {e}")
+
+    if trace_collector_url is not None:
+        task = asyncio.get_running_loop().create_task(export_to_collector(payload))
+        pending_exports.add(task)
+        task.add_done_callback(pending_exports.discard)
+
+async def export_to_collector(payload):
+    """
+    Send a trace to an OpenTelemetry collector over OTLP/HTTP JSON.
+
+    Args:
+        payload (dict): The OTLP/JSON payload
+    """
+    try:
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            response = await client.post(trace_collector_url, json=payload)
+
+        if response.status_code >= 300:
+            log.error(f"failed to export trace to collector (status_code={response.status_code})")
+    except httpx.HTTPError as e:
+        log.error(f"failed to export trace to collector: {e}")
+
+async def flush_traces(timeout):
+    """
+    Wait for in-flight collector exports to finish, at shutdown.
+
+    Args:
+        timeout (float): Seconds to wait at most
+    """
+    if not pending_exports:
+        return
+
+    done, pending = await asyncio.wait(set(pending_exports), timeout=timeout)
+    if pending:
+        log.warning(f"dropped {len(pending)} trace exports still in flight at shutdown")
@@ -0,0 +1,113 @@
+"""
+Idempotency store for webhook deliveries.
+
+Stripe and BTCPay retry webhooks, so the same event can arrive many times.
+The dedupe key of every applied event is recorded in a compact table in the
+webhook inbox database, fronted by an in-memory LRU of recently seen keys.
+A retried delivery is rejected with a dict lookup, or at worst a primary key
+lookup, without touching the invoice row. Keys are kept for a retention
+window that comfortably covers the providers' retry schedules.
+"""
+import time
+
+from collections import OrderedDict
+from database import ProcessedWebhookEvent, WebhookEvent
+
+class WebhookDedupeStore:
+    """
+    Records processed webhook events and answers whether one was seen.
+
+    Args:
+        retention (float): Seconds to remember a processed event
+        max_entries (int): Maximum number of keys held in memory
+        prune_batch_size (int): Rows deleted per statement when pruning
+    """
+
+    def __init__(self, retention=30 * 86400, max_entries=10000, prune_batch_size=1000):
+        self.retention = retention
+        self.max_entries = max_entries
+        self.prune_batch_size = prune_batch_size
+
+        # dedupe_key -> processed_at, most recently used last
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, webhook_inbox_db, dedupe_key):
+        """
+        Check whether an event was already processed within the retention window.
+
+        Args:
+            webhook_inbox_db (Session): Webhook inbox database session
+            dedupe_key (str): The event's dedupe key
+
+        Returns:
+            bool: True if the event is a duplicate
+        """
+        cutoff = time.time() - self.retention
+
+        processed_at = self.cache.get(dedupe_key)
+        if processed_at is not None and processed_at > cutoff:
+            self.cache.move_to_end(dedupe_key)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+
+        row = webhook_inbox_db.get(ProcessedWebhookEvent, dedupe_key)
+        if row is None or row.processed_at <= cutoff:
+            return False
+
+        self.remember(dedupe_key, row.processed_at)
+        return True
+
+    def mark_processed(self, webhook_inbox_db, dedupe_key, processed_at):
+        """
+        Record an event as processed. The caller commits the session and
+        then calls remember() so the cache never runs ahead of the table.
+
+        Args:
+            webhook_inbox_db (Session): Webhook inbox database session
+            dedupe_key (str): The event's dedupe key
+            processed_at (float): Unix time the event was applied
+        """
+        webhook_inbox_db.merge(ProcessedWebhookEvent(dedupe_key=dedupe_key, processed_at=processed_at))
+
+    def remember(self, dedupe_key, processed_at):
+        self.cache[dedupe_key] = processed_at
+        self.cache.move_to_end(dedupe_key)
+
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def prune(self, webhook_inbox_db):
+        """
+        Delete processed events and applied inbox rows older than the retention window.
+
+        Args:
+            webhook_inbox_db (Session): Webhook inbox database session
+
+        Returns:
+            int: Number of rows deleted
+        """
+        cutoff = time.time() - self.retention
+        deleted = 0
+
+        # Delete in small batches so the inbox writers are never blocked for long
+        for model, key in ((ProcessedWebhookEvent, ProcessedWebhookEvent.dedupe_key), (WebhookEvent, WebhookEvent.id)):
+            while True:
+                keys = [row[0] for row in webhook_inbox_db.query(key)
+                        .filter(model.processed_at < cutoff)
+                        .limit(self.prune_batch_size)
+                        .all()]
+                if not keys:
+                    break
+
+                deleted += webhook_inbox_db.query(model).filter(key.in_(keys)).delete(synchronize_session=False)
+                webhook_inbox_db.commit()
+
+        for dedupe_key in [key for key, processed_at in self.cache.items() if processed_at <= cutoff]:
+            del self.cache[dedupe_key]
+
+        return deleted
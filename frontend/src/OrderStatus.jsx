@@ -51,6 +51,12 @@ export function OrderStatus() {
             })
 
             eventSource.onerror = (error) => {
+                // The connection dropped (e.g. the backend restarted), let the browser
+                // reconnect, it resumes the stream with Last-Event-ID
+                if (eventSource.readyState === EventSource.CONNECTING) {
+                    return;
+                }
+
                 console.error("BTCPay EventSource failed:", error);
                 eventSource.close();
             };
@@ -74,6 +80,12 @@ export function OrderStatus() {
             })
 
             eventSource.onerror = (error) => {
+                // The connection dropped (e.g. the backend restarted), let the browser
+                // reconnect, it resumes the stream with Last-Event-ID
+                if (eventSource.readyState === EventSource.CONNECTING) {
+                    return;
+                }
+
                 console.error("Stripe EventSource failed:", error);
                 eventSource.close();
             };